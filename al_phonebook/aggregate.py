@@ -0,0 +1,127 @@
+import math
+from typing import Any, Callable, Mapping, Sequence
+
+from .indexes import is_number
+from .types import DictItem
+
+WORKSPACE = "workspace"
+METRICS = ("count", "sum", "min", "max", "avg")
+
+
+class AggregationError(Exception):
+    def __init__(self, spec: str, message: str) -> None:
+        super().__init__(f"Invalid aggregation `{spec}`. {message}")
+
+
+def group_key(spec: str) -> Callable[[str, Mapping], Any]:
+    """Parses a group by specification into a function of (workspace, document):
+
+    * `workspace`: the workspace of the contact.
+    * `<field>`: the value of the field, e.g. `age`.
+    * `<field>:domain`: the domain of an email field, e.g. `email:domain`.
+    * `<field>:<width>`: numbers in buckets of `width`, e.g. `age:10` groups 30 to 39 under 30.
+
+    :raises AggregationError: If `spec` is invalid.
+    """
+    if spec == WORKSPACE:
+        return lambda workspace, document: workspace
+
+    field, _, transform = spec.partition(":")
+    if not transform:
+        return lambda workspace, document: document.get(field)
+
+    if transform == "domain":
+
+        def domain(workspace: str, document: Mapping) -> Any:
+            value = document.get(field)
+            if not isinstance(value, str) or "@" not in value:
+                return None
+            return value.rsplit("@", 1)[1].casefold()
+
+        return domain
+
+    try:
+        width = float(transform)
+        assert width > 0
+    except (ValueError, AssertionError):
+        raise AggregationError(spec, "Use `<field>:domain` or `<field>:<bucket width>`.")
+
+    def bucket(workspace: str, document: Mapping) -> Any:
+        value: Any = document.get(field)
+        if not is_number(value):
+            return None
+        start = math.floor(value / width) * width
+        return int(start) if width.is_integer() else start
+
+    return bucket
+
+
+def parse_metric(spec: str) -> tuple[str, str]:
+    """Parses `count` or `<metric>:<field>`, e.g. `avg:age`.
+
+    :raises AggregationError: If `spec` is invalid.
+    """
+    metric, _, field = spec.partition(":")
+    if metric not in METRICS:
+        raise AggregationError(spec, f"Supported metrics are: {', '.join(METRICS)}.")
+    if metric != "count" and not field:
+        raise AggregationError(spec, f"`{metric}` needs a field, e.g. `{metric}:age`.")
+    return metric, field
+
+
+def _sort_key(value: Any) -> tuple:
+    return (value is None, not is_number(value), value if is_number(value) else str(value))
+
+
+class Aggregation:
+    """Groups raw documents and computes metrics over each group in a single pass, without
+    building `Item`s.
+
+    :param group_by: Group by specifications, see `group_key`.
+    :param metrics: Metric specifications, see `parse_metric`.
+    """
+
+    def __init__(self, group_by: Sequence[str], metrics: Sequence[str]) -> None:
+        self.group_by = list(group_by)
+        self.metrics = list(metrics)
+        self._keys = [group_key(spec) for spec in self.group_by]
+        self._metrics = [parse_metric(spec) for spec in self.metrics]
+        # For each group, [count, sum, min, max, numeric count] for every metric
+        self._groups: dict[tuple, list[list[Any]]] = {}
+
+    def add(self, workspace: str, document: Mapping) -> None:
+        group = tuple(key(workspace, document) for key in self._keys)
+        accumulators = self._groups.get(group)
+        if accumulators is None:
+            accumulators = [[0, 0, None, None, 0] for _ in self._metrics]
+            self._groups[group] = accumulators
+        for (metric, field), accumulator in zip(self._metrics, accumulators):
+            accumulator[0] += 1
+            if metric == "count":
+                continue
+            value = document.get(field)
+            if not is_number(value):
+                continue
+            accumulator[1] += value
+            accumulator[2] = value if accumulator[2] is None else min(accumulator[2], value)
+            accumulator[3] = value if accumulator[3] is None else max(accumulator[3], value)
+            accumulator[4] += 1
+
+    def result(self) -> list[DictItem]:
+        """One row per group, sorted by group. Each row maps the group by and metric
+        specifications to their values."""
+        rows = []
+        for group in sorted(self._groups, key=lambda g: tuple(map(_sort_key, g))):
+            row: DictItem = dict(zip(self.group_by, group))
+            for spec, (metric, _), (count, total, low, high, numeric) in zip(
+                self.metrics, self._metrics, self._groups[group]
+            ):
+                row[spec] = {
+                    "count": count,
+                    "sum": total,
+                    "min": low,
+                    "max": high,
+                    "avg": total / numeric if numeric else None,
+                }[metric]
+            rows.append(row)
+        return rows
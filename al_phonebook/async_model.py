@@ -0,0 +1,122 @@
+import asyncio
+import functools
+import json
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Hashable, Optional, Sequence, TypeVar
+
+from .collection import ItemCollection
+from .lib import Item, Model
+from .types import DictItem
+
+# How many `Item`s `AsyncModel.all` validates at once in the executor
+BATCH_SIZE = 500
+
+T = TypeVar("T")
+
+
+class AsyncModel:
+    """Asyncio version of `Model`, for services running an event loop.
+
+    Every call runs in `executor`, so neither reading and writing the database nor validating
+    the results blocks the loop. The default executor has a single thread: databases aren't
+    safe to use from several threads and calls run in the order they were made, so a read
+    always sees the writes awaited before it.
+
+    Identical reads running at the same time (e.g. many requests listing the same workspace)
+    are coalesced into a single one and share its result, which mustn't be modified. Searches
+    of the same workspace running at the same time share a single `load` of it, if the
+    database supports it, and only apply their own filters on top of it.
+
+        async with AsyncModel(model) as phonebook:
+            found = await phonebook.filter({"name": "Cla"})
+    """
+
+    def __init__(self, model: Model, executor: Optional[Executor] = None) -> None:
+        self.model = model
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="al_phonebook-async"
+        )
+        # Reads running right now, by their arguments
+        self._reads: dict[Hashable, asyncio.Future] = {}
+        # Writes started so far, a search doesn't use a load made before one of them
+        self._writes = 0
+
+    async def __aenter__(self) -> "AsyncModel":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Shuts the executor down, unless it was given by the caller."""
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+
+    async def get(self, id: int, workspace: Optional[str] = None) -> Item:
+        return await self._read(("get", id, workspace), self.model.get, id, workspace)
+
+    async def filter(
+        self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> ItemCollection:
+        """See `Model.filter`."""
+        writes = self._writes
+        loaded = await self._read(("load", workspace), self.model.database.load, workspace)
+        if loaded is not None and writes == self._writes:
+            kwargs["loaded"] = loaded
+        return await self._run(
+            functools.partial(self.model.filter, filters, workspace=workspace, **kwargs)
+        )
+
+    async def all(self, **kwargs: Any) -> AsyncIterator[tuple[str, Item]]:
+        """Yields (workspace, `Item`) pairs of every entry. `Item`s are validated in batches of
+        `BATCH_SIZE` in the executor. Accepts the same options as `Model.all`."""
+        key = ("all", json.dumps(kwargs, sort_keys=True, default=str))
+        workspaces = await self._read(key, functools.partial(self.model.all, **kwargs))
+        for workspace, entries in workspaces.items():
+            for start in range(0, len(entries), BATCH_SIZE):
+                batch = await self._run(
+                    lambda: [entries[i] for i in range(start, min(start + BATCH_SIZE, len(entries)))]
+                )
+                for item in batch:
+                    yield workspace, item
+
+    async def add_item(self, item: DictItem, workspace: Optional[str] = None) -> Optional[int]:
+        return await self._write(self.model.add_item, item, workspace)
+
+    async def add_items(
+        self, items: Sequence[DictItem], workspace: Optional[str] = None
+    ) -> Sequence[Optional[int]]:
+        # Generators would be consumed in the executor thread
+        return await self._write(self.model.add_items, list(items), workspace)
+
+    async def update(
+        self, id: int, update: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Optional[int]:
+        """See `Model.update`."""
+        return await self._write(
+            functools.partial(self.model.update, id, update, workspace, **kwargs)
+        )
+
+    async def _run(self, function: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def _read(self, key: Hashable, function: Callable[..., T], *args: Any) -> T:
+        future = self._reads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(function, *args))
+            self._reads[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # A caller being cancelled mustn't cancel the read of the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._reads.get(key) is future:
+            del self._reads[key]
+
+    async def _write(self, function: Callable[..., T], *args: Any) -> T:
+        # Reads started from now on must see this write, don't share the ones already running
+        self._reads.clear()
+        self._writes += 1
+        return await self._run(function, *args)
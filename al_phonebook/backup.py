@@ -0,0 +1,166 @@
+import gzip
+import hashlib
+import json
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .changes import DELETE, RESET, ChangeEvent
+from .lib import AbcDatabase, TinyDBDatabase
+from .normalize import DELETED_KEY
+from .sidecar import write_atomic
+from .types import DictItem, PathLike
+
+MANIFEST = "manifest.json"
+
+
+class BackupError(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(f"Backup failed. {message}")
+
+
+@dataclass
+class BackupResult:
+    """What a `backup` wrote. `segment` is `None` when a snapshot was written or when
+    nothing changed since the last backup."""
+
+    directory: str
+    seq: int
+    snapshot: Optional[str] = None
+    segment: Optional[str] = None
+    changes: int = 0
+
+    def dict(self) -> DictItem:
+        return asdict(self)
+
+
+def sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _as_tinydb(database: AbcDatabase) -> TinyDBDatabase:
+    if not isinstance(database, TinyDBDatabase):
+        raise BackupError(f"{type(database).__name__} doesn't support backups.")
+    return database
+
+
+def _read_manifest(directory: Path) -> Optional[DictItem]:
+    try:
+        manifest: DictItem = json.loads((directory / MANIFEST).read_bytes())
+        return manifest
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        raise BackupError(f"{directory / MANIFEST} is corrupted.")
+
+
+def _write_gzip(path: Path, lines: Iterable[str]) -> DictItem:
+    with gzip.open(path, "wt", compresslevel=6) as f:
+        f.writelines(lines)
+    return {"file": path.name, "sha256": sha256(path)}
+
+
+def backup(database: AbcDatabase, directory: PathLike, full: bool = False) -> BackupResult:
+    """Backs up `database` to `directory`.
+
+    The first backup (or any with `full`) writes a compressed snapshot of the whole database.
+    The next ones only write a compressed segment with the changes recorded in the
+    `ChangeFeed` since the previous backup. Every file is listed in `manifest.json` with its
+    SHA-256, which is written last, so an interrupted backup leaves the previous one intact.
+
+    Writers are never blocked: the database file is read once without locking it.
+
+    :raises BackupError: If the database can't be backed up.
+    """
+    db = _as_tinydb(database)
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    manifest = None if full else _read_manifest(path)
+    last_seq = db.feed.last_seq
+
+    # The feed can't tell what changed if it was started over
+    if manifest is not None and manifest["seq"] <= last_seq:
+        events = [*db.feed.since(manifest["seq"])]
+        # Nor if the database was replaced since, e.g. a backup was restored
+        if all(event.op != RESET for event in events):
+            return _backup_changes(path, manifest, events)
+
+    try:
+        seq, tables = db.snapshot()
+    except OSError as e:
+        raise BackupError(str(e))
+    name = f"snapshot-{seq:010d}.json.gz"
+    snapshot = _write_gzip(path / name, [json.dumps({"seq": seq, "tables": tables})])
+    previous = _read_manifest(path)
+    write_atomic(
+        path / MANIFEST,
+        json.dumps({"seq": seq, "snapshot": {**snapshot, "seq": seq}, "segments": []}, indent=4).encode(),
+    )
+    # Files of the previous backup aren't needed anymore
+    if previous is not None:
+        for entry in [previous["snapshot"], *previous["segments"]]:
+            if entry["file"] != name:
+                (path / entry["file"]).unlink(missing_ok=True)
+    return BackupResult(str(path), seq, snapshot=name)
+
+
+def _backup_changes(path: Path, manifest: DictItem, events: list[ChangeEvent]) -> BackupResult:
+    """Writes `events` to a segment of the backup in `path` described by `manifest`."""
+    if not events:
+        return BackupResult(str(path), manifest["seq"])
+    name = f"delta-{events[0].seq:010d}-{events[-1].seq:010d}.jsonl.gz"
+    segment = _write_gzip(path / name, (json.dumps(e.dict()) + "\n" for e in events))
+    manifest["segments"].append({**segment, "from": events[0].seq, "to": events[-1].seq})
+    manifest["seq"] = events[-1].seq
+    write_atomic(path / MANIFEST, json.dumps(manifest, indent=4).encode())
+    return BackupResult(str(path), manifest["seq"], segment=name, changes=len(events))
+
+
+def _verified(directory: Path, entry: DictItem) -> Path:
+    file: Path = directory / entry["file"]
+    if not file.exists():
+        raise BackupError(f"{file} is missing.")
+    if sha256(file) != entry["sha256"]:
+        raise BackupError(f"{file} is corrupted, its checksum doesn't match.")
+    return file
+
+
+def restore(database: AbcDatabase, directory: PathLike) -> int:
+    """Replaces the content of `database` with the backup in `directory`: the snapshot and
+    then every change segment, replayed in memory and written at once. Every file is checked
+    against its checksum before anything is written. Returns the sequence number restored.
+
+    :raises BackupError: If the backup is missing, corrupted or incomplete.
+    """
+    db = _as_tinydb(database)
+    path = Path(directory)
+    manifest = _read_manifest(path)
+    if manifest is None:
+        raise BackupError(f"There's no backup in {path}.")
+    files = [_verified(path, manifest["snapshot"])]
+    files += [_verified(path, segment) for segment in manifest["segments"]]
+
+    with gzip.open(files[0], "rt") as f:
+        snapshot = json.load(f)
+    tables: dict[str, dict[str, DictItem]] = snapshot["tables"]
+    seq: int = snapshot["seq"]
+    for file, segment in zip(files[1:], manifest["segments"]):
+        if segment["from"] != seq + 1:
+            raise BackupError(f"Changes {seq + 1} to {segment['from'] - 1} are missing.")
+        with gzip.open(file, "rt") as f:
+            for line in f:
+                event = ChangeEvent(**json.loads(line))
+                table = tables.setdefault(event.workspace, {})
+                if event.op == DELETE:
+                    if str(event.id) in table:
+                        table[str(event.id)][DELETED_KEY] = True
+                else:
+                    table[str(event.id)] = db.stored_document(event.document or {})
+        seq = segment["to"]
+
+    db.replace_all(tables)
+    return seq
@@ -0,0 +1,44 @@
+import re
+from typing import Optional, Union
+
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+# Reading every entry holds the decoded documents, the entries built from them and the output,
+# several times the size of the stored data
+WORKING_SET_FACTOR = 6
+# Rough size in memory of an entry while it's sorted
+ENTRY_SIZE = 2048
+
+
+def parse_size(value: Union[str, int]) -> int:
+    """Parses a size in bytes, e.g. `128M`, `1.5G`, `512K` or `4096`.
+
+    :raises ValueError: If `value` isn't a size."""
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*", value, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size {value}, e.g. 128M, 1G or 512K.")
+    number, unit = match.groups()
+    return int(float(number) * UNITS[unit.upper()])
+
+
+def format_size(size: float) -> str:
+    for unit in ("", "K", "M"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}G"
+
+
+def exceeds(max_memory: Optional[int], stored_size: Optional[int]) -> bool:
+    """Whether reading every entry of a database storing `stored_size` bytes would exceed
+    `max_memory`. Unknown sizes are assumed to fit."""
+    if max_memory is None or stored_size is None:
+        return False
+    return stored_size * WORKING_SET_FACTOR > max_memory
+
+
+def run_size(max_memory: int) -> int:
+    """How many entries can be sorted in memory at once, using half of `max_memory`."""
+    return max(1, max_memory // 2 // ENTRY_SIZE)
+
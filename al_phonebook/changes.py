@@ -0,0 +1,163 @@
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import IO, Callable, Iterable, Iterator, Optional
+from warnings import warn
+
+from .sidecar import sidecar_path
+from .types import DictItem, OptionalDictItem
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+
+ADD, UPDATE, DELETE, RESET = "add", "update", "delete", "reset"
+
+
+@dataclass
+class ChangeEvent:
+    """A single write to the phonebook. `document` is the entry after the change, without
+    the keys reserved for the database, or `None` if it was deleted.
+
+    A `RESET` event, without workspace nor id, means the whole phonebook was replaced, e.g. by
+    restoring a backup. The events before it don't lead to the current content anymore."""
+
+    seq: int
+    op: str
+    workspace: str
+    id: int
+    document: OptionalDictItem = None
+
+    def dict(self) -> DictItem:
+        return asdict(self)
+
+
+Subscriber = Callable[[ChangeEvent], None]
+
+
+class ChangeFeed:
+    """Records every write to a database as a `ChangeEvent` with a monotonic sequence number,
+    so consumers (e.g. a cache or a search cluster mirroring the phonebook) can catch up with
+    only the changes since the last one they saw.
+
+    Events are appended to a jsonl sidecar file next to the database, or kept in memory for
+    databases without a file.
+    """
+
+    SUFFIX = ".changes"
+
+    def __init__(self, database_path: Optional[Path]) -> None:
+        self.path = sidecar_path(database_path, self.SUFFIX) if database_path else None
+        self._memory: list[ChangeEvent] = []
+        self._subscribers: list[Subscriber] = []
+
+    @property
+    def last_seq(self) -> int:
+        """Sequence number of the last event recorded, 0 if there's none. Read from the end of
+        the file every time, since other processes (e.g. another CLI command) may append to it."""
+        if self.path is None:
+            return self._memory[-1].seq if self._memory else 0
+        try:
+            with self.path.open("rb") as f:
+                return self._last_seq(f)
+        except FileNotFoundError:
+            return 0
+
+    def record(self, op: str, workspace: str, changes: Iterable[tuple[int, OptionalDictItem]]) -> None:
+        """Records an `op` event for each (id, document) of `changes`, which were written together,
+        and notifies the subscribers."""
+        changes = list(changes)
+        if not changes:
+            return
+        if self.path is None:
+            events = self._events(self.last_seq, op, workspace, changes)
+            self._memory.extend(events)
+        else:
+            with self.path.open("a+b") as f:
+                if fcntl is not None:
+                    # Other processes may record changes at the same time, the last sequence
+                    # number is read and the events appended holding the lock
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                events = self._events(self._last_seq(f), op, workspace, changes)
+                f.writelines((json.dumps(event.dict()) + "\n").encode() for event in events)
+        for event in events:
+            for subscriber in self._subscribers:
+                try:
+                    subscriber(event)
+                except Exception as e:
+                    warn(f"Subscriber {subscriber!r} failed on change {event.seq}: {e!r}")
+
+    def reset(self) -> None:
+        """Records a `RESET` event, after the whole phonebook was replaced."""
+        self.record(RESET, "", [(0, None)])
+
+    def since(self, seq: int = 0) -> Iterator[ChangeEvent]:
+        """Yields the events recorded after `seq`, in order. Only the events after `seq`
+        are read."""
+        if self.path is None:
+            # Sequence numbers start at 1 and have no gaps
+            yield from self._memory[max(seq, 0) :]
+            return
+        try:
+            f = self.path.open("rb")
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(self._offset_after(f, seq))
+            for line in f:
+                event = ChangeEvent(**json.loads(line))
+                if event.seq > seq:
+                    yield event
+
+    def subscribe(self, callback: Subscriber) -> Callable[[], None]:
+        """Calls `callback` with every event recorded from now on, right after the write.
+        Returns a function that cancels the subscription."""
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+    @staticmethod
+    def _events(
+        seq: int, op: str, workspace: str, changes: Iterable[tuple[int, OptionalDictItem]]
+    ) -> list[ChangeEvent]:
+        """Numbers the events of `changes` after the last sequence number `seq`."""
+        events = []
+        for doc_id, document in changes:
+            seq += 1
+            if document is not None:
+                document = dict(document)
+            events.append(ChangeEvent(seq, op, workspace, doc_id, document))
+        return events
+
+    @staticmethod
+    def _last_seq(f: IO[bytes]) -> int:
+        """Reads the sequence number of the last event from the end of the open file `f`."""
+        size = os.fstat(f.fileno()).st_size
+        window = 4096
+        while True:
+            start = max(size - window, 0)
+            f.seek(start)
+            lines = f.read().splitlines()
+            # The first line may be cut, unless the window starts at the file
+            if len(lines) > 1 or start == 0:
+                return json.loads(lines[-1])["seq"] if lines else 0
+            window *= 2
+
+    def _offset_after(self, f: IO[bytes], seq: int) -> int:
+        """Binary searches the file for the offset of a line at or before the first event
+        after `seq`. Works because events are appended in sequence order."""
+        low, high = 0, os.fstat(f.fileno()).st_size
+        while low < high:
+            middle = (low + high) // 2
+            f.seek(middle)
+            if middle:
+                # Skip the rest of the line `middle` falls in
+                f.readline()
+            start = f.tell()
+            line = f.readline()
+            if not line or json.loads(line)["seq"] > seq:
+                high = middle
+            else:
+                low = start + len(line)
+        return low
@@ -1,22 +1,48 @@
+import cProfile
+import json
 import os
-from typing import Optional
+import pstats
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from itertools import groupby, islice
+from operator import itemgetter
+from typing import Any, Iterable, Iterator, List, Optional
 
 import click
-from pydantic import ValidationError, schema_of
+from pydantic import BaseModel, ValidationError, schema_of
 from rich.console import Console
 from rich.layout import Layout
 from rich.panel import Panel
 from rich.pretty import pprint
 from rich.table import Table
 
+from .backup import BackupError
+from .backup import backup as create_backup
+from .backup import restore as restore_backup
+from .budget import format_size, parse_size
 from .config import (configuration_file, create_database_model,
                      parse_configuration)
-from .constants import CONSTANTS
+from .constants import CONSTANTS, FilterMode
 from .formatter_registry import FormatterRegistry
+from .aggregate import AggregationError
+from .explain import QueryPlan
+from .federated import SOURCES_KEY, FederationError
+from .indexes import FilterError
 from .lib import Item, Model
+from .metrics import METRICS
+from .sorting import SortError
+from .storages import SERIALIZERS, StorageFormatError
+
+try:
+    import readline
+except ImportError:  # readline isn't available on Windows
+    readline = None  # type: ignore[assignment]
 
 # TODO: #5 Update UI with rich/textual
 CONSOLE = Console()
+# Rows printed per table when contacts are streamed
+STREAM_BATCH = 1000
 
 
 class CliEnvironment:
@@ -31,18 +57,120 @@ def get_formatter_registry():
     return registry
 
 
+@contextmanager
+def prompt_completion(model: Model, field: str, workspace: Optional[str]) -> Iterator[None]:
+    """While active, pressing Tab in a prompt completes the input with values of `field`
+    already in the phonebook."""
+    if readline is None:
+        yield
+        return
+
+    # `list` is the command listing contacts in this module
+    suggestions: List[str] = []
+
+    def completer(text: str, state: int) -> Optional[str]:
+        if state == 0:
+            suggestions[:] = model.complete(field, text, workspace=workspace)
+        return suggestions[state] if state < len(suggestions) else None
+
+    previous_completer, previous_delims = readline.get_completer(), readline.get_completer_delims()
+    readline.set_completer(completer)
+    readline.set_completer_delims("")
+    readline.parse_and_bind("tab: complete")
+    try:
+        yield
+    finally:
+        readline.set_completer(previous_completer)
+        readline.set_completer_delims(previous_delims)
+
+
+def complete_search_pattern(
+    ctx: click.Context, param: click.Parameter, incomplete: str
+) -> List[str]:
+    """Shell completion for `search`: completes the field name first and then its value
+    with the values already in the phonebook."""
+    model = ctx.find_object(Model)
+    if model is None:
+        model = create_database_model(parse_configuration(configuration_file()))
+    # An incomplete `nargs=2` argument isn't parsed, its values are left in `ctx.args`
+    given = [*(ctx.params.get(param.name) or ctx.args)]
+    if not given:
+        return [f for f in model.ItemSchema.__fields__ if f.startswith(incomplete)]
+    return [*model.complete(given[0], incomplete, workspace=ctx.params.get("workspace"))]
+
+
+def print_profile(profiler: cProfile.Profile) -> None:
+    profiler.disable()
+    t = Table(title="Time by operation")
+    for column in ("Operation", "Calls", "Total (ms)", "Mean (ms)"):
+        t.add_column(column)
+    for operation, calls, total in METRICS.breakdown():
+        t.add_row(operation, str(calls), f"{total * 1000:.2f}", f"{total * 1000 / calls:.3f}")
+    CONSOLE.print(t)
+    CONSOLE.print(
+        ", ".join(f"{counter}: {value}" for counter, value in sorted(METRICS.counters.items()))
+    )
+    stats = pstats.Stats(profiler, stream=sys.stdout)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(15)
+
+
+def write_metrics(path: str) -> None:
+    exported = METRICS.to_prometheus() if path.endswith(".prom") else METRICS.to_json()
+    with open(path, "w") as f:
+        f.write(exported)
+
+
+def parse_max_memory(ctx: click.Context, param: click.Parameter, value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.group(
     no_args_is_help=True,
     invoke_without_command=True,
     help=f"Loading configuration file from {configuration_file()}\nExecute a command followed by --help for more help.",
 )
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="After the command, prints how long each operation took and the slowest functions.",
+)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    required=False,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Writes the metrics of the command to this file. In the Prometheus text format if it ends with .prom, json otherwise.",
+)
+@click.option(
+    "--max-memory",
+    callback=parse_max_memory,
+    help="Memory budget, e.g. 128M. Listing or searching more contacts than fit in it streams them instead of loading them all at once. The peak memory used is printed after the command. Defaults to `database.max_memory` in the configuration.",
+)
 @click.pass_context
-def cli(ctx):
+def cli(
+    ctx: click.Context, profile: bool, metrics_path: Optional[str], max_memory: Optional[int]
+) -> None:
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        ctx.call_on_close(lambda: print_profile(profiler))
+    if metrics_path:
+        ctx.call_on_close(lambda: write_metrics(metrics_path))
     click.secho(
         f"📖 Starting {click.style('AL', fg='bright_blue', bold=True)} Phonebook! 📖\n\n"
     )
     config = parse_configuration(configuration_file())
     model = create_database_model(config)
+    if max_memory is not None:
+        model.max_memory = max_memory
+    if model.max_memory:
+        tracemalloc.start()
+        ctx.call_on_close(lambda: print_peak_memory(model.max_memory))
     ctx.obj = model
 
 
@@ -69,22 +197,31 @@ def add(model, workspace: Optional[str] = None) -> None:
         parameter_styled = click.style(
             f"{data['title'].lower()}", bold=True, blink=True, fg="yellow"
         )
-        r = click.prompt(f"Enter the contact's {parameter_styled}", default="")
+        with prompt_completion(model, name, workspace):
+            r = click.prompt(f"Enter the contact's {parameter_styled}", default="")
         t.add_column(data["title"])
         if r:
             d[name] = r
 
     try:
         item = Item(**d)
-        already_exists = model.filter(
-            {"name": item.name}, exact=True, workspace=workspace
-        )
+        already_exists = []
+        # Most new contacts don't exist yet, `exists` answers that without a search
+        if model.exists({"name": item.name}, workspace=workspace):
+            already_exists = model.filter(
+                {"name": item.name}, exact=True, workspace=workspace
+            )
         if already_exists:
             overwrite = click.prompt(
                 "Entry with name {name} already exists, update?", type=bool
             )
             if overwrite:
-                model.update(already_exists[0].id, item.dict())
+                entry = already_exists[0]
+                # Ids are only unique within a source, the entries of a federated database
+                # tell which one they are from
+                sources = getattr(entry, SOURCES_KEY, None)
+                options = {"source": sources[0]} if sources else {}
+                model.update(entry.id, item.dict(), workspace=workspace, **options)
         else:
             model.add_item(d, workspace=workspace)
         t.title = workspace or "Default"
@@ -93,6 +230,8 @@ def add(model, workspace: Optional[str] = None) -> None:
         CONSOLE.print(t)
     except ValidationError as e:
         click.echo(f"Invalid input {e}")
+    except FederationError as e:
+        click.echo(e)
 
 
 @click.command(help="Lists all contacts separated by workspace.")
@@ -111,20 +250,53 @@ def add(model, workspace: Optional[str] = None) -> None:
     type=str,
     help="If given, outputs the result in a specific format. Check the documentation for information on how to add more formatters.",
 )
+@click.option(
+    "-s",
+    "--sort",
+    "order_by",
+    type=str,
+    help="Sorts the contacts by these fields, separated by commas, e.g. name,-age. A - sorts the field in descending order.",
+)
+@click.option(
+    "-n",
+    "--limit",
+    type=click.IntRange(1),
+    help="Shows at most this many contacts (per workspace for list).",
+)
 @click.pass_obj
-def list(model: Model, workspace: Optional[str], formatter_name: str) -> None:
+def list(
+    model: Model,
+    workspace: Optional[str],
+    formatter_name: str,
+    order_by: Optional[str],
+    limit: Optional[int],
+) -> None:
     registry = get_formatter_registry()
-    all_entries = model.all()
+    try:
+        if model.streams():
+            streamed = model.iter_all(order_by=order_by, limit=limit)
+            if formatter_name in registry.formatters:
+                # Formatters get every contact at once
+                as_dict: dict[str, Any] = {}
+                for workspace_name, item in streamed:
+                    as_dict.setdefault(workspace_name, []).append(item.dict())
+                CONSOLE.print(registry.format(formatter_name, as_dict))
+            else:
+                print_streamed(streamed)
+            return
+        all_entries = model.all(order_by=order_by, limit=limit)
+    except SortError as e:
+        click.echo(e)
+        return
 
     if all_entries:
         if formatter_name:
-            formatter = registry.formatters.get(formatter_name)
-            if formatter:
+            if formatter_name in registry.formatters:
                 as_dict = {}
                 for entry in all_entries:
                     as_dict[entry] = [i.dict() for i in all_entries[entry]]
 
-                CONSOLE.print(formatter.format(as_dict))
+                CONSOLE.print(registry.format(formatter_name, as_dict))
                 return
         for workspace_name, entries in all_entries.items():
             t = Table(title=workspace_name)
@@ -153,7 +325,7 @@ will find any contacts that contain "Vi" in their "name".
 
 """
 )
-@click.argument("pattern", nargs=2)
+@click.argument("pattern", nargs=2, shell_complete=complete_search_pattern)
 @click.option(
     "-w",
     "--workspace",
@@ -169,19 +341,82 @@ will find any contacts that contain "Vi" in their "name".
     type=str,
     help="If given, outputs the result in a specific format. Check the documentation for information on how to add more formatters.",
 )
+@click.option(
+    "-m",
+    "--mode",
+    default=FilterMode.FULLTEXT.value,
+    type=click.Choice([m.value for m in FilterMode]),
+    help="How the value is matched. 'phonetic' finds values that sound alike, e.g. Clarice and Clarisse. 'regex' searches a regular expression.",
+)
+@click.option(
+    "-s",
+    "--sort",
+    "order_by",
+    type=str,
+    help="Sorts the contacts by these fields, separated by commas, e.g. name,-age. A - sorts the field in descending order.",
+)
+@click.option(
+    "-n",
+    "--limit",
+    type=click.IntRange(1),
+    help="Shows at most this many contacts (per workspace for list).",
+)
+@click.option(
+    "--explain",
+    is_flag=True,
+    help="Also prints how the search was executed: which index was used, how many contacts were checked and how long it took.",
+)
 @click.pass_obj
 def search(
-    model: Model, pattern: str, workspace: Optional[str], formatter_name: str
+    model: Model,
+    pattern: str,
+    workspace: Optional[str],
+    formatter_name: str,
+    mode: str,
+    explain: bool,
+    order_by: Optional[str],
+    limit: Optional[int],
 ) -> None:
     registry = get_formatter_registry()
     key, value = pattern
     click.echo(f"Searching for field {key} with value {value}!")
-    result = model.filter({key: value}, workspace=workspace)
+    try:
+        if model.streams():
+            if explain:
+                click.echo("--explain can't be used when the contacts don't fit in --max-memory and are streamed.")
+                return
+            found = model.iter_filter(
+                {key: value},
+                workspace=workspace,
+                mode=FilterMode(mode),
+                order_by=order_by,
+                limit=limit,
+            )
+            if formatter_name in registry.formatters:
+                # Formatters get every contact at once
+                CONSOLE.print(registry.format(formatter_name, [i.dict() for i in found]))
+            else:
+                print_streamed((workspace or "Default", i) for i in found)
+            return
+        # The plans are those of this search, not of a second one
+        plans: List[QueryPlan] = []
+        result = model.filter(
+            {key: value},
+            workspace=workspace,
+            mode=FilterMode(mode),
+            order_by=order_by,
+            limit=limit,
+            **({"plans": plans} if explain else {}),
+        )
+        for plan in plans:
+            print_plan(plan)
+    except (FilterError, SortError) as e:
+        click.echo(e)
+        return
     if result:
         if formatter_name:
-            formatter = registry.formatters.get(formatter_name)
-            if formatter:
-                formatted = formatter.format([i.dict() for i in result])
+            if formatter_name in registry.formatters:
+                formatted = registry.format(formatter_name, [i.dict() for i in result])
                 CONSOLE.print(formatted)
                 return
         t = Table(title=workspace or "Default")
@@ -193,7 +428,222 @@ def search(
         CONSOLE.print(t)
 
 
+def print_streamed(entries: Iterable[tuple[str, BaseModel]]) -> None:
+    """Prints (workspace, `Item`) pairs as they come, in tables of at most `STREAM_BATCH` rows,
+    so only those are held at once."""
+    for workspace, group in groupby(entries, key=itemgetter(0)):
+        items = (item for _, item in group)
+        while batch := [*islice(items, STREAM_BATCH)]:
+            t = Table(title=workspace)
+            for name in batch[0].dict().keys():
+                t.add_column(name.title())
+            for entry in batch:
+                t.add_row(*[str(i) if i else "" for i in entry.dict().values()])
+            CONSOLE.print(t)
+
+
+def print_peak_memory(max_memory: int) -> None:
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    click.echo(f"Peak memory: {format_size(peak)} (budget {format_size(max_memory)})")
+
+
+def print_plan(plan: QueryPlan) -> None:
+    t = Table(title=f"Plan: {plan.access_path}")
+    for column in ("Field", "Condition", "Access", "Rows"):
+        t.add_column(column)
+    for step in plan.steps:
+        t.add_row(step.field, str(step.condition), step.access, format_stat(step.rows))
+    CONSOLE.print(t)
+    timings = ", ".join(f"{stage}: {seconds * 1000:.2f}ms" for stage, seconds in plan.timings.items())
+    click.echo(
+        f"Estimated rows: {plan.estimated_rows}, scanned: {plan.rows_scanned}, "
+        f"returned: {plan.rows_returned}. {timings}"
+    )
+
+
+def format_stat(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.2f}".rstrip("0").rstrip(".")
+    return str(value)
+
+
+@click.command(
+    help="""Prints statistics about the contacts. By default, how many contacts there are in each workspace. E.g:
+
+al_phonebook stats -g email:domain
+
+counts the contacts by email domain and
+
+al_phonebook stats -g age:10 -m count -m avg:age
+
+prints an age histogram with buckets of 10 years.
+"""
+)
+@click.option(
+    "-g",
+    "--group-by",
+    multiple=True,
+    default=["workspace"],
+    help="How contacts are grouped: workspace, a field name, <field>:domain or <field>:<bucket width>. Can be repeated.",
+)
+@click.option(
+    "-m",
+    "--metric",
+    multiple=True,
+    default=["count"],
+    help="What is computed for each group: count, or sum, min, max, avg of a field (e.g. avg:age). Can be repeated.",
+)
+@click.option(
+    "-w",
+    "--workspace",
+    multiple=True,
+    help="If given, only contacts in these workspaces are included. Can be repeated.",
+)
+@click.pass_obj
+def stats(
+    model: Model, group_by: tuple[str, ...], metric: tuple[str, ...], workspace: tuple[str, ...]
+) -> None:
+    try:
+        rows = model.aggregate(group_by=group_by, metrics=metric, workspaces=workspace)
+    except AggregationError as e:
+        click.echo(e)
+        return
+
+    t = Table(title="Statistics")
+    for column in [*group_by, *metric]:
+        t.add_column(column)
+    for row in rows:
+        t.add_row(*[format_stat(value) for value in row.values()])
+    CONSOLE.print(t)
+
+
+@click.command(help="Finds contacts that are probably duplicates of each other, across all workspaces.")
+@click.option(
+    "-t",
+    "--threshold",
+    default=0.6,
+    type=click.FloatRange(0, 1),
+    help="Minimum similarity score, between 0 and 1, of the suggested duplicates.",
+)
+@click.option(
+    "--window",
+    default=5,
+    type=click.IntRange(2),
+    help="How many neighbouring contacts each contact is compared with. Higher finds more duplicates but is slower.",
+)
+@click.option(
+    "-o",
+    "--output",
+    required=False,
+    type=click.Path(dir_okay=False, writable=True),
+    help="If given, writes the merge suggestions to this file as json.",
+)
+@click.pass_obj
+def dedupe(model: Model, threshold: float, window: int, output: Optional[str]) -> None:
+    suggestions = model.find_duplicates(window=window, threshold=threshold, workers=None)
+    if output:
+        with open(output, "w") as f:
+            json.dump([s.dict() for s in suggestions], f, indent=4)
+
+    if not suggestions:
+        click.echo("No duplicates found!")
+        return
+
+    t = Table(title="Merge suggestions")
+    for column in ("Workspace", "Id", "Duplicate workspace", "Duplicate id", "Score", "Matched"):
+        t.add_column(column)
+    for s in suggestions:
+        t.add_row(
+            s.workspace,
+            str(s.id),
+            s.duplicate_workspace,
+            str(s.duplicate_id),
+            f"{s.score:.2f}",
+            ", ".join(s.reasons),
+        )
+    CONSOLE.print(t)
+
+
+@click.command(
+    help="Migrates the stored contacts to the current model after `custom_fields` or the custom model changed. Contacts are already migrated when read, this makes it permanent. An interrupted migration resumes where it stopped."
+)
+@click.option(
+    "--batch-size",
+    default=500,
+    type=click.IntRange(1),
+    help="How many contacts are migrated and written at once.",
+)
+@click.pass_obj
+def migrate(model: Model, batch_size: int) -> None:
+    migrated = 0
+    failed: List[str] = []
+    for progress in model.migrate(batch_size=batch_size):
+        migrated = progress.migrated
+        failed.extend(f"{progress.workspace}/{id}" for id in progress.failed)
+        click.echo(f"Migrated {migrated} contacts...")
+    click.echo(f"Done! {migrated} contacts migrated.")
+    if failed:
+        click.echo(f"Couldn't migrate (a required field is invalid): {', '.join(failed)}")
+
+
+@click.command(
+    help="Backs up the contacts to DIRECTORY. The first backup saves all of them, the next ones only save what changed since the previous backup. Can run while other commands are in use."
+)
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--full", is_flag=True, help="Saves all contacts again instead of only what changed.")
+@click.pass_obj
+def backup(model: Model, directory: str, full: bool) -> None:
+    try:
+        result = create_backup(model.database, directory, full=full)
+    except BackupError as e:
+        click.echo(e)
+        return
+    if result.snapshot:
+        click.echo(f"Saved all contacts to {result.snapshot}.")
+    elif result.segment:
+        click.echo(f"Saved {result.changes} changes to {result.segment}.")
+    else:
+        click.echo("Nothing changed since the last backup.")
+
+
+@click.command(help="Replaces all contacts with the backup in DIRECTORY.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.confirmation_option(prompt="All current contacts will be replaced by the backup. Continue?")
+@click.pass_obj
+def restore(model: Model, directory: str) -> None:
+    try:
+        seq = restore_backup(model.database, directory)
+    except BackupError as e:
+        click.echo(e)
+        return
+    click.echo(f"Restored the backup up to change {seq}.")
+
+
+@click.command(
+    name="convert-storage",
+    help="Rewrites the database file in FORMAT. Set `database.format` in the configuration to FORMAT as well, so it keeps being read and written in it.",
+)
+@click.argument("storage_format", metavar="FORMAT", type=click.Choice([*SERIALIZERS]))
+@click.pass_obj
+def convert_storage(model: Model, storage_format: str) -> None:
+    try:
+        size = model.database.convert_storage(storage_format)
+    except StorageFormatError as e:
+        click.echo(e)
+        return
+    click.echo(f"Database written in the {storage_format} format ({size} bytes).")
+
+
 cli.add_command(add)
 cli.add_command(list)
 cli.add_command(search)
 cli.add_command(list_formatters)
+cli.add_command(dedupe)
+cli.add_command(stats)
+cli.add_command(migrate)
+cli.add_command(backup)
+cli.add_command(restore)
+cli.add_command(convert_storage)
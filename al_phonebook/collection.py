@@ -0,0 +1,83 @@
+import sys
+from collections.abc import Sequence
+from typing import Any, Iterable, Iterator, Type
+
+from pydantic import BaseModel
+
+from .types import DictItem
+
+# Marks a field that wasn't present in the stored document. It's different from `None`
+# because a missing field must fall back to the schema default when the row is built.
+_MISSING = object()
+
+
+class ItemCollection(Sequence):
+    """A compact, list-like collection of contacts.
+
+    Rows are stored as plain tuples ordered by the fields of `schema` instead of
+    full pydantic objects. A pydantic instance is only built when a single row is accessed,
+    which keeps large results (e.g. `Model.all`) small in memory.
+    """
+
+    __slots__ = ("schema", "fields", "_rows")
+
+    def __init__(self, schema: Type[BaseModel], entries: Iterable[DictItem] = ()) -> None:
+        self.schema = schema
+        self.fields: tuple[str, ...] = tuple(schema.__fields__)
+        self._rows: list[tuple] = []
+        for entry in entries:
+            self.append(entry)
+
+    def append(self, entry: DictItem) -> None:
+        """Stores `entry` as a row. Keys that aren't part of the schema are dropped."""
+        self._rows.append(tuple(entry.get(field, _MISSING) for field in self.fields))
+
+    def row(self, index: int) -> DictItem:
+        """Returns the raw stored values of a row without validating it."""
+        return {
+            field: value
+            for field, value in zip(self.fields, self._rows[index])
+            if value is not _MISSING
+        }
+
+    def rows(self) -> Iterator[DictItem]:
+        for index in range(len(self._rows)):
+            yield self.row(index)
+
+    def memory_usage(self) -> int:
+        """Approximate size in bytes of the collection, including the stored values.
+        Values shared between rows (e.g. interned strings) are only counted once."""
+        seen: set[int] = set()
+        total = sys.getsizeof(self._rows)
+        for row in self._rows:
+            total += sys.getsizeof(row)
+            for value in row:
+                if value is _MISSING or id(value) in seen:
+                    continue
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+        return total
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            sliced = ItemCollection(self.schema)
+            sliced._rows = self._rows[index]
+            return sliced
+        if index < 0:
+            index += len(self._rows)
+        if not 0 <= index < len(self._rows):
+            raise IndexError("ItemCollection index out of range")
+        return self.schema(**self.row(index))
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f"ItemCollection({self.schema.__name__}, {len(self)} rows)"
@@ -17,10 +17,30 @@ from pydantic import (
 )
 
 from .types import OptionalDictItem, PathLike, DictItem
-from .lib import Item, TinyDBDatabase, Model
+from .lib import AbcDatabase, Item, TinyDBDatabase, Model
+from .budget import parse_size
 from .constants import CONSTANTS
+from .explain import SlowQueryLog
+from .federated import DEFAULT_TIMEOUT, FederatedDatabase, Source
+from .storages import DEFAULT_FORMAT, SERIALIZERS, is_compressed
 
 SUPPORTED_TYPES = {"integer": int, "string": str, "email": EmailStr, "float": float}
+# Name of the source of the database in `database_path` when other sources are configured
+LOCAL_SOURCE = "local"
+
+
+class SourceConfiguration(BaseModel):
+    path: Path
+    timeout: Optional[float]
+
+    @validator("path")
+    def is_valid_source_path(cls, v: Path) -> Path:
+        if not v.exists():
+            raise ConfigurationError(FileNotFoundError(f"Path {v} doesn't exist"))
+        return v
+
+    class Config:
+        extra = "forbid"
 
 
 class Configuration(BaseModel):
@@ -29,6 +49,16 @@ class Configuration(BaseModel):
         None, description="Path to the custom model to be used."
     )
     database_path: Optional[Path]
+    indexed_fields: Optional[list[str]]
+    completion_fields: Optional[list[str]]
+    identity_fields: Optional[list[str]]
+    bloom_error_rate: Optional[float]
+    phonetic_fields: Optional[list[str]]
+    slow_query_log: Optional[Path]
+    slow_query_threshold_ms: Optional[float]
+    storage_format: Optional[str]
+    sources: Optional[dict[str, SourceConfiguration]]
+    max_memory: Optional[int]
     plugins_folders: Optional[Sequence[Path]]
     formatters: Optional[list[str]]
 
@@ -54,8 +84,37 @@ class Configuration(BaseModel):
     def is_valid_db_path(cls, v):
         if not v:
             return True
-        if v.suffix != ".json":
-            raise ConfigurationError("Database path must be .json file.")
+        if v.suffix != ".json" and not is_compressed(v):
+            raise ConfigurationError(
+                "Database path must be .json file, or .json.gz to store it compressed."
+            )
+        return v
+
+    @validator("storage_format")
+    def is_valid_storage_format(cls, v: Optional[str]) -> Optional[str]:
+        if v is not None and v not in SERIALIZERS:
+            raise ConfigurationError(
+                f"Database format must be one of: {', '.join(SERIALIZERS)}."
+            )
+        return v
+
+    @validator("max_memory", pre=True)
+    def is_valid_max_memory(cls, v: Optional[Union[int, str]]) -> Optional[int]:
+        if v is None:
+            return None
+        try:
+            return parse_size(v)
+        except ValueError as e:
+            raise ConfigurationError(e)
+
+    @validator("sources")
+    def is_valid_sources(
+        cls, v: Optional[dict[str, SourceConfiguration]]
+    ) -> Optional[dict[str, SourceConfiguration]]:
+        if v and LOCAL_SOURCE in v:
+            raise ConfigurationError(
+                f"`{LOCAL_SOURCE}` is the name of the database in `database.path`, name the source differently."
+            )
         return v
 
     class Config:
@@ -79,6 +138,18 @@ def parse_configuration(path: PathLike) -> Configuration:
             database_path = config_dict.get("database", {}).get(
                 "path", configuration_folder() / ".alpb.json"
             )
+            indexed_fields = config_dict.get("database", {}).get("indexes")
+            completion_fields = config_dict.get("database", {}).get("completion")
+            identity_fields = config_dict.get("database", {}).get("identity")
+            bloom_error_rate = config_dict.get("database", {}).get("bloom_error_rate")
+            phonetic_fields = config_dict.get("database", {}).get("phonetic")
+            slow_queries = config_dict.get("database", {}).get("slow_queries", {})
+            storage_format = config_dict.get("database", {}).get("format")
+            max_memory = config_dict.get("database", {}).get("max_memory")
+            sources = {
+                name: source if isinstance(source, dict) else {"path": source}
+                for name, source in config_dict.get("database", {}).get("sources", {}).items()
+            }
             custom_model_path = (
                 config_dict.get("model", {}).get("custom_model", {}).get("path")
             )
@@ -90,6 +161,16 @@ def parse_configuration(path: PathLike) -> Configuration:
             config = Configuration(
                 custom_model_path=custom_model_path,
                 database_path=database_path,
+                indexed_fields=indexed_fields,
+                completion_fields=completion_fields,
+                identity_fields=identity_fields,
+                bloom_error_rate=bloom_error_rate,
+                phonetic_fields=phonetic_fields,
+                slow_query_log=slow_queries.get("path"),
+                slow_query_threshold_ms=slow_queries.get("threshold_ms"),
+                storage_format=storage_format,
+                sources=sources,
+                max_memory=max_memory,
                 custom_fields=custom_fields,
                 plugins_folders=plugins_folders,
                 formatters=formatters,
@@ -185,11 +266,50 @@ def create_item_model(config: Configuration) -> Type[Item]:
 def create_database_model(config: Configuration) -> Model:
     """
     Creates a Model using TinyDB as a database. `config` configures the database as needed.
+    If other `sources` are configured, they are searched together with it by a `FederatedDatabase`.
     """
     assert config.database_path
-    db = TinyDBDatabase(path=config.database_path)
+    db: AbcDatabase = create_tinydb_database(
+        config,
+        config.database_path,
+        slow_query_log=(
+            SlowQueryLog(config.slow_query_log, config.slow_query_threshold_ms or 500)
+            if config.slow_query_log
+            else None
+        ),
+    )
+    if config.sources:
+        db = FederatedDatabase(
+            [
+                Source(LOCAL_SOURCE, db),
+                *(
+                    Source(
+                        name,
+                        create_tinydb_database(config, source.path),
+                        source.timeout or DEFAULT_TIMEOUT,
+                    )
+                    for name, source in config.sources.items()
+                ),
+            ],
+            identity_fields=config.identity_fields or ("name", "email"),
+        )
     item_schema = create_item_model(config)
-    return Model(database=db, custom_item_schema=item_schema)
+    return Model(database=db, custom_item_schema=item_schema, max_memory=config.max_memory)
+
+
+def create_tinydb_database(
+    config: Configuration, path: Path, slow_query_log: Optional[SlowQueryLog] = None
+) -> TinyDBDatabase:
+    return TinyDBDatabase(
+        path=path,
+        indexed_fields=config.indexed_fields or (),
+        completion_fields=config.completion_fields or ("name",),
+        identity_fields=config.identity_fields or ("name", "email"),
+        bloom_error_rate=config.bloom_error_rate or 0.01,
+        phonetic_fields=config.phonetic_fields or ("name",),
+        slow_query_log=slow_query_log,
+        storage_format=config.storage_format or DEFAULT_FORMAT,
+    )
 
 
 class ConfigurationError(Exception):
@@ -3,3 +3,12 @@ from enum import Enum
 
 class CONSTANTS(str, Enum):
     CONFIG_FOLDER_NAME = ".al_phonebook"
+
+
+class FilterMode(str, Enum):
+    """How the values of a filter are compared with the entries."""
+
+    FULLTEXT = "fulltext"
+    EXACT = "exact"
+    PHONETIC = "phonetic"
+    REGEX = "regex"
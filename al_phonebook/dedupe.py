@@ -0,0 +1,134 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from difflib import SequenceMatcher
+from typing import Callable, Iterable, Mapping, NamedTuple, Optional, Sequence
+
+from .normalize import phone_digits, search_key, soundex
+from .types import DictItem
+
+# How much each matching field contributes to the score of a pair of contacts
+NAME_WEIGHT = 0.6
+EMAIL_WEIGHT = 0.5
+PHONE_WEIGHT = 0.4
+
+
+class Record(NamedTuple):
+    """The normalized fields of a contact used to find duplicates."""
+
+    workspace: str
+    id: int
+    name: str
+    email: str
+    phone: str
+
+
+@dataclass
+class MergeSuggestion:
+    """Two contacts that are probably the same person. `reasons` lists the fields that matched."""
+
+    workspace: str
+    id: int
+    duplicate_workspace: str
+    duplicate_id: int
+    score: float
+    reasons: list[str] = field(default_factory=list)
+
+    def dict(self) -> DictItem:
+        return asdict(self)
+
+
+def to_record(workspace: str, doc_id: int, entry: Mapping) -> Record:
+    return Record(
+        workspace,
+        doc_id,
+        " ".join(search_key(entry.get("name")).split()),
+        search_key(entry.get("email")),
+        phone_digits(entry.get("phone_number")),
+    )
+
+
+# Blocking keys: contacts are only compared with the contacts next to them when sorted by
+# each of these keys, instead of with every other contact.
+BLOCKING_KEYS: dict[str, Callable[[Record], str]] = {
+    "email": lambda r: r.email,
+    "phone": lambda r: r.phone,
+    "name": lambda r: soundex(r.name) + r.name,
+}
+
+
+def candidate_pairs(records: Sequence[Record], window: int) -> set[tuple[int, int]]:
+    """Sorted neighborhood method: for each blocking key, sorts the records by it and pairs each
+    record with the `window - 1` records after it. Records without a value for the key are skipped.
+    Returns pairs of positions in `records`."""
+    pairs: set[tuple[int, int]] = set()
+    for key in BLOCKING_KEYS.values():
+        keyed = sorted((key(r), i) for i, r in enumerate(records) if key(r))
+        for position, (_, i) in enumerate(keyed):
+            for _, j in keyed[position + 1 : position + window]:
+                pairs.add((min(i, j), max(i, j)))
+    return pairs
+
+
+def score(a: Record, b: Record) -> tuple[float, list[str]]:
+    """Scores how likely `a` and `b` are the same contact, between 0 and 1."""
+    total, reasons = 0.0, []
+    if a.email and a.email == b.email:
+        total += EMAIL_WEIGHT
+        reasons.append("email")
+    if a.phone and a.phone == b.phone:
+        total += PHONE_WEIGHT
+        reasons.append("phone_number")
+    if a.name and b.name:
+        similarity = SequenceMatcher(None, a.name, b.name).ratio()
+        if soundex(a.name) == soundex(b.name):
+            similarity = max(similarity, 0.8)
+        total += NAME_WEIGHT * similarity
+        if similarity >= 0.8:
+            reasons.append("name")
+    return min(total, 1.0), reasons
+
+
+def score_pairs(
+    pairs: Iterable[tuple[Record, Record]], threshold: float
+) -> list[MergeSuggestion]:
+    suggestions = []
+    for a, b in pairs:
+        value, reasons = score(a, b)
+        if value >= threshold:
+            suggestions.append(
+                MergeSuggestion(a.workspace, a.id, b.workspace, b.id, round(value, 3), reasons)
+            )
+    return suggestions
+
+
+def find_duplicates(
+    entries: Mapping[str, Iterable[Mapping]],
+    id_field_name: str,
+    window: int = 5,
+    threshold: float = 0.6,
+    workers: Optional[int] = 1,
+) -> list[MergeSuggestion]:
+    """Finds probable duplicates among `entries`, grouped by workspace, in O(n * window)
+    comparisons. Candidate pairs are scored in `workers` processes (all CPUs if `None`)."""
+    records = [
+        to_record(workspace, entry.get(id_field_name, getattr(entry, id_field_name, 0)), entry)
+        for workspace, workspace_entries in sorted(entries.items())
+        for entry in workspace_entries
+    ]
+    pairs = [(records[i], records[j]) for i, j in sorted(candidate_pairs(records, window))]
+
+    workers = workers or os.cpu_count() or 1
+    # Starting processes isn't worth it for a handful of pairs
+    if workers == 1 or len(pairs) < 1000:
+        suggestions = score_pairs(pairs, threshold)
+    else:
+        chunk = -(-len(pairs) // workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(score_pairs, pairs[start : start + chunk], threshold)
+                for start in range(0, len(pairs), chunk)
+            ]
+            suggestions = [s for future in futures for s in future.result()]
+
+    return sorted(suggestions, key=lambda s: -s.score)
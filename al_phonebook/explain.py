@@ -0,0 +1,72 @@
+import json
+import logging
+from dataclasses import asdict, dataclass, field
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Any, Optional
+
+from .types import DictItem, PathLike
+
+FULL_SCAN = "full scan"
+
+
+@dataclass
+class PlanStep:
+    """How a single filter is answered. `access` is `FULL_SCAN` or the kind of index used,
+    e.g. `sorted index`. `rows` is how many entries the index returned."""
+
+    field: str
+    condition: Any
+    access: str
+    rows: Optional[int] = None
+
+
+@dataclass
+class QueryPlan:
+    """How a filter was executed. `access_path` is `FULL_SCAN` if any entry had to be checked,
+    or `index` if the indexes narrowed the entries down first.
+
+    `estimated_rows` is how many entries the plan expects to check, `rows_scanned` how many
+    were actually checked and `rows_returned` how many matched. `timings` has the seconds
+    spent planning (including building indexes) and searching."""
+
+    workspace: str
+    access_path: str
+    steps: list[PlanStep] = field(default_factory=list)
+    estimated_rows: int = 0
+    rows_scanned: int = 0
+    rows_returned: int = 0
+    timings: dict[str, float] = field(default_factory=dict)
+
+    def dict(self) -> DictItem:
+        return asdict(self)
+
+
+class SlowQueryLog:
+    """Logs filters slower than `threshold_ms` milliseconds, with their `QueryPlan`, as json
+    lines to `path`. The file is rotated when it reaches `max_bytes`, keeping `backups` old files."""
+
+    def __init__(
+        self,
+        path: PathLike,
+        threshold_ms: float = 500,
+        max_bytes: int = 1 << 20,
+        backups: int = 3,
+    ) -> None:
+        self.path = Path(path)
+        self.threshold = threshold_ms / 1000
+        self.logger = logging.getLogger(f"al_phonebook.slow_queries.{self.path}")
+        self.logger.setLevel(logging.INFO)
+        # Slow queries only go to their own file
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(self.path, maxBytes=max_bytes, backupCount=backups)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.logger.addHandler(handler)
+
+    def is_slow(self, seconds: float) -> bool:
+        return seconds >= self.threshold
+
+    def record(self, filters: DictItem, seconds: float, plan: QueryPlan) -> None:
+        entry = {"filters": filters, "seconds": seconds, "plan": plan.dict()}
+        self.logger.info(json.dumps(entry, default=str))
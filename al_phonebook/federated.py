@@ -0,0 +1,233 @@
+import copy
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional, Sequence, TypeVar
+from warnings import warn
+
+from .lib import AbcDatabase, Item
+from .metrics import METRICS, instrument
+from .migration import MigrationProgress, SchemaMigration
+from .normalize import search_key
+from .types import DictItem, OptionalDictItem
+
+# Seconds a source has to answer before its results are left out
+DEFAULT_TIMEOUT = 5.0
+# Key listing the names of the sources an entry was found in
+SOURCES_KEY = "sources"
+
+T = TypeVar("T")
+
+
+class FederationError(Exception):
+    pass
+
+
+class SourceBusyError(FederationError):
+    def __init__(self, name: str) -> None:
+        super().__init__(f"Source {name} is still answering a previous query.")
+
+
+@dataclass
+class Source:
+    """A database queried by a `FederatedDatabase`. `name` tags the entries found in it."""
+
+    name: str
+    database: AbcDatabase
+    timeout: float = DEFAULT_TIMEOUT
+
+
+@instrument("federated")
+class FederatedDatabase(AbcDatabase):
+    """Searches several databases as one, e.g. the phonebooks of different teams.
+
+    `filter`, `get` and `all` query every source in parallel threads. Sources that fail or
+    don't answer within their `timeout` are left out with a warning, so one slow network drive
+    doesn't block the others. Entries found in several sources (same `identity_fields`) are
+    merged into the first one, in the order of `sources`, and every entry lists the sources it
+    was found in under `sources`. Entries of the same source are never merged, they are
+    different contacts even with the same identity.
+
+    Writes only go to the first source, the primary one. A source still answering a query
+    that timed out isn't queried again until it's done, its entries are left out meanwhile.
+    """
+
+    out_fields = {SOURCES_KEY: (list[str], [])}
+
+    def __init__(
+        self, sources: Sequence[Source], identity_fields: Sequence[str] = ("name", "email")
+    ) -> None:
+        if not sources:
+            raise FederationError("At least one source is needed.")
+        names = [source.name for source in sources]
+        if len(set(names)) != len(names):
+            raise FederationError(f"Source names must be unique: {', '.join(names)}.")
+        self.sources = tuple(sources)
+        self.primary = self.sources[0].database
+        self.identity_fields = tuple(identity_fields)
+        # A database isn't safe to use from several threads, a source that timed out may still
+        # be answering when it's queried again. Held while a source is answering.
+        self._locks = {source.name: threading.Lock() for source in self.sources}
+        super().__init__(feed=self.primary.feed)
+
+    @property
+    def migration(self) -> Optional[SchemaMigration]:
+        return self.primary.migration
+
+    @migration.setter
+    def migration(self, migration: Optional[SchemaMigration]) -> None:
+        for source in self.sources:
+            source.database.migration = migration
+
+    @property
+    def id_field_name(self) -> str:
+        return self.primary.id_field_name
+
+    def all(self) -> dict[str, list[DictItem]]:
+        workspaces: dict[str, list[tuple[str, DictItem]]] = {}
+        for source, tables in self._fan_out(lambda database: database.all()):
+            for workspace, entries in tables.items():
+                workspaces.setdefault(workspace, []).extend((source.name, e) for e in entries)
+        return {workspace: self._merge(entries) for workspace, entries in workspaces.items()}
+
+    def get(
+        self, id: int, workspace: Optional[str] = None, source: Optional[str] = None
+    ) -> OptionalDictItem:
+        """Returns the entry `id` of `source`. Ids are only unique within a source, without
+        `source` the entry of the first source having one with this id is returned."""
+        sources = [s for s in self.sources if source is None or s.name == source]
+        found = self._fan_out(lambda database: database.get(id, workspace), sources)
+        entries = [(s.name, entry) for s, entry in found if entry is not None]
+        return self._merge(entries[:1])[0] if entries else None
+
+    def add_item(self, item: Item, workspace: Optional[str] = None) -> int:
+        return self.primary.add_item(item, workspace=workspace)
+
+    def add_items(self, items: Sequence[Item], workspace: Optional[str] = None) -> Sequence[int]:
+        return self.primary.add_items(items, workspace=workspace)
+
+    def filter(self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any) -> Sequence[DictItem]:
+        found = self._fan_out(
+            lambda database: database.filter(filters, workspace=workspace, **kwargs)
+        )
+        return self._merge([(source.name, entry) for source, entries in found for entry in entries])
+
+    def update(
+        self, id: int, update: DictItem, workspace: Optional[str] = None, source: Optional[str] = None
+    ) -> Optional[int]:
+        """Updates the entry `id` of `source`, the first one in its `sources`. Ids are only
+        unique within a source and only entries of the primary source can be updated.
+
+        :raises FederationError: If `source` isn't the primary source."""
+        primary = self.sources[0].name
+        if source is not None and source != primary:
+            raise FederationError(
+                f"Only contacts of {primary} can be updated, this one is from {source}."
+            )
+        return self.primary.update(id, update, workspace=workspace)
+
+    def update_where(
+        self, filters: DictItem, update: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Sequence[int]:
+        return self.primary.update_where(filters, update, workspace=workspace, **kwargs)
+
+    def delete_where(
+        self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Sequence[int]:
+        return self.primary.delete_where(filters, workspace=workspace, **kwargs)
+
+    def compact(self) -> int:
+        return self.primary.compact()
+
+    def migrate(self, batch_size: int = 500) -> Iterator[MigrationProgress]:
+        return self.primary.migrate(batch_size=batch_size)
+
+    def stored_size(self) -> Optional[int]:
+        sizes = [source.database.stored_size() for source in self.sources]
+        known = [size for size in sizes if size is not None]
+        return sum(known) if known else None
+
+    def _fan_out(
+        self, call: Callable[[AbcDatabase], T], sources: Optional[Sequence[Source]] = None
+    ) -> list[tuple[Source, T]]:
+        """Runs `call` on the database of every source in parallel. Returns the results of the
+        sources that answered in time, in the order of `sources`."""
+        start = time.monotonic()
+        futures = [
+            (source, self._submit(source, call))
+            for source in (self.sources if sources is None else sources)
+        ]
+        results = []
+        for source, future in futures:
+            # Every source started at the same time, so the time spent waiting for the previous
+            # ones counts towards the timeout of the next ones
+            remaining = max(source.timeout - (time.monotonic() - start), 0)
+            try:
+                results.append((source, future.result(timeout=remaining)))
+            except FutureTimeoutError:
+                future.cancel()
+                METRICS.increment("source_timeouts")
+                warn(f"Source {source.name} didn't answer within {source.timeout}s, its entries are left out.")
+            except SourceBusyError as e:
+                METRICS.increment("source_busy")
+                warn(f"{e} Its entries are left out.")
+            except Exception as e:
+                warn(f"Source {source.name} failed, its entries are left out: {e}")
+        return results
+
+    def _submit(self, source: Source, call: Callable[[AbcDatabase], T]) -> "Future[T]":
+        """Runs `_call` in a thread of its own. The thread is a daemon, so a source that timed
+        out doesn't keep the process running once the command is done."""
+        future: "Future[T]" = Future()
+
+        def run() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self._call(source, call))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(
+            target=run, name=f"al_phonebook-federated-{source.name}", daemon=True
+        ).start()
+        return future
+
+    def _call(self, source: Source, call: Callable[[AbcDatabase], T]) -> T:
+        """Runs `call` on the database of `source`, unless it's still answering a previous
+        call, e.g. one that timed out. Waiting for it would hold a worker thread as well.
+
+        :raises SourceBusyError: If `source` is still answering a previous call."""
+        lock = self._locks[source.name]
+        if not lock.acquire(blocking=False):
+            raise SourceBusyError(source.name)
+        try:
+            return call(source.database)
+        finally:
+            lock.release()
+
+    def _merge(self, entries: Sequence[tuple[str, DictItem]]) -> list[DictItem]:
+        """Tags `entries`, (source name, entry) pairs, with their source and merges the ones
+        of different sources with the same identity. Missing fields of the first entry are
+        filled by the others."""
+        merged: list[DictItem] = []
+        by_identity: dict[tuple, list[DictItem]] = {}
+        for name, entry in entries:
+            identity = tuple(search_key(entry.get(field)) for field in self.identity_fields)
+            same = by_identity.setdefault(identity, []) if any(identity) else []
+            # The first entry with this identity not found in this source yet
+            kept = next((e for e in same if name not in e[SOURCES_KEY]), None)
+            if kept is None:
+                # A copy keeps the type of the entry, e.g. a TinyDB `Document` and its id
+                tagged = copy.copy(entry)
+                tagged[SOURCES_KEY] = [name]
+                merged.append(tagged)
+                same.append(tagged)
+                continue
+            kept[SOURCES_KEY].append(name)
+            for field, value in entry.items():
+                if kept.get(field) is None:
+                    kept[field] = value
+        return merged
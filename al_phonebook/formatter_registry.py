@@ -2,12 +2,14 @@ import importlib
 import inspect
 import sys
 from pathlib import Path
-from typing import Sequence
+from typing import Any, Optional, Sequence
 from warnings import warn
 
 from .config import Configuration
+from .metrics import instrument
 
 
+@instrument("formatter")
 class FormatterRegistry:
     """
     FormatterRegistry is a simplistic plugin system that can be used to format DictItem
@@ -63,6 +65,13 @@ class FormatterRegistry:
                     )
                     continue
 
+    def format(self, name: str, data: Any) -> Optional[Any]:
+        """Formats `data` with the formatter `name`. Returns `None` if there's no such formatter."""
+        formatter = self.formatters.get(name)
+        if formatter is None:
+            return None
+        return formatter.format(data)
+
     @staticmethod
     def from_configuration(configuration: Configuration) -> "FormatterRegistry":
         """Initializes a `FormatterRegistry` based on a `Configuration` instance.
@@ -0,0 +1,606 @@
+import base64
+import hashlib
+import math
+import re
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
+
+from .normalize import phone_digits, phonetic_codes, search_key
+from .patterns import compile_pattern
+from .types import DictItem
+
+RANGE_OPERATORS = ("gt", "ge", "lt", "le", "between")
+OPERATORS = RANGE_OPERATORS + ("prefix", "phonetic", "regex")
+
+
+class FilterError(Exception):
+    def __init__(self, field: str, message: str) -> None:
+        super().__init__(f"Invalid filter for field `{field}`. {message}")
+
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _groups(keys: Sequence[Any], doc_ids: Sequence[int], descending: bool) -> Iterator[list[int]]:
+    """Yields the ids of `doc_ids` with equal `keys` together, in the order of the keys."""
+    pairs = zip(reversed(keys), reversed(doc_ids)) if descending else zip(keys, doc_ids)
+    for _, group in groupby(pairs, key=itemgetter(0)):
+        yield [doc_id for _, doc_id in group]
+
+
+@dataclass(frozen=True)
+class Range:
+    """An interval of values. `None` bounds are unbounded."""
+
+    low: Optional[float] = None
+    high: Optional[float] = None
+    include_low: bool = False
+    include_high: bool = False
+
+    @staticmethod
+    def from_condition(field: str, condition: DictItem) -> "Range":
+        """Builds a `Range` from a filter condition such as `{"gt": 30, "le": 50}`
+        or `{"between": (30, 50)}`. `between` includes both ends. If several operators bound
+        the same end, e.g. `{"gt": 30, "ge": 40}`, the tightest one is kept.
+
+        :raises FilterError: If an operator is unknown or its value isn't a number.
+        """
+        # (value, inclusive) of every bound given
+        lows: list[tuple[float, bool]] = []
+        highs: list[tuple[float, bool]] = []
+        for operator, value in condition.items():
+            if operator not in RANGE_OPERATORS:
+                raise FilterError(
+                    field,
+                    f"Unknown operator `{operator}`. Supported operators are: {', '.join(OPERATORS)}.",
+                )
+            if operator == "between":
+                try:
+                    low, high = value
+                except (TypeError, ValueError):
+                    raise FilterError(field, "`between` expects a pair of values.")
+                lows.append((low, True))
+                highs.append((high, True))
+            elif operator in ("gt", "ge"):
+                lows.append((value, operator == "ge"))
+            else:
+                highs.append((value, operator == "le"))
+
+        for value, _ in lows + highs:
+            if not is_number(value):
+                raise FilterError(field, f"Range bounds must be numbers, got {value!r}.")
+
+        # The largest low and the smallest high, exclusive bounds are tighter on ties
+        low, include_low = max(lows, key=lambda bound: (bound[0], not bound[1]), default=(None, False))
+        high, include_high = min(highs, key=lambda bound: (bound[0], bound[1]), default=(None, False))
+        return Range(low, high, include_low, include_high)
+
+    def __contains__(self, value: Any) -> bool:
+        if not is_number(value):
+            return False
+        if self.low is not None:
+            if value < self.low or (value == self.low and not self.include_low):
+                return False
+        if self.high is not None:
+            if value > self.high or (value == self.high and not self.include_high):
+                return False
+        return True
+
+
+@dataclass(frozen=True)
+class Prefix:
+    """Matches values starting with `value`."""
+
+    value: str
+
+
+@dataclass(frozen=True)
+class Phonetic:
+    """Matches values containing words that sound like every word of `value`."""
+
+    value: str
+
+    @property
+    def codes(self) -> frozenset[str]:
+        return phonetic_codes(self.value)
+
+    def __contains__(self, value: Any) -> bool:
+        codes = self.codes
+        return bool(codes) and codes <= phonetic_codes(value)
+
+
+class Regex:
+    """Matches string values where the regular expression `pattern` is found.
+
+    Values that don't contain the literal substrings every match requires are rejected
+    with a cheap `in` check before running the regular expression."""
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        self.compiled, self.literals = compile_pattern(pattern)
+
+    def __contains__(self, value: Any) -> bool:
+        if not isinstance(value, str):
+            return False
+        if not all(literal in value for literal in self.literals):
+            return False
+        return self.compiled.search(value) is not None
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Regex) and other.pattern == self.pattern
+
+    def __hash__(self) -> int:
+        return hash(("regex", self.pattern))
+
+
+def parse_condition(field: str, condition: DictItem) -> Range | Prefix | Phonetic | Regex:
+    """Parses a filter condition, e.g. `{"gt": 30}`, `{"prefix": "+44 20"}`,
+    `{"phonetic": "Clarice"}` or `{"regex": "^[a-z]+@al\\.com$"}`.
+
+    :raises FilterError: If the condition is invalid.
+    """
+    for operator, kind in (("prefix", Prefix), ("phonetic", Phonetic), ("regex", Regex)):
+        if operator in condition:
+            if len(condition) > 1:
+                raise FilterError(field, f"`{operator}` can't be combined with other operators.")
+            try:
+                return kind(str(condition[operator]))
+            except re.error as e:
+                raise FilterError(field, f"Invalid regular expression: {e}.")
+    return Range.from_condition(field, condition)
+
+
+class AbcIndex(ABC):
+    """A secondary index over a single field of a single table."""
+
+    kind: str = ""
+
+    def __init__(self, field: str) -> None:
+        self.field = field
+
+    @abstractmethod
+    def add(self, doc_id: int, document: DictItem) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def remove(self, doc_id: int, document: DictItem) -> None:
+        raise NotImplementedError()
+
+    def build(self, documents: Iterable[tuple[int, DictItem]]) -> None:
+        """Adds every (doc_id, document) pair of `documents` at once. Indexes kept sorted
+        override it to sort once, `add` is meant for a few documents at a time."""
+        for doc_id, document in documents:
+            self.add(doc_id, document)
+
+    @abstractmethod
+    def dump(self) -> DictItem:
+        """Returns the state of the index as JSON serializable data."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def load(self, data: DictItem) -> None:
+        """Restores the state of the index from the output of `dump`."""
+        raise NotImplementedError()
+
+
+class SortedIndex(AbcIndex):
+    """Keeps the numeric values of `field` sorted, together with their document ids,
+    so range queries cost O(log n + k) using `bisect`. Non numeric values aren't indexed."""
+
+    kind = "sorted"
+
+    def __init__(self, field: str) -> None:
+        super().__init__(field)
+        self.keys: list[float] = []
+        self.doc_ids: list[int] = []
+
+    def add(self, doc_id: int, document: DictItem) -> None:
+        value: Any = document.get(self.field)
+        if not is_number(value):
+            return
+        position = bisect_right(self.keys, value)
+        self.keys.insert(position, value)
+        self.doc_ids.insert(position, doc_id)
+
+    def build(self, documents: Iterable[tuple[int, DictItem]]) -> None:
+        pairs = [*zip(self.keys, self.doc_ids)]
+        for doc_id, document in documents:
+            value: Any = document.get(self.field)
+            if is_number(value):
+                pairs.append((value, doc_id))
+        # Sorting on the value only keeps equal values in the order they were added, like `add`
+        pairs.sort(key=itemgetter(0))
+        self.keys = [value for value, _ in pairs]
+        self.doc_ids = [doc_id for _, doc_id in pairs]
+
+    def remove(self, doc_id: int, document: DictItem) -> None:
+        value: Any = document.get(self.field)
+        if not is_number(value):
+            return
+        start, end = bisect_left(self.keys, value), bisect_right(self.keys, value)
+        for position in range(start, end):
+            if self.doc_ids[position] == doc_id:
+                del self.keys[position]
+                del self.doc_ids[position]
+                return
+
+    def range(self, interval: Range) -> Sequence[int]:
+        """Returns the ids of the documents whose value is inside `interval`."""
+        start, end = 0, len(self.keys)
+        if interval.low is not None:
+            bisect = bisect_left if interval.include_low else bisect_right
+            start = bisect(self.keys, interval.low)
+        if interval.high is not None:
+            bisect = bisect_right if interval.include_high else bisect_left
+            end = bisect(self.keys, interval.high)
+        return self.doc_ids[start:end]
+
+    def ordered(self, descending: bool = False) -> Iterator[list[int]]:
+        """Yields the ids of the indexed documents ordered by their value, those with equal
+        values together."""
+        return _groups(self.keys, self.doc_ids, descending)
+
+    def dump(self) -> DictItem:
+        return {"keys": self.keys, "doc_ids": self.doc_ids}
+
+    def load(self, data: DictItem) -> None:
+        self.keys = list(data["keys"])
+        self.doc_ids = list(data["doc_ids"])
+
+
+class _TrieNode:
+    __slots__ = ("children", "doc_ids")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _TrieNode] = {}
+        self.doc_ids: set[int] = set()
+
+
+class DigitTrie(AbcIndex):
+    """Indexes phone numbers digit by digit, so the documents whose number starts with
+    a given prefix are found in time proportional to the prefix length plus the number
+    of results. Numbers are normalized with `phone_digits` first."""
+
+    kind = "trie"
+
+    def __init__(self, field: str) -> None:
+        super().__init__(field)
+        self.root = _TrieNode()
+
+    def add(self, doc_id: int, document: DictItem) -> None:
+        digits = phone_digits(document.get(self.field))
+        if not digits:
+            return
+        node = self.root
+        for digit in digits:
+            node = node.children.setdefault(digit, _TrieNode())
+        node.doc_ids.add(doc_id)
+
+    def remove(self, doc_id: int, document: DictItem) -> None:
+        digits = phone_digits(document.get(self.field))
+        if not digits:
+            return
+        path = [self.root]
+        for digit in digits:
+            child = path[-1].children.get(digit)
+            if child is None:
+                return
+            path.append(child)
+        path[-1].doc_ids.discard(doc_id)
+        # Prune the branches that don't lead to any document anymore
+        for digit, parent, node in zip(reversed(digits), reversed(path[:-1]), reversed(path[1:])):
+            if node.doc_ids or node.children:
+                break
+            del parent.children[digit]
+
+    def prefix(self, digits: str) -> Sequence[int]:
+        """Returns the ids of the documents whose number starts with `digits`."""
+        node = self.root
+        for digit in digits:
+            child = node.children.get(digit)
+            if child is None:
+                return []
+            node = child
+        doc_ids: list[int] = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            doc_ids.extend(node.doc_ids)
+            stack.extend(node.children.values())
+        return doc_ids
+
+    def dump(self) -> DictItem:
+        numbers: dict[str, list[int]] = {}
+        stack = [("", self.root)]
+        while stack:
+            digits, node = stack.pop()
+            if node.doc_ids:
+                numbers[digits] = sorted(node.doc_ids)
+            stack.extend((digits + d, child) for d, child in node.children.items())
+        return {"numbers": numbers}
+
+    def load(self, data: DictItem) -> None:
+        self.root = _TrieNode()
+        for digits, doc_ids in data["numbers"].items():
+            for doc_id in doc_ids:
+                self.add(doc_id, {self.field: digits})
+
+
+class PrefixIndex(AbcIndex):
+    """Keeps the `search_key` of the string values of `field` in a sorted array, so values starting
+    with a prefix are found with `bisect` in O(log n + k). Used for autocompletion and
+    `prefix` filters on string fields."""
+
+    kind = "prefix"
+
+    def __init__(self, field: str) -> None:
+        super().__init__(field)
+        self.keys: list[str] = []
+        self.values: list[str] = []
+        self.doc_ids: list[int] = []
+
+    def add(self, doc_id: int, document: DictItem) -> None:
+        value = document.get(self.field)
+        if not isinstance(value, str) or not value:
+            return
+        key = search_key(value)
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.values.insert(position, value)
+        self.doc_ids.insert(position, doc_id)
+
+    def build(self, documents: Iterable[tuple[int, DictItem]]) -> None:
+        entries = [*zip(self.keys, self.values, self.doc_ids)]
+        for doc_id, document in documents:
+            value = document.get(self.field)
+            if isinstance(value, str) and value:
+                entries.append((search_key(value), value, doc_id))
+        # Sorting on the key only keeps equal keys in the order they were added, like `add`
+        entries.sort(key=itemgetter(0))
+        self.keys = [key for key, _, _ in entries]
+        self.values = [value for _, value, _ in entries]
+        self.doc_ids = [doc_id for _, _, doc_id in entries]
+
+    def remove(self, doc_id: int, document: DictItem) -> None:
+        value = document.get(self.field)
+        if not isinstance(value, str) or not value:
+            return
+        key = search_key(value)
+        start, end = bisect_left(self.keys, key), bisect_right(self.keys, key)
+        for position in range(start, end):
+            if self.doc_ids[position] == doc_id:
+                del self.keys[position]
+                del self.values[position]
+                del self.doc_ids[position]
+                return
+
+    def _matches(self, prefix: str) -> Iterator[int]:
+        """Yields the positions of the keys starting with `prefix`, in order."""
+        prefix = search_key(prefix)
+        position = bisect_left(self.keys, prefix)
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            yield position
+            position += 1
+
+    def ordered(self, descending: bool = False) -> Iterator[list[int]]:
+        """Yields the ids of the indexed documents ordered by their `search_key`, those with
+        equal keys together."""
+        return _groups(self.keys, self.doc_ids, descending)
+
+    def prefix(self, prefix: str) -> Sequence[int]:
+        """Returns the ids of the documents whose value starts with `prefix`, ignoring case."""
+        return [self.doc_ids[position] for position in self._matches(prefix)]
+
+    def complete(self, prefix: str, limit: int) -> Sequence[str]:
+        """Returns up to `limit` distinct values starting with `prefix`, ignoring case."""
+        suggestions: dict[str, None] = {}
+        for position in self._matches(prefix):
+            if len(suggestions) >= limit:
+                break
+            suggestions[self.values[position]] = None
+        return list(suggestions)
+
+    def dump(self) -> DictItem:
+        return {"values": self.values, "doc_ids": self.doc_ids}
+
+    def load(self, data: DictItem) -> None:
+        self.values = list(data["values"])
+        self.doc_ids = list(data["doc_ids"])
+        self.keys = [search_key(value) for value in self.values]
+
+
+class _BloomStage:
+    __slots__ = ("capacity", "count", "size", "hashes", "bits")
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = capacity
+        self.count = 0
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: str) -> Iterator[int]:
+        # Enhanced double hashing: k positions from the two halves of a single digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        for i in range(self.hashes):
+            yield h1 % self.size
+            h1 += h2
+            h2 += i
+
+    def add(self, key: str) -> None:
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+class BloomFilter(AbcIndex):
+    """Answers "is there a document whose `field` is exactly this value?" with either
+    "definitely not" or "maybe", without looking at the documents.
+
+    The filter grows by adding stages with twice the capacity and half the error rate of
+    the previous one, so the overall false positive rate stays below `error_rate` no matter
+    how many documents are added. Values can't be removed: after an update the old value
+    may still answer "maybe", which only costs a regular search."""
+
+    kind = "bloom"
+
+    def __init__(
+        self,
+        field: str,
+        error_rate: float = 0.01,
+        capacity: int = 1024,
+        key: Callable[[Any], str] = str,
+    ) -> None:
+        super().__init__(field)
+        self.error_rate = error_rate
+        self.key = key
+        self.stages = [_BloomStage(max(capacity, 1), error_rate / 2)]
+
+    def add(self, doc_id: int, document: DictItem) -> None:
+        value = document.get(self.field)
+        if value is None:
+            return
+        stage = self.stages[-1]
+        if stage.count >= stage.capacity:
+            stage = _BloomStage(stage.capacity * 2, self.error_rate / 2 ** (len(self.stages) + 1))
+            self.stages.append(stage)
+        stage.add(self.key(value))
+
+    def remove(self, doc_id: int, document: DictItem) -> None:
+        pass
+
+    def __contains__(self, value: Any) -> bool:
+        key = self.key(value)
+        return any(key in stage for stage in self.stages)
+
+    def dump(self) -> DictItem:
+        return {
+            "error_rate": self.error_rate,
+            "stages": [
+                {
+                    "capacity": stage.capacity,
+                    "count": stage.count,
+                    "size": stage.size,
+                    "hashes": stage.hashes,
+                    "bits": base64.b64encode(stage.bits).decode(),
+                }
+                for stage in self.stages
+            ],
+        }
+
+    def load(self, data: DictItem) -> None:
+        self.error_rate = data["error_rate"]
+        self.stages = []
+        for stored in data["stages"]:
+            stage = _BloomStage.__new__(_BloomStage)
+            stage.capacity, stage.count = stored["capacity"], stored["count"]
+            stage.size, stage.hashes = stored["size"], stored["hashes"]
+            stage.bits = bytearray(base64.b64decode(stored["bits"]))
+            self.stages.append(stage)
+
+
+class PhoneticIndex(AbcIndex):
+    """Maps the Soundex code of every word of `field` to the documents containing it, so
+    phonetic searches are a hash lookup per word of the query instead of encoding every
+    stored value."""
+
+    kind = "phonetic"
+
+    def __init__(self, field: str) -> None:
+        super().__init__(field)
+        self.codes: dict[str, set[int]] = {}
+
+    def add(self, doc_id: int, document: DictItem) -> None:
+        for code in phonetic_codes(document.get(self.field)):
+            self.codes.setdefault(code, set()).add(doc_id)
+
+    def remove(self, doc_id: int, document: DictItem) -> None:
+        for code in phonetic_codes(document.get(self.field)):
+            doc_ids = self.codes.get(code)
+            if doc_ids is not None:
+                doc_ids.discard(doc_id)
+                if not doc_ids:
+                    del self.codes[code]
+
+    def search(self, condition: Phonetic) -> Sequence[int]:
+        """Returns the ids of the documents with words sounding like every word of the condition."""
+        codes = condition.codes
+        if not codes:
+            return []
+        matches = set.intersection(*(self.codes.get(code, set()) for code in codes))
+        return sorted(matches)
+
+    def dump(self) -> DictItem:
+        return {"codes": {code: sorted(doc_ids) for code, doc_ids in self.codes.items()}}
+
+    def load(self, data: DictItem) -> None:
+        self.codes = {code: set(doc_ids) for code, doc_ids in data["codes"].items()}
+
+
+class IndexSet:
+    """All the indexes of a single table. With `restore`, the state of every index is only
+    restored by it the first time the index is needed, so using one index doesn't read the
+    others."""
+
+    def __init__(
+        self, indexes: Iterable[AbcIndex], restore: Optional[Callable[[AbcIndex], None]] = None
+    ) -> None:
+        self.indexes = list(indexes)
+        self._restore = restore
+        # Indexes whose state wasn't restored yet
+        self._pending = list(self.indexes) if restore is not None else []
+
+    def find(self, kind: str, field: str) -> Optional[AbcIndex]:
+        for index in self.indexes:
+            if index.kind == kind and index.field == field:
+                self._restored([index])
+                return index
+        return None
+
+    def restore(self) -> None:
+        """Restores every index not restored yet, e.g. before they are all updated."""
+        self._restored(self.indexes)
+
+    def add(self, doc_id: int, document: DictItem) -> None:
+        self.restore()
+        for index in self.indexes:
+            index.add(doc_id, document)
+
+    def build(self, documents: Sequence[tuple[int, DictItem]]) -> None:
+        """Adds every (doc_id, document) pair of `documents` to every index at once."""
+        self.restore()
+        for index in self.indexes:
+            index.build(documents)
+
+    def remove(self, doc_id: int, document: DictItem) -> None:
+        self.restore()
+        for index in self.indexes:
+            index.remove(doc_id, document)
+
+    def spec(self) -> list[list[str]]:
+        """The kind and field of every index, used to check if stored indexes still match."""
+        return sorted([index.kind, index.field] for index in self.indexes)
+
+    def dump(self) -> list[DictItem]:
+        """Returns the state of the restored indexes, the others didn't change."""
+        return [
+            {"kind": index.kind, "field": index.field, "data": index.dump()}
+            for index in self.indexes
+            if index not in self._pending
+        ]
+
+    def _restored(self, indexes: Iterable[AbcIndex]) -> None:
+        for index in indexes:
+            if index in self._pending:
+                self._pending.remove(index)
+                assert self._restore is not None
+                self._restore(index)
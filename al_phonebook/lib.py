@@ -1,18 +1,40 @@
 import inspect
+import math
 import os
+import time
 from abc import ABC, abstractmethod, abstractproperty
 from collections import defaultdict
-from functools import reduce
+from itertools import groupby
 from pathlib import Path
-from typing import Any, Optional, Sequence, Type
+from typing import (Any, Callable, Iterable, Iterator, Mapping, Optional,
+                    Sequence, Type, Union)
 
 from pydantic import (BaseModel, EmailStr, PositiveInt, 
                       constr, create_model)
 from tinydb import TinyDB, where
 from tinydb.queries import QueryInstance
 from tinydb.storages import MemoryStorage
+from tinydb.table import Document, Table
 
-from .constants import CONSTANTS
+from .aggregate import Aggregation, AggregationError
+from .budget import exceeds, run_size
+from .changes import ADD, DELETE, UPDATE, ChangeEvent, ChangeFeed, Subscriber
+from .collection import ItemCollection
+from .constants import CONSTANTS, FilterMode
+from .dedupe import MergeSuggestion, find_duplicates
+from .explain import FULL_SCAN, PlanStep, QueryPlan, SlowQueryLog
+from .indexes import (AbcIndex, BloomFilter, DigitTrie, FilterError,
+                      IndexSet, Phonetic, PhoneticIndex, PrefixIndex, Range,
+                      Regex, SortedIndex, parse_condition)
+from .metrics import METRICS, MetricsMiddleware, instrument
+from .migration import (MigrationCheckpoint, MigrationError,
+                        MigrationProgress, SchemaMigration)
+from .normalize import (DELETED_KEY, DIGITS_KEY, FOLDED_KEY, RESERVED_PREFIX,
+                        SCHEMA_KEY, phone_digits, search_key)
+from .sidecar import IndexStore, file_stamp
+from .sorting import RUN_SIZE, Order, parse_order, sort_entries, sort_in_memory
+from .storages import (DEFAULT_FORMAT, StorageFormatError, convert_storage,
+                       storage_class, stored_size)
 from .types import DictItem, OptionalDictItem, PathLike
 
 
@@ -32,6 +54,14 @@ def convert_fields_to_optional(parent_class: Type[BaseModel]):
     return child_class
 
 
+def add_fields(item_schema: Type[BaseModel], fields: DictItem) -> Type[BaseModel]:
+    """Given a `item_schema` Pydantic model, creates a new one with the additional `fields`.
+    Returns `item_schema` itself if there are none."""
+    if not fields:
+        return item_schema
+    return create_model(item_schema.__name__, **fields, __base__=item_schema)
+
+
 def create_out_item(item_schema: Type[Item]) -> Type[Item]:
     """Given a `item_schema` Pydantic model, creates a new one with an additional field `id`"""
     return create_model("OutItem", id=(PositiveInt, ...), __base__=item_schema)
@@ -52,11 +82,26 @@ class SchemaLoadingError(Exception):
 
 
 class DatabasePathError(Exception):
-    def __init__(self, path: PathLike) -> None:
+    def __init__(self, path: Optional[PathLike]) -> None:
         super().__init__(f"The path {path} is invalid.")
 
 
+# How many times `TinyDBDatabase.snapshot` tries to read the database file
+SNAPSHOT_ATTEMPTS = 5
+
+
+@instrument("database")
 class AbcDatabase(ABC):
+    # Set by `Model` to the migration of its schema. Backends use it to stamp the documents
+    # they write and to migrate documents written with another schema.
+    migration: Optional[SchemaMigration] = None
+    # Fields the backend adds to the entries it returns, as `create_model` field definitions,
+    # e.g. where they were found. `Model` adds them to its schemas.
+    out_fields: DictItem = {}
+
+    def __init__(self, feed: Optional[ChangeFeed] = None) -> None:
+        # Write paths record their changes here
+        self.feed = feed or ChangeFeed(None)
 
     @abstractproperty
     def id_field_name(self) -> str:
@@ -64,19 +109,19 @@ class AbcDatabase(ABC):
 
     #TODO: #7 All should return a generator
     @abstractmethod
-    def all(self) -> Sequence[DictItem]:
+    def all(self) -> Mapping[str, Sequence[DictItem]]:
         raise NotImplementedError()
 
     @abstractmethod
-    def get(self, id: int) -> OptionalDictItem:
+    def get(self, id: int, workspace: Optional[str] = None) -> OptionalDictItem:
         raise NotImplementedError()
 
     @abstractmethod
-    def add_item(self, item: Item) -> int:
+    def add_item(self, item: Item, workspace: Optional[str] = None) -> int:
         raise NotImplementedError()
 
     @abstractmethod
-    def add_items(self, items: Sequence[Item]) -> Sequence[int]:
+    def add_items(self, items: Sequence[Item], workspace: Optional[str] = None) -> Sequence[int]:
         raise NotImplementedError()
 
     @abstractmethod
@@ -84,142 +129,1077 @@ class AbcDatabase(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def update(self, id: int, update: DictItem) -> Optional[int]:
+    def update(
+        self, id: int, update: DictItem, workspace: Optional[str] = None
+    ) -> Optional[int]:
+        raise NotImplementedError()
+
+    def explain(self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any) -> QueryPlan:
+        """Runs `filters` like `filter` and returns how they were executed. This default
+        implementation only knows the time it took, backends should override it."""
+        start = time.perf_counter()
+        found = self.filter(filters, workspace=workspace, **kwargs)
+        return QueryPlan(
+            workspace=workspace or "",
+            access_path=FULL_SCAN,
+            rows_returned=len(found),
+            timings={"search": time.perf_counter() - start},
+        )
+
+    def iter_all(self) -> Iterator[tuple[str, DictItem]]:
+        """Yields (workspace, entry) pairs of every entry, grouped by workspace. This default
+        implementation goes through `all`, backends should override it to avoid holding every
+        entry at once."""
+        for workspace, entries in self.all().items():
+            for entry in entries:
+                yield workspace, entry
+
+    def iter_filter(self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any) -> Iterator[DictItem]:
+        """Like `filter`, but yields the entries one at a time. This default implementation
+        goes through `filter`, backends should override it."""
+        return iter(self.filter(filters, workspace=workspace, **kwargs))
+
+    def stored_size(self) -> Optional[int]:
+        """Size in bytes of the stored entries, `None` if unknown."""
+        return None
+
+    def load(self, workspace: Optional[str] = None) -> Any:
+        """Reads every entry of `workspace` at once, so several searches given the result as
+        `loaded` (see `filter`) don't read the database again. Returns `None` if the backend
+        can't search loaded entries, which is what this default implementation does."""
+        return None
+
+    def order(
+        self,
+        entries: Sequence[DictItem],
+        order_by: Order,
+        limit: Optional[int] = None,
+        workspace: Optional[str] = None,
+    ) -> Sequence[DictItem]:
+        """Sorts `entries` of `workspace`, e.g. returned by `filter`, by `order_by` and keeps the
+        first `limit`. This default implementation sorts them in memory, backends should
+        override it to use their indexes."""
+        return sort_in_memory(entries, order_by, limit)
+
+    def update_where(
+        self, filters: DictItem, update: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Sequence[int]:
+        """Updates every entry matching `filters` with `update`. Returns the ids of the updated
+        entries. This default implementation updates them one by one, backends should
+        override it to write them at once."""
+        ids = [
+            entry.get(self.id_field_name, getattr(entry, self.id_field_name))
+            for entry in self.filter(filters, workspace=workspace, **kwargs)
+        ]
+        for id in ids:
+            self.update(id, update, workspace=workspace)
+        return ids
+
+    @abstractmethod
+    def delete_where(
+        self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Sequence[int]:
+        """Deletes every entry matching `filters`. Returns the ids of the deleted entries."""
         raise NotImplementedError()
 
+    def compact(self) -> int:
+        """Reclaims the space used by deleted entries. Returns how many were reclaimed."""
+        return 0
+
+    def migrate(self, batch_size: int = 500) -> Iterator[MigrationProgress]:
+        """Migrates every stored entry to the schema of `migration`, reporting progress after
+        each batch. Backends that don't version their entries have nothing to migrate."""
+        return iter(())
+
+    def convert_storage(self, storage_format: str) -> int:
+        """Rewrites the stored entries in `storage_format` (see `storages.SERIALIZERS`).
+        Returns the size written.
+
+        :raises StorageFormatError: If the database can't be converted, like with this default
+        implementation."""
+        raise StorageFormatError(f"{type(self).__name__} can't be converted to another storage format.")
+
+    def complete(
+        self, field: str, prefix: str, limit: int = 10, workspace: Optional[str] = None
+    ) -> Sequence[str]:
+        """Returns up to `limit` distinct values of `field` starting with `prefix`, ignoring case.
+        This default implementation goes through every entry, backends should override it
+        with an index."""
+        prefix = search_key(prefix)
+        suggestions: dict[str, None] = {}
+        for entry in self.filter({}, workspace=workspace):
+            value = entry.get(field)
+            if isinstance(value, str) and search_key(value).startswith(prefix):
+                suggestions[value] = None
+        return sorted(suggestions, key=search_key)[:limit]
+
+    def exists(self, filters: DictItem, workspace: Optional[str] = None) -> bool:
+        """Returns whether there's an entry matching all `filters` exactly."""
+        return bool(self.filter(filters, exact=True, workspace=workspace))
+
+    def count(
+        self, filters: Optional[DictItem] = None, workspace: Optional[str] = None, **kwargs: Any
+    ) -> int:
+        """Returns how many entries match `filters`. Accepts the same options as `filter`.
+        Backends should override it to avoid building the entries."""
+        return len(self.filter(filters or {}, workspace=workspace, **kwargs))
+
+    def aggregate(
+        self,
+        group_by: Sequence[str],
+        metrics: Sequence[str],
+        filters: Optional[DictItem] = None,
+        workspaces: Optional[Sequence[str]] = None,
+        **kwargs: Any,
+    ) -> Sequence[DictItem]:
+        """Groups the entries of `workspaces` (all of them by default) matching `filters` and
+        computes `metrics` for each group. See `Aggregation` for the specifications."""
+        aggregation = Aggregation(group_by, metrics)
+        for workspace, entries in self.all().items():
+            if workspaces and workspace not in workspaces:
+                continue
+            if filters:
+                entries = self.filter(filters, workspace=workspace, **kwargs)
+            for entry in entries:
+                aggregation.add(workspace, entry)
+        return aggregation.result()
+
+
+def folded_filter(key: str, needle: str, match: Callable[[str, str], bool]) -> QueryInstance:
+    """Compares `needle`, already normalized with `search_key`, with the shadow key of `key`
+    stored at write time. Documents written before shadow keys existed are normalized on the fly."""
+
+    def test(document: Mapping) -> bool:
+        stored = document.get(FOLDED_KEY, {}).get(key)
+        if stored is None:
+            stored = search_key(document.get(key))
+        return bool(stored) and match(stored, needle)
+
+    return QueryInstance(test, ("folded", key, needle, match.__name__))
+
 
 def poorman_fulltext_filter(key: str, value: Any) -> QueryInstance:
-    return where(key).test(
-        lambda entry: str(value).lower().strip() in str(entry).lower()
-        if entry
-        else False
-    )
+    return folded_filter(key, search_key(value), str.__contains__)
 
 
 def case_insensitive_filter(key: str, value: Any) -> QueryInstance:
-    return where(key).test(
-        lambda entry: str(value).lower().strip() == str(entry).lower()
-        if entry
-        else False
-    )
+    return folded_filter(key, search_key(value), str.__eq__)
+
+
+def range_filter(key: str, interval: Range) -> QueryInstance:
+    return where(key).test(lambda entry: entry in interval)
+
+
+def phone_filter(key: str, digits: str, match: Callable[[str, str], bool]) -> QueryInstance:
+    """Compares `digits` with the digits-only shadow key of the phone field `key`.
+    Documents written before shadow keys existed are normalized on the fly."""
+
+    def test(document: Mapping) -> bool:
+        stored = document.get(DIGITS_KEY, {}).get(key)
+        if stored is None:
+            stored = phone_digits(document.get(key))
+        return bool(stored) and match(stored, digits)
+
+    return QueryInstance(test, ("phone", key, digits, match.__name__))
+
+
+def is_live(document: Mapping) -> bool:
+    """Returns whether `document` wasn't deleted."""
+    return not document.get(DELETED_KEY)
 
 
+def public_fields(document: Mapping) -> DictItem:
+    """Returns the fields of `document` without the keys reserved for the database."""
+    return {k: v for k, v in document.items() if not k.startswith(RESERVED_PREFIX)}
+
+
+def public_document(document: Document) -> Document:
+    """Returns `document` without the keys reserved for the database."""
+    return Document(public_fields(document), doc_id=document.doc_id)
+
+
+def get_documents(
+    table: Table, doc_ids: Iterable[int], raw: Optional[Mapping[str, Mapping]] = None
+) -> list[Document]:
+    """Returns the documents of `table` with the given ids, ordered by id. Deleted documents
+    are skipped. If given, they are taken from `raw`, the content of `table` already read."""
+    # `Table.get` reads the whole storage on every call, so read it once instead.
+    if raw is None:
+        raw = table._read_table()
+    return [
+        Document(raw[str(doc_id)], doc_id=doc_id)
+        for doc_id in sorted(doc_ids)
+        if str(doc_id) in raw and is_live(raw[str(doc_id)])
+    ]
+
+
+def live_documents(table: Table) -> list[Document]:
+    """Returns the documents of `table` that weren't deleted."""
+    return [
+        Document(document, doc_id=table.document_id_class(doc_id))
+        for doc_id, document in table._read_table().items()
+        if is_live(document)
+    ]
+
+
+@instrument("database")
 class TinyDBDatabase(AbcDatabase):
-    def __init__(self, path: PathLike) -> None:
-        self.db = TinyDBDatabase.get_database(path, False)
-        self.path = Path(path)
-        super().__init__()
+    def __init__(
+        self,
+        path: Optional[PathLike],
+        in_memory: bool = False,
+        indexed_fields: Sequence[str] = (),
+        phone_fields: Sequence[str] = ("phone_number",),
+        completion_fields: Sequence[str] = ("name",),
+        identity_fields: Sequence[str] = ("name", "email"),
+        bloom_error_rate: float = 0.01,
+        phonetic_fields: Sequence[str] = ("name",),
+        slow_query_log: Optional[SlowQueryLog] = None,
+        storage_format: str = DEFAULT_FORMAT,
+    ) -> None:
+        """
+        :param indexed_fields: Numeric fields backed by a `SortedIndex`. Range filters on them
+        don't need to scan the whole table.
+        :param phone_fields: Fields holding phone numbers. They are matched by their digits only
+        and `prefix` filters on them are backed by a `DigitTrie`.
+        :param completion_fields: String fields backed by a `PrefixIndex`, used by `complete`
+        and `prefix` filters.
+        :param identity_fields: Fields backed by a `BloomFilter`, so `exists` can tell that
+        a value isn't in the database without searching it.
+        :param bloom_error_rate: Target false positive rate of the `BloomFilter`s.
+        :param phonetic_fields: Fields backed by a `PhoneticIndex` for phonetic searches.
+        :param slow_query_log: If given, filters slower than its threshold are logged to it
+        together with their `QueryPlan`.
+        :param storage_format: One of `storages.SERIALIZERS`, how the database file is encoded.
+        Files in another format are still read, `convert_storage` rewrites them.
+
+        Indexes of a database stored in `path` are persisted next to it by an `IndexStore`.
+        """
+        self.db = TinyDBDatabase.get_database(path, in_memory, storage_format)
+        self.path = Path(path) if path is not None and not in_memory else None
+        self.indexed_fields = tuple(indexed_fields)
+        self.phone_fields = tuple(phone_fields)
+        self.completion_fields = tuple(completion_fields)
+        self.identity_fields = tuple(identity_fields)
+        self.bloom_error_rate = bloom_error_rate
+        self.phonetic_fields = tuple(phonetic_fields)
+        self.slow_query_log = slow_query_log
+        self._indexes: dict[str, IndexSet] = {}
+        # Tables whose indexes are current in the `IndexStore`, read when first needed
+        self._stored_tables: Optional[set[str]] = None
+        # `file_stamp` of the database when the indexes were last loaded or saved
+        self._index_stamp: Optional[DictItem] = None
+        self._index_store = (
+            IndexStore(self.path) if self.path and self._new_index_set().indexes else None
+        )
+        super().__init__(feed=ChangeFeed(self.path))
 
     @property
     def id_field_name(self) -> str:
         return "doc_id"
 
-    def all(self) -> Sequence[DictItem]:
-        r: Sequence[DictItem] = self.db.all()
+    def all(self) -> Mapping[str, Sequence[DictItem]]:
         r: dict[str, Any] = defaultdict(list)
-        for table_name in self.db.tables():
-            for entry in self.db.table(table_name):
-                r[table_name].append(entry)
+        for table_name in sorted(self.db.tables()):
+            for entry in live_documents(self.db.table(table_name)):
+                r[table_name].append(self._public(entry))
         return r
 
     def get(self, id: int, workspace: Optional[str] = None) -> OptionalDictItem:
-        if workspace:
-            r: OptionalDictItem = self.db.table(workspace).get(doc_id=id)
-        else:
-            r: OptionalDictItem = self.db.get(doc_id=id)
-        return r
+        r: Optional[Document] = self._table(workspace).get(doc_id=id)
+        return self._public(r) if r is not None and is_live(r) else None
 
     def add_item(self, item: DictItem, workspace: Optional[str] = None) -> int:
-        if workspace:
-            result: int = self.db.table(workspace).insert(item.dict())
-        else:
-            result: int = self.db.insert(item.dict())
-        return result
+        return self.add_items([item], workspace=workspace)[0]
 
     def add_items(
         self, items: Sequence[DictItem], workspace: Optional[str] = None
     ) -> Sequence[int]:
-        ids = []
-        for item in items:
-            ids.append(self.add_item(item, workspace=workspace))
+        table = self._table(workspace)
+        indexes = self._loaded_indexes(table)
+        documents = [item.dict() for item in items]
+        stamp = {SCHEMA_KEY: self.migration.version} if self.migration else {}
+        ids: list[int] = table.insert_multiple(
+            {**document, **self._search_keys(document), **stamp} for document in documents
+        )
+        if indexes:
+            indexes.build([*zip(ids, documents)])
+        self._save_indexes(table.name)
+        self.feed.record(ADD, table.name, zip(ids, documents))
         return ids
 
     def filter(
-        self, filters: DictItem, exact: bool = False, workspace: Optional[str] = None
+        self,
+        filters: DictItem,
+        exact: bool = False,
+        workspace: Optional[str] = None,
+        mode: FilterMode = FilterMode.FULLTEXT,
+        plans: Optional[list[QueryPlan]] = None,
+        loaded: Optional[Mapping[str, Mapping]] = None,
     ) -> Sequence[DictItem]:
-        """Returns a subset of the items in the phonebook. If exact is True
-        only returns exact matches. By default checks if the values of `filters` are in the
-        entries."""
-        # TODO: #8 Add better search support for various types
+        """Returns a subset of the items in the phonebook. If exact is True (or `mode` is
+        `FilterMode.EXACT`) only returns exact matches. By default checks if the values of
+        `filters` are in the entries. With `FilterMode.PHONETIC` values are matched by how they
+        sound, e.g. "Clarice" matches "Clarisse". With `FilterMode.REGEX` values are regular
+        expressions searched in the entries.
 
-        items: Sequence[DictItem] = filters.items()
+        A value can also be a condition:
 
-        if exact:
-            query = [
-                where(field_name) == field_value for field_name, field_value in items
-            ]
+        * a range, e.g. `{"age": {"gt": 30, "le": 50}}` or `{"age": {"between": (30, 50)}}`.
+          Ranges on `indexed_fields` are answered by their `SortedIndex`.
+        * a prefix, e.g. `{"phone_number": {"prefix": "+44 20"}}`. It ignores case. Prefixes of
+          `phone_fields` are answered by their `DigitTrie` and prefixes of `completion_fields`
+          by their `PrefixIndex`.
+        * a phonetic match, e.g. `{"name": {"phonetic": "Clarice"}}`. Answered by the
+          `PhoneticIndex` of `phonetic_fields`.
+        * a regular expression, e.g. `{"email": {"regex": "^[a-z]+@al\\.com$"}}`. Entries
+          without the literal parts of the expression are skipped before running it.
+
+        Phone fields are always compared by their digits only, so "+1 555-0100" matches "15550100".
+
+        If given, the plan of the search, as returned by `explain`, is appended to `plans`. If
+        given, `loaded`, as returned by `load` for `workspace`, is searched instead of reading
+        the workspace again.
+
+        :raises FilterError: If a condition is invalid."""
+        # TODO: #8 Add better search support for various types
+        documents: list[Document] = []
+        if self.slow_query_log is not None or plans is not None:
+            start = time.perf_counter()
+            plan = self.explain(filters, workspace, exact, mode, documents=documents, loaded=loaded)
+            seconds = time.perf_counter() - start
+            if self.slow_query_log is not None and self.slow_query_log.is_slow(seconds):
+                self.slow_query_log.record(filters, seconds, plan)
+            if plans is not None:
+                plans.append(plan)
         else:
-            query = [
-                poorman_fulltext_filter(field_name, field_value)
-                for field_name, field_value in items
+            table = self._table(workspace)
+            documents = self._search(table, *self._plan(table, filters, exact, mode), raw=loaded)
+        r: Sequence[DictItem] = [self._public(d) for d in documents]
+        return r
+
+    def explain(
+        self,
+        filters: DictItem,
+        workspace: Optional[str] = None,
+        exact: bool = False,
+        mode: FilterMode = FilterMode.FULLTEXT,
+        documents: Optional[list[Document]] = None,
+        loaded: Optional[Mapping[str, Mapping]] = None,
+    ) -> QueryPlan:
+        """Runs `filters` like `filter` and returns how they were executed: which index, if
+        any, answered each filter, how many entries were expected to be checked and how many
+        were, and the time spent planning and searching. If given, `documents` is filled with
+        the documents found and `loaded` is searched like in `filter`.
+
+        :raises FilterError: If a condition is invalid."""
+        table = self._table(workspace)
+        plan = QueryPlan(workspace=table.name, access_path=FULL_SCAN)
+        start = time.perf_counter()
+        candidates, query = self._plan(table, filters, exact, mode, plan.steps)
+        planned = time.perf_counter()
+        if candidates is not None:
+            plan.access_path, plan.estimated_rows = "index", len(candidates)
+        found = self._search(table, candidates, query, plan, raw=loaded)
+        if candidates is None:
+            # A full scan checks every entry, known once the table is read
+            plan.estimated_rows = plan.rows_scanned
+        plan.timings = {"plan": planned - start, "search": time.perf_counter() - planned}
+        if documents is not None:
+            documents.extend(found)
+        return plan
+
+    def count(
+        self,
+        filters: Optional[DictItem] = None,
+        workspace: Optional[str] = None,
+        exact: bool = False,
+        mode: FilterMode = FilterMode.FULLTEXT,
+    ) -> int:
+        """Counts the entries matching `filters` without building them. When every filter is
+        answered by an index the documents aren't read at all."""
+        table = self._table(workspace)
+        if not filters:
+            return sum(map(is_live, table._read_table().values()))
+        candidates, query = self._plan(table, filters, exact, mode)
+        if candidates is not None and not query:
+            return len(candidates)
+        return len(self._search(table, candidates, query))
+
+    def aggregate(
+        self,
+        group_by: Sequence[str],
+        metrics: Sequence[str],
+        filters: Optional[DictItem] = None,
+        workspaces: Optional[Sequence[str]] = None,
+        exact: bool = False,
+        mode: FilterMode = FilterMode.FULLTEXT,
+    ) -> Sequence[DictItem]:
+        """Groups the entries of `workspaces` (all of them by default) matching `filters` and
+        computes `metrics` for each group, directly on the stored documents.
+        See `Aggregation` for the specifications."""
+        aggregation = Aggregation(group_by, metrics)
+        for name in sorted(self.db.tables()):
+            if workspaces and name not in workspaces:
+                continue
+            table = self.db.table(name)
+            if filters:
+                documents: Iterable[Mapping] = self._search(
+                    table, *self._plan(table, filters, exact, mode)
+                )
+            else:
+                documents = filter(is_live, table._read_table().values())
+            for document in documents:
+                aggregation.add(name, document)
+        return aggregation.result()
+
+    def _plan(
+        self,
+        table: Table,
+        filters: DictItem,
+        exact: bool,
+        mode: FilterMode,
+        steps: Optional[list[PlanStep]] = None,
+    ) -> tuple[Optional[set[int]], list[QueryInstance]]:
+        """Splits `filters` into the ids of the candidate documents, found through indexes
+        (`None` if no index could be used), and the queries the candidates must still pass.
+        If given, `steps` is filled with how each filter is answered."""
+        candidates: Optional[set[int]] = None
+        query = []
+        exact = exact or mode == FilterMode.EXACT
+
+        def narrow(field_name: str, condition: Any, access: str, ids: Sequence[int]) -> None:
+            nonlocal candidates
+            candidates = set(ids) if candidates is None else candidates.intersection(ids)
+            if steps is not None:
+                steps.append(PlanStep(field_name, condition, access, len(ids)))
+
+        def scan(field_name: str, condition: Any, test: QueryInstance) -> None:
+            query.append(test)
+            if steps is not None:
+                steps.append(PlanStep(field_name, condition, FULL_SCAN))
+
+        for field_name, field_value in filters.items():
+            is_phone = field_name in self.phone_fields
+            if mode in (FilterMode.PHONETIC, FilterMode.REGEX) and not isinstance(field_value, dict):
+                field_value = {FilterMode(mode).value: field_value}
+            if isinstance(field_value, dict):
+                condition = parse_condition(field_name, field_value)
+                if isinstance(condition, Regex):
+                    scan(field_name, field_value, where(field_name).test(condition.__contains__))
+                elif isinstance(condition, Phonetic):
+                    index = self._index(table, "phonetic", field_name)
+                    if isinstance(index, PhoneticIndex):
+                        narrow(field_name, field_value, "phonetic index", index.search(condition))
+                    else:
+                        scan(field_name, field_value, where(field_name).test(condition.__contains__))
+                elif isinstance(condition, Range):
+                    index = self._index(table, "sorted", field_name)
+                    if isinstance(index, SortedIndex):
+                        narrow(field_name, field_value, "sorted index", index.range(condition))
+                    else:
+                        scan(field_name, field_value, range_filter(field_name, condition))
+                elif is_phone:
+                    digits = phone_digits(condition.value)
+                    index = self._index(table, "trie", field_name)
+                    if isinstance(index, DigitTrie):
+                        narrow(field_name, field_value, "digit trie", index.prefix(digits))
+                    else:
+                        scan(field_name, field_value, phone_filter(field_name, digits, str.startswith))
+                else:
+                    index = self._index(table, "prefix", field_name)
+                    if isinstance(index, PrefixIndex):
+                        narrow(field_name, field_value, "prefix index", index.prefix(condition.value))
+                    else:
+                        scan(
+                            field_name,
+                            field_value,
+                            folded_filter(field_name, search_key(condition.value), str.startswith),
+                        )
+            elif is_phone and phone_digits(field_value):
+                match = str.__eq__ if exact else str.__contains__
+                scan(field_name, field_value, phone_filter(field_name, phone_digits(field_value), match))
+            elif exact:
+                scan(field_name, field_value, where(field_name) == field_value)
+            else:
+                scan(field_name, field_value, poorman_fulltext_filter(field_name, field_value))
+
+        return candidates, query
+
+    def _search(
+        self,
+        table: Table,
+        candidates: Optional[set[int]],
+        query: Sequence[QueryInstance],
+        plan: Optional[QueryPlan] = None,
+        raw: Optional[Mapping[str, Mapping]] = None,
+    ) -> list[Document]:
+        """Returns the documents among `candidates` (every document if `None`) passing every
+        query. If given, `plan` is filled with how many documents were scanned and returned.
+        The documents are taken from `raw` if given, the content of `table` already read."""
+        if candidates is None:
+            # A single read of the table, counting the rows scanned doesn't read it again
+            if raw is None:
+                raw = table._read_table()
+            scanned = len(raw)
+            documents = [
+                Document(document, doc_id=table.document_id_class(doc_id))
+                for doc_id, document in raw.items()
+                if is_live(document) and all(q(document) for q in query)
             ]
-        if workspace:
-            table = self.db.table(workspace)
         else:
-            table = self.db
-
-        # TinyDB accepts multiple queries separated by the boolean operator (__and__)
-        # we use reduce to combine multiple queries into one
-        r: Sequence[dict] = table.search(reduce(lambda a, b: a & b, query))
-        return r
+            found = get_documents(table, candidates, raw)
+            scanned = len(found)
+            documents = [d for d in found if all(q(d) for q in query)]
+        METRICS.increment("rows_scanned", scanned)
+        METRICS.increment("rows_returned", len(documents))
+        if plan is not None:
+            plan.rows_scanned, plan.rows_returned = scanned, len(documents)
+        return documents
 
     def update(
         self, id: int, update: DictItem, workspace: Optional[str] = None
     ) -> Optional[int]:
-        if workspace:
-            table = self.db.table(workspace)
-        else:
-            table = self.db
-        result = table.update(update, doc_ids=[id])
+        table = self._table(workspace)
+        old = table.get(doc_id=id)
+        if old is None or not is_live(old):
+            return None
+        indexes = self._loaded_indexes(table)
+        new = dict(old)
+        self._upgrade(new)
+        new.update(update)
+        new.update(self._search_keys(new))
+        result = table.update(new, doc_ids=[id])
+        if indexes:
+            indexes.remove(id, old)
+            indexes.add(id, new)
+        self._save_indexes(table.name)
+        self.feed.record(UPDATE, table.name, [(id, public_fields(new))])
         return result[0]
 
+    def update_where(
+        self,
+        filters: DictItem,
+        update: DictItem,
+        workspace: Optional[str] = None,
+        exact: bool = False,
+        mode: FilterMode = FilterMode.FULLTEXT,
+    ) -> Sequence[int]:
+        """Updates every entry matching `filters` (see `filter`) with `update` in a single write.
+        Returns the ids of the updated entries."""
+        table = self._table(workspace)
+        old = {d.doc_id: d for d in self._search(table, *self._plan(table, filters, exact, mode))}
+        if not old:
+            return []
+        # After searching, since it may have built the indexes
+        indexes = self._loaded_indexes(table)
+
+        new = {}
+        for doc_id, document in old.items():
+            new[doc_id] = dict(document)
+            self._upgrade(new[doc_id])
+            new[doc_id].update(update)
+            new[doc_id].update(self._search_keys(new[doc_id]))
+
+        table._update_table(lambda documents: documents.update(new))
+        if indexes:
+            for doc_id, document in old.items():
+                indexes.remove(doc_id, document)
+                indexes.add(doc_id, new[doc_id])
+        self._save_indexes(table.name)
+        self.feed.record(
+            UPDATE, table.name, [(doc_id, public_fields(new[doc_id])) for doc_id in sorted(new)]
+        )
+        return sorted(old)
+
+    def delete_where(
+        self,
+        filters: DictItem,
+        workspace: Optional[str] = None,
+        exact: bool = False,
+        mode: FilterMode = FilterMode.FULLTEXT,
+    ) -> Sequence[int]:
+        """Deletes every entry matching `filters` (see `filter`) in a single write. Returns the
+        ids of the deleted entries.
+
+        Entries are only marked as deleted (a tombstone) and skipped by every read, the space
+        they use is reclaimed by `compact`."""
+        table = self._table(workspace)
+        old = {d.doc_id: d for d in self._search(table, *self._plan(table, filters, exact, mode))}
+        if not old:
+            return []
+        # After searching, since it may have built the indexes
+        indexes = self._loaded_indexes(table)
+        table.update({DELETED_KEY: True}, doc_ids=list(old))
+        if indexes:
+            for doc_id, document in old.items():
+                indexes.remove(doc_id, document)
+        self._save_indexes(table.name)
+        self.feed.record(DELETE, table.name, [(doc_id, None) for doc_id in sorted(old)])
+        return sorted(old)
+
+    def compact(self) -> int:
+        """Removes the deleted entries of every workspace for good, one write per workspace
+        with deleted entries. Their indexes are rebuilt the next time they are needed, since
+        a `BloomFilter` can't forget values. Returns how many entries were removed."""
+        removed = 0
+        for name in sorted(self.db.tables()):
+            table = self.db.table(name)
+            self._loaded_indexes(table)
+            doc_ids = [
+                int(doc_id)
+                for doc_id, document in table._read_table().items()
+                if not is_live(document)
+            ]
+            if not doc_ids:
+                continue
+            table.remove(doc_ids=doc_ids)
+            removed += len(doc_ids)
+            self._indexes.pop(name, None)
+            if self._stored_tables is not None:
+                self._stored_tables.discard(name)
+        if removed:
+            self._save_indexes()
+        return removed
+
+    def migrate(self, batch_size: int = 500) -> Iterator[MigrationProgress]:
+        """Migrates the documents written with another schema than the one of `migration`,
+        `batch_size` documents per write. Only one batch of documents is migrated in memory
+        at a time.
+
+        Progress is stored in a `MigrationCheckpoint` after each batch, so if the migration is
+        interrupted (e.g. the iterator isn't exhausted) it resumes after the last batch written.
+        Documents that can't be migrated are left untouched and reported as failed."""
+        if self.migration is None:
+            return
+        version = self.migration.version
+        checkpoint = MigrationCheckpoint(self.path)
+        resume = checkpoint.load(version)
+        migrated = 0
+        for name in sorted(self.db.tables()):
+            if resume and name < resume[0]:
+                continue
+            after = resume[1] if resume and name == resume[0] else 0
+            table = self.db.table(name)
+            stale = sorted(
+                int(doc_id)
+                for doc_id, document in table._read_table().items()
+                if int(doc_id) > after and is_live(document) and not self.migration.is_current(document)
+            )
+            for start in range(0, len(stale), batch_size):
+                batch = stale[start : start + batch_size]
+                indexes = self._loaded_indexes(table)
+                new, failed = {}, []
+                # Read again for every batch, the table may have been written in between
+                for old in get_documents(table, batch):
+                    document = dict(old)
+                    if not self._upgrade(document):
+                        failed.append(old.doc_id)
+                        continue
+                    document.update(self._search_keys(document))
+                    new[old.doc_id] = document
+                    if indexes:
+                        indexes.remove(old.doc_id, old)
+                        indexes.add(old.doc_id, document)
+                if new:
+                    table._update_table(lambda documents: documents.update(new))
+                    self._save_indexes(table.name)
+                    self.feed.record(
+                        UPDATE, name, [(doc_id, public_fields(d)) for doc_id, d in new.items()]
+                    )
+                migrated += len(new)
+                checkpoint.save(version, name, batch[-1])
+                yield MigrationProgress(workspace=name, migrated=migrated, failed=failed)
+        checkpoint.clear()
+
+    def complete(
+        self, field: str, prefix: str, limit: int = 10, workspace: Optional[str] = None
+    ) -> Sequence[str]:
+        index = self._index(self._table(workspace), "prefix", field)
+        if isinstance(index, PrefixIndex):
+            return index.complete(prefix, limit)
+        return super().complete(field, prefix, limit, workspace)
+
+    def exists(self, filters: DictItem, workspace: Optional[str] = None) -> bool:
+        """Returns whether there's an entry matching all `filters` exactly. If the `BloomFilter`
+        of any of the fields says its value is absent, the documents aren't searched at all."""
+        table = self._table(workspace)
+        for field_name, field_value in filters.items():
+            if isinstance(field_value, dict):
+                continue
+            index = self._index(table, "bloom", field_name)
+            if isinstance(index, BloomFilter) and field_value not in index:
+                return False
+        return super().exists(filters, workspace=workspace)
+
+    def iter_all(self) -> Iterator[tuple[str, DictItem]]:
+        for name in sorted(self.db.tables()):
+            table = self.db.table(name)
+            for doc_id, document in table._read_table().items():
+                if is_live(document):
+                    yield name, self._public(Document(document, doc_id=table.document_id_class(doc_id)))
+
+    def iter_filter(
+        self,
+        filters: DictItem,
+        exact: bool = False,
+        workspace: Optional[str] = None,
+        mode: FilterMode = FilterMode.FULLTEXT,
+    ) -> Iterator[DictItem]:
+        """Like `filter`, but yields the matching entries one at a time instead of building the
+        list of every match. Invalid `filters` raise right away, not when iterating.
+
+        :raises FilterError: If a filter is invalid."""
+        table = self._table(workspace)
+        candidates, query = self._plan(table, filters, exact, mode)
+        raw = table._read_table()
+        ids = (str(doc_id) for doc_id in sorted(candidates)) if candidates is not None else iter(raw)
+
+        def matches() -> Iterator[DictItem]:
+            scanned = returned = 0
+            try:
+                for doc_id in ids:
+                    document = raw.get(doc_id)
+                    if document is None or not is_live(document):
+                        continue
+                    scanned += 1
+                    document = Document(document, doc_id=table.document_id_class(doc_id))
+                    if all(q(document) for q in query):
+                        returned += 1
+                        yield self._public(document)
+            finally:
+                METRICS.increment("rows_scanned", scanned)
+                METRICS.increment("rows_returned", returned)
+
+        return matches()
+
+    def load(self, workspace: Optional[str] = None) -> Mapping[str, Mapping]:
+        """Returns the stored documents of `workspace` by id, as searched by `filter`."""
+        return self._table(workspace)._read_table()
+
+    def stored_size(self) -> Optional[int]:
+        if self.path is None or not self.path.exists():
+            return None
+        return stored_size(self.path)
+
+    def order(
+        self,
+        entries: Sequence[DictItem],
+        order_by: Order,
+        limit: Optional[int] = None,
+        workspace: Optional[str] = None,
+    ) -> Sequence[DictItem]:
+        """Entries sorted by a single field backed by a `SortedIndex` or `PrefixIndex` are put
+        in the order of the index instead of being compared, unless there are so few of them
+        that sorting is cheaper than going through the index. Only indexes already built are
+        used. Entries with equal values and entries without a value, which aren't indexed and
+        come last, keep their order in `entries` like when they are sorted."""
+        if len(order_by) != 1 or any(getattr(e, "doc_id", None) is None for e in entries):
+            return super().order(entries, order_by, limit, workspace)
+        (field, descending), = order_by
+        indexes = self._loaded_indexes(self._table(workspace), lazy=True)
+        index = indexes and (indexes.find("sorted", field) or indexes.find("prefix", field))
+        if (
+            not isinstance(index, (SortedIndex, PrefixIndex))
+            or len(entries) * math.log2(len(entries) or 1) < len(index.doc_ids)
+        ):
+            return super().order(entries, order_by, limit, workspace)
+        positions = {getattr(entry, "doc_id"): position for position, entry in enumerate(entries)}
+        ordered: list[DictItem] = []
+        for doc_ids in index.ordered(descending):
+            if limit is not None and len(ordered) >= limit:
+                break
+            found = sorted(positions.pop(doc_id) for doc_id in doc_ids if doc_id in positions)
+            ordered.extend(entries[position] for position in found)
+        ordered.extend(entries[position] for position in positions.values())
+        return ordered[:limit]
+
+    def _table(self, workspace: Optional[str] = None) -> Table:
+        return self.db.table(workspace or self.db.default_table_name)
+
+    def snapshot(self) -> tuple[int, DictItem]:
+        """Returns the sequence number of the last change in the feed and the raw data of every
+        table. Nothing is locked, so writers aren't blocked: changes after the sequence number
+        may already be in the data, replaying them again must be harmless.
+
+        :raises OSError: If the database file can't be read, e.g. it's always being written."""
+        for attempt in range(SNAPSHOT_ATTEMPTS):
+            seq = self.feed.last_seq
+            try:
+                return seq, self.db.storage.read() or {}
+            except ValueError:
+                # Read while another process was writing it, try again
+                time.sleep(0.05 * (attempt + 1))
+        raise OSError(f"Couldn't read a consistent copy of {self.path}.")
+
+    def replace_all(self, tables: DictItem) -> None:
+        """Replaces the whole database with the raw data of `tables` in a single write, e.g. to
+        restore a backup, and records a `RESET` change. Indexes are rebuilt the next time they
+        are needed."""
+        self.db.storage.write(tables)
+        # Tables cache the next id and query results, start over with new ones
+        self.db._tables.clear()
+        self._indexes.clear()
+        self._stored_tables = set()
+        self._save_indexes()
+        # Consumers of the feed, e.g. incremental backups, can't apply the changes before
+        self.feed.reset()
+
+    def convert_storage(self, storage_format: str) -> int:
+        """Rewrites the database file in `storage_format` (see `storages.SERIALIZERS`) and keeps
+        writing it in that format. Returns the size of the file written.
+
+        :raises StorageFormatError: If the format is unknown or the database isn't in a file."""
+        if self.path is None:
+            raise StorageFormatError("Databases in memory aren't stored in a file.")
+        size = convert_storage(self.path, storage_format)
+        self.db = TinyDBDatabase.get_database(self.path, storage_format=storage_format)
+        return size
+
+    def stored_document(self, document: DictItem) -> DictItem:
+        """Returns the raw document stored for the entry `document`, with its search keys."""
+        stored = dict(document)
+        self._upgrade(stored)
+        stored.update(self._search_keys(stored))
+        return stored
+
+    def _public(self, document: Document) -> Document:
+        """Returns `document` without the reserved keys. Documents written with another schema
+        are migrated on the fly, without writing them back."""
+        if self.migration is not None and not self.migration.fits(document):
+            try:
+                document = Document(self.migration.migrate(document), doc_id=document.doc_id)
+            except MigrationError:
+                pass
+        return public_document(document)
+
+    def _upgrade(self, document: dict) -> bool:
+        """Migrates `document` in place to the schema of `migration` before it's written.
+        Returns whether `document` is now current."""
+        if self.migration is None or self.migration.is_current(document):
+            return True
+        try:
+            document.update(self.migration.migrate(document))
+        except MigrationError:
+            return False
+        document[SCHEMA_KEY] = self.migration.version
+        return True
+
+    def _search_keys(self, document: DictItem) -> DictItem:
+        """Normalized copies of `document` fields stored alongside it, so filters don't have
+        to normalize every entry on every search."""
+        return {
+            DIGITS_KEY: {
+                field: phone_digits(document[field])
+                for field in self.phone_fields
+                if document.get(field)
+            },
+            FOLDED_KEY: {
+                field: search_key(value)
+                for field, value in document.items()
+                if value is not None and not field.startswith(RESERVED_PREFIX)
+            },
+        }
+
+    def _new_index_set(
+        self, capacity: int = 1024, restore: Optional[Callable[[AbcIndex], None]] = None
+    ) -> IndexSet:
+        """Creates empty indexes for a table. `capacity` is the expected number of documents.
+        With `restore`, each index is restored by it the first time it's needed."""
+        return IndexSet(
+            [SortedIndex(f) for f in self.indexed_fields]
+            + [DigitTrie(f) for f in self.phone_fields]
+            + [PrefixIndex(f) for f in self.completion_fields]
+            + [
+                # Exact filters on phone fields compare digits, so must their `BloomFilter`
+                BloomFilter(
+                    f,
+                    self.bloom_error_rate,
+                    capacity,
+                    key=phone_digits if f in self.phone_fields else str,
+                )
+                for f in self.identity_fields
+            ]
+            + [PhoneticIndex(f) for f in self.phonetic_fields],
+            restore,
+        )
+
+    def _loaded_indexes(self, table: Table, lazy: bool = False) -> Optional[IndexSet]:
+        """Returns the indexes of `table` if they are in memory or can be restored from the
+        `IndexStore`. Must be called before `table` is written, so the stored indexes are
+        checked against the database they were saved with. With `lazy`, each index is only
+        read from the store when it's used, e.g. completing names doesn't read the others."""
+        if self._index_store is not None:
+            stamp = file_stamp(self._index_store.database_path)
+            if stamp != self._index_stamp:
+                # Written by another process since, the indexes in memory are stale and the
+                # stored ones are only current if it saved them
+                self._indexes.clear()
+                self._stored_tables = None
+                self._index_stamp = stamp
+        indexes = self._indexes.get(table.name)
+        if indexes is None and self._index_store is not None:
+            if self._stored_tables is None:
+                self._stored_tables = self._index_store.load(self._new_index_set().spec())
+            if table.name in self._stored_tables:
+                indexes = self._new_index_set(
+                    restore=lambda index: self._restore_index(table, index)
+                )
+                self._indexes[table.name] = indexes
+        if indexes is not None and not lazy:
+            indexes.restore()
+        return indexes
+
+    def _restore_index(self, table: Table, index: AbcIndex) -> None:
+        """Restores `index` of `table` from the `IndexStore`, or builds it if it can't be read."""
+        assert self._index_store is not None
+        data = self._index_store.load_index(table.name, index.kind, index.field)
+        if data is not None:
+            index.load(data)
+        else:
+            index.build([(document.doc_id, document) for document in live_documents(table)])
+
+    def _index(self, table: Table, kind: str, field: str) -> Optional[AbcIndex]:
+        """Returns the index of `kind` over `field` in `table`. The indexes of a table are
+        restored from the `IndexStore` or built from its documents the first time they are needed."""
+        indexes = self._loaded_indexes(table, lazy=True)
+        if indexes is None:
+            if not self._new_index_set().indexes:
+                return None
+            documents = live_documents(table)
+            indexes = self._new_index_set(capacity=len(documents))
+            indexes.build([(document.doc_id, document) for document in documents])
+            self._indexes[table.name] = indexes
+            self._save_indexes(table.name)
+        return indexes.find(kind, field)
+
+    def _save_indexes(self, *names: str) -> None:
+        """Persists the indexes of the tables `names` after they were written. The stored
+        indexes of the other tables are still current and aren't written again."""
+        if self._index_store is None:
+            return
+        if not self._indexes and not self._index_store.path.exists():
+            return
+        tables = {name: self._indexes[name].dump() for name in names if name in self._indexes}
+        kept = self._stored_tables or set()
+        self._index_stamp = self._index_store.save(self._new_index_set().spec(), tables, kept)
+        self._stored_tables = {*kept, *tables}
+
     @staticmethod
-    def get_database(path: Optional[PathLike], in_memory: bool = False) -> TinyDB:
+    def get_database(
+        path: Optional[PathLike], in_memory: bool = False, storage_format: str = DEFAULT_FORMAT
+    ) -> TinyDB:
         TinyDB.default_table_name = "personal"
         if in_memory:
-            return TinyDB(storage=MemoryStorage)
+            return TinyDB(storage=MetricsMiddleware(MemoryStorage))
+        if path is None:
+            raise DatabasePathError(path)
+        storage = storage_class(path, storage_format)
         try:
-            db = TinyDB(path)
-        except OSError as e:
+            db = TinyDB(path, storage=MetricsMiddleware(storage))
+        # `TypeError` if `path` isn't a path at all
+        except (OSError, TypeError) as e:
             raise DatabasePathError(path)
         return db
 
 
+@instrument("model")
 class Model:
     def __init__(
         self,
         database: Optional[AbcDatabase] = None,
         custom_item_schema: Optional[Type[BaseModel]] = None,
+        max_memory: Optional[int] = None,
     ) -> None:
+        """
+        :param max_memory: Memory budget in bytes. Reading every entry of a database whose
+        working set would exceed it should go through `iter_all` and `iter_filter`, see `streams`.
+        """
         if not database:
             database = TinyDBDatabase()
         assert database is not None
         self.database = database
         self.ItemSchema = custom_item_schema or Item
+        self.max_memory = max_memory
+        self.database.migration = SchemaMigration(self.ItemSchema)
 
-    def all(self) -> dict[str, Sequence[Item]]:
-        """Returns all entries in the phonebook"""
-        r: dict[str, Any] = defaultdict(list)
+    def all(
+        self, order_by: Optional[Union[str, Sequence[str]]] = None, limit: Optional[int] = None
+    ) -> dict[str, ItemCollection]:
+        """Returns all entries in the phonebook, grouped by workspace. Each workspace is
+        an `ItemCollection`, so `Item`s are only built when accessed.
 
+        :param order_by: Fields each workspace is sorted by, see `filter`.
+        :param limit: Maximum number of entries of each workspace.
+        :raises SortError: If `order_by` has a field that isn't part of the schema."""
+        r: dict[str, ItemCollection] = {}
+        schema = add_fields(self.ItemSchema, self.database.out_fields)
+        order = self._order(order_by)
         for workspace, entries in self.database.all().items():
-            for entry in entries:
-                r[workspace].append(self.ItemSchema(**entry))
+            if order or limit is not None:
+                entries = self.database.order(entries, order, limit, workspace)
+            r[workspace] = ItemCollection(schema, entries)
         return r
 
+    def streams(self) -> bool:
+        """Whether holding every entry at once would exceed `max_memory`. If so, `iter_all` and
+        `iter_filter` should be used instead of `all` and `filter`."""
+        return exceeds(self.max_memory, self.database.stored_size())
+
+    def iter_all(
+        self, order_by: Optional[Union[str, Sequence[str]]] = None, limit: Optional[int] = None
+    ) -> Iterator[tuple[str, BaseModel]]:
+        """Like `all`, but yields (workspace, `Item`) pairs one at a time, so only the entry
+        being built is held besides the database itself. Sorted workspaces larger than the
+        budget are sorted in runs spilled to temporary files. An invalid `order_by` raises
+        right away, not when iterating.
+
+        :raises SortError: If `order_by` has a field that isn't part of the schema."""
+        schema = add_fields(self.ItemSchema, self.database.out_fields)
+        order = self._order(order_by)
+
+        def items() -> Iterator[tuple[str, BaseModel]]:
+            for workspace, pairs in groupby(self.database.iter_all(), key=lambda pair: pair[0]):
+                entries: Iterable[DictItem] = (entry for _, entry in pairs)
+                if order or limit is not None:
+                    entries = self._sorted(entries, order, limit)
+                for entry in entries:
+                    yield workspace, schema(**entry)
+
+        return items()
+
+    def iter_filter(
+        self,
+        filters: DictItem,
+        workspace: Optional[str] = None,
+        order_by: Optional[Union[str, Sequence[str]]] = None,
+        limit: Optional[int] = None,
+        **kwargs: Any,
+    ) -> Iterator[Item]:
+        """Like `filter`, but yields the `Item`s one at a time. Invalid `filters` or `order_by`
+        raise right away, not when iterating.
+
+        :raises FilterError: If a filter is invalid.
+        :raises SortError: If `order_by` has a field that isn't part of the schema."""
+        order = self._order(order_by)
+        entries = self.database.iter_filter(filters, workspace=workspace, **kwargs)
+        if order or limit is not None:
+            entries = self._sorted(entries, order, limit)
+        OutSchema = create_out_item(add_fields(self.ItemSchema, self.database.out_fields))
+        id_field = self.database.id_field_name
+        return (
+            OutSchema(**entry, id=entry.get(id_field, getattr(entry, id_field, None)))
+            for entry in entries
+        )
+
+    def _sorted(self, entries: Iterable[DictItem], order: Order, limit: Optional[int]) -> Iterator[DictItem]:
+        run = run_size(self.max_memory) if self.max_memory else RUN_SIZE
+        return sort_entries(entries, order, limit, run_size=run)
+
     def get(self, id: int, workspace: Optional[str] = None) -> Item:
         """Gets a single entry from the phonebook"""
         r: DictItem = self.database.get(id, workspace)
-        return self.ItemSchema(**r)
+        return add_fields(self.ItemSchema, self.database.out_fields)(**r)
 
     def add_item(
         self, item: DictItem, workspace: Optional[str] = None
@@ -237,29 +1217,174 @@ class Model:
         ids: Sequence[int] = self.database.add_items(items, workspace=workspace)
         return ids
 
-    def filter(self, filters: DictItem, workspace: Optional[str] = None, **kwargs) -> Sequence[Item]:
+    def filter(
+        self,
+        filters: DictItem,
+        workspace: Optional[str] = None,
+        order_by: Optional[Union[str, Sequence[str]]] = None,
+        limit: Optional[int] = None,
+        **kwargs,
+    ) -> ItemCollection:
         """Returns a subset of the items in the phonebook. Additional options can be passed with keyword
-        arguments depending on the database being used."""
+        arguments depending on the database being used.
+
+        :param order_by: Fields the result is sorted by, e.g. `"name,-age"` or `["name", "-age"]`.
+        A `-` sorts the field in descending order. Strings are sorted ignoring case.
+        :param limit: Maximum number of entries returned, the first ones in `order_by` order.
+        :raises SortError: If `order_by` has a field that isn't part of the schema."""
+        order = self._order(order_by)
         result: Sequence[DictItem] = self.database.filter(filters, workspace=workspace, **kwargs)
-        OutSchema = create_out_item(self.ItemSchema)
-        output = []
+        if order or limit is not None:
+            result = self.database.order(result, order, limit, workspace)
+        OutSchema = create_out_item(add_fields(self.ItemSchema, self.database.out_fields))
+        output = ItemCollection(OutSchema)
         for entry in result:
             entry["id"] = entry.get(self.database.id_field_name, getattr(entry, self.database.id_field_name))
-            output.append(OutSchema(**entry))
+            output.append(entry)
         return output
 
-    def update(self, id: int, update: DictItem, workspace: str = None) -> Optional[int]:
-        """Updated a single document by `id`.
+    def complete(
+        self, field: str, prefix: str, limit: int = 10, workspace: Optional[str] = None
+    ) -> Sequence[str]:
+        """Returns up to `limit` distinct values of `field` starting with `prefix`, ignoring case.
+        Meant for autocompletion, e.g. suggesting names while the user types."""
+        return self.database.complete(field, prefix, limit=limit, workspace=workspace)
+
+    def exists(self, filters: DictItem, workspace: Optional[str] = None) -> bool:
+        """Returns whether there's an entry matching all `filters` exactly. Cheaper than
+        `filter` when the answer is usually no, e.g. checking for duplicates before adding."""
+        return self.database.exists(filters, workspace=workspace)
+
+    def count(
+        self, filters: Optional[DictItem] = None, workspace: Optional[str] = None, **kwargs: Any
+    ) -> int:
+        """Returns how many entries match `filters`, without validating them into `Item`s.
+        Accepts the same options as `filter`."""
+        return self.database.count(filters, workspace=workspace, **kwargs)
+
+    def aggregate(
+        self,
+        group_by: Sequence[str] = ("workspace",),
+        metrics: Sequence[str] = ("count",),
+        filters: Optional[DictItem] = None,
+        workspaces: Optional[Sequence[str]] = None,
+        **kwargs: Any,
+    ) -> Sequence[DictItem]:
+        """Groups the entries of `workspaces` (all of them by default) and computes `metrics` for
+        each group, without validating them into `Item`s. E.g. an age histogram:
+
+            model.aggregate(group_by=["age:10"], metrics=["count"])
+
+        :param group_by: `workspace`, a field name, `<field>:domain` or `<field>:<bucket width>`.
+        :param metrics: `count` or `sum`, `min`, `max`, `avg` of a field, e.g. `avg:age`.
+        :raises AggregationError: If a specification is invalid.
+        """
+        return self.database.aggregate(
+            group_by, metrics, filters=filters, workspaces=workspaces, **kwargs
+        )
+
+    def find_duplicates(
+        self, window: int = 5, threshold: float = 0.6, workers: Optional[int] = 1
+    ) -> Sequence[MergeSuggestion]:
+        """Finds contacts that are probably the same person, across all workspaces.
+
+        Contacts are only compared with their `window` neighbours when sorted by each blocking
+        key (email, phone digits and phonetic name), instead of with every other contact.
+
+        :param threshold: Minimum score, between 0 and 1, for a pair to be suggested.
+        :param workers: Number of processes scoring the candidate pairs. `None` uses every CPU.
+        """
+        return find_duplicates(
+            self.database.all(),
+            self.database.id_field_name,
+            window=window,
+            threshold=threshold,
+            workers=workers,
+        )
+
+    def _order(self, order_by: Optional[Union[str, Sequence[str]]]) -> Order:
+        if not order_by:
+            return []
+        schema = add_fields(self.ItemSchema, self.database.out_fields)
+        return parse_order(order_by, schema.__fields__)
+
+    def update(
+        self, id: int, update: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Optional[int]:
+        """Updated a single document by `id`. Additional options can be passed with keyword
+        arguments depending on the database being used, e.g. the `source` of the entry for a
+        `FederatedDatabase`.
         :raises ValidationError In case the update values are not valid."""
         InSchema = convert_fields_to_optional(self.ItemSchema)
         update = InSchema(**update)
         update_data = update.dict(exclude_unset=True)
-        return self.database.update(id=id, update=update_data, workspace=workspace)
+        return self.database.update(id=id, update=update_data, workspace=workspace, **kwargs)
+
+    def update_where(
+        self, filters: DictItem, update: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Sequence[int]:
+        """Updates every entry matching `filters` with `update`. Returns the ids of the updated
+        entries. Accepts the same options as `filter`, e.g. moving everyone at a domain:
+
+            model.update_where({"email": "@old.com"}, {"address": "New office"})
+
+        :raises ValidationError In case the update values are not valid."""
+        InSchema = convert_fields_to_optional(self.ItemSchema)
+        update_data = InSchema(**update).dict(exclude_unset=True)
+        return self.database.update_where(filters, update_data, workspace=workspace, **kwargs)
+
+    def delete_where(
+        self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any
+    ) -> Sequence[int]:
+        """Deletes every entry matching `filters`. Returns the ids of the deleted entries.
+        Accepts the same options as `filter`. Empty `filters` delete the whole workspace."""
+        return self.database.delete_where(filters, workspace=workspace, **kwargs)
+
+    def compact(self) -> int:
+        """Reclaims the space used by deleted entries. Returns how many were reclaimed."""
+        return self.database.compact()
+
+    def migrate(self, batch_size: int = 500) -> Iterator[MigrationProgress]:
+        """Migrates the entries written with an older schema to the current one, reporting the
+        progress after each batch of `batch_size` entries. Entries are already migrated when
+        read or updated, this makes it permanent for all of them at once, e.g.:
+
+            for progress in model.migrate():
+                print(progress.migrated)
+
+        An interrupted migration resumes where it stopped."""
+        return self.database.migrate(batch_size=batch_size)
+
+    def explain(self, filters: DictItem, workspace: Optional[str] = None, **kwargs: Any) -> QueryPlan:
+        """Runs `filters` like `filter` and returns how they were executed: the access path
+        (a full scan or which index), the estimated and actual rows scanned and the time per
+        stage. Accepts the same options as `filter`."""
+        return self.database.explain(filters, workspace=workspace, **kwargs)
+
+    def changes(self, since: int = 0) -> Iterator[ChangeEvent]:
+        """Yields every change made to the phonebook after the change `since`, in order. Consumers
+        keeping a copy of the phonebook remember the `seq` of the last change they applied and
+        only read what happened after it, e.g.:
+
+            for change in model.changes(since=last_seq):
+                mirror.apply(change)
+                last_seq = change.seq
+
+        A `reset` change means the whole phonebook was replaced, e.g. a backup was restored,
+        the copy has to be made again."""
+        return self.database.feed.since(since)
+
+    def subscribe(self, callback: Subscriber) -> Callable[[], None]:
+        """Calls `callback` with each change right after it's written, in this process.
+        Returns a function that cancels the subscription."""
+        return self.database.feed.subscribe(callback)
 
-    def update_item_schema(self, new_schema: BaseModel) -> None:
+    def update_item_schema(self, new_schema: Type[BaseModel]) -> None:
         """Updates the item schema being used. If the database layout changes,
-        you can call this to update the Item
+        you can call this to update the Item. Entries written with the previous
+        schema are migrated when read, see `migrate`.
 
         :param new_schema: [description]
         """
         self.ItemSchema = new_schema
+        self.database.migration = SchemaMigration(new_schema)
@@ -0,0 +1,176 @@
+import functools
+import inspect
+import json
+import os
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Callable, Optional, TypeVar
+
+from tinydb.middlewares import Middleware
+
+from .types import DictItem
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf"))
+
+T = TypeVar("T")
+
+
+class Histogram:
+    """Counts observations in `LATENCY_BUCKETS`. Bucket counts aren't cumulative, they are
+    only summed up when exported to Prometheus."""
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def dict(self) -> DictItem:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(le): n for le, n in zip(LATENCY_BUCKETS, self.counts)},
+        }
+
+
+class Metrics:
+    """Call counts and latencies of operations (e.g. `model.filter`, `storage.read`) and totals
+    of counters (e.g. `bytes_read`, `rows_scanned`).
+
+    Recording is cheap enough to be always on, a module level instance `METRICS` is shared by
+    everything instrumented."""
+
+    def __init__(self) -> None:
+        self.latency: dict[str, Histogram] = {}
+        self.counters: Counter[str] = Counter()
+
+    def observe(self, operation: str, seconds: float) -> None:
+        histogram = self.latency.get(operation)
+        if histogram is None:
+            histogram = self.latency[operation] = Histogram()
+        histogram.observe(seconds)
+
+    def increment(self, counter: str, value: int = 1) -> None:
+        self.counters[counter] += value
+
+    def reset(self) -> None:
+        self.latency.clear()
+        self.counters.clear()
+
+    def dict(self) -> DictItem:
+        return {
+            "operations": {name: h.dict() for name, h in sorted(self.latency.items())},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.dict(), indent=4)
+
+    def to_prometheus(self) -> str:
+        """Exports the metrics in the Prometheus text format, e.g. for the textfile collector
+        of the node exporter."""
+        lines = [
+            "# HELP al_phonebook_operation_seconds Latency of phonebook operations.",
+            "# TYPE al_phonebook_operation_seconds histogram",
+        ]
+        for name, histogram in sorted(self.latency.items()):
+            cumulative = 0
+            for le, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                bound = "+Inf" if le == float("inf") else repr(le)
+                lines.append(
+                    f'al_phonebook_operation_seconds_bucket{{operation="{name}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'al_phonebook_operation_seconds_sum{{operation="{name}"}} {histogram.sum}')
+            lines.append(f'al_phonebook_operation_seconds_count{{operation="{name}"}} {histogram.count}')
+        for counter, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE al_phonebook_{counter}_total counter")
+            lines.append(f"al_phonebook_{counter}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def breakdown(self) -> list[tuple[str, int, float]]:
+        """(operation, calls, total seconds) of every operation, slowest first."""
+        rows = [(name, h.count, h.sum) for name, h in self.latency.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+METRICS = Metrics()
+
+
+def timed(operation: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Decorator recording the latency of each call of the decorated function as `operation`."""
+
+    def decorator(function: Callable[..., T]) -> Callable[..., T]:
+        # Only creating the generator would be timed. Checked apart, so mypy doesn't narrow
+        # the type of `function`.
+        generator = inspect.isgeneratorfunction(function)
+        if generator:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.observe(operation, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument(prefix: str) -> Callable[[type], type]:
+    """Class decorator timing every public method defined in the class as `<prefix>.<method>`,
+    e.g. `model.filter`. Inherited methods are timed by decorating their class too."""
+
+    def decorator(cls: type) -> type:
+        for name, value in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.isfunction(value):
+                continue
+            setattr(cls, name, timed(f"{prefix}.{name}")(value))
+        return cls
+
+    return decorator
+
+
+class MetricsMiddleware(Middleware):
+    """TinyDB middleware recording the latency of storage reads and writes and how many bytes
+    they read and wrote. Bytes are only known for storages backed by a file."""
+
+    def read(self) -> Optional[DictItem]:
+        start = time.perf_counter()
+        try:
+            return self.storage.read()
+        finally:
+            METRICS.observe("storage.read", time.perf_counter() - start)
+            METRICS.increment("bytes_read", self._size())
+
+    def write(self, data: DictItem) -> None:
+        start = time.perf_counter()
+        try:
+            self.storage.write(data)
+        finally:
+            METRICS.observe("storage.write", time.perf_counter() - start)
+            METRICS.increment("bytes_written", self._size())
+
+    def close(self) -> None:
+        self.storage.close()
+
+    def _size(self) -> int:
+        try:
+            handle = getattr(self.storage, "_handle", None)
+            if handle is not None:
+                return os.fstat(handle.fileno()).st_size
+            path = getattr(self.storage, "path", None)
+            return os.path.getsize(path) if path is not None else 0
+        except (OSError, ValueError):
+            return 0
@@ -0,0 +1,148 @@
+import hashlib
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Mapping, Optional, Type
+
+from pydantic import BaseModel, ValidationError
+from pydantic.fields import SHAPE_SINGLETON, ModelField
+
+from .normalize import RESERVED_PREFIX, SCHEMA_KEY
+from .sidecar import sidecar_path, write_atomic
+from .types import DictItem
+
+
+class MigrationError(Exception):
+    def __init__(self, field_name: str) -> None:
+        super().__init__(
+            f"Couldn't migrate the field `{field_name}`. It's required and has no default value."
+        )
+
+
+def schema_version(schema: Type[BaseModel]) -> str:
+    """A short hash of the fields of `schema`: their names, types, constraints and defaults.
+    Any change to the fields gives a new version."""
+    definition = json.dumps(schema.schema(), sort_keys=True, default=str)
+    return hashlib.sha256(definition.encode()).hexdigest()[:16]
+
+
+def value_type(field: ModelField) -> Optional[type]:
+    """The builtin type the values of `field` are stored as, e.g. `str` for an `EmailStr`.
+    `None` if `field` isn't a plain value or has validators of its own."""
+    if field.shape != SHAPE_SINGLETON or field.sub_fields or field.class_validators:
+        return None
+    if not isinstance(field.type_, type):
+        return None
+    # `bool` first, it's a subclass of `int`
+    return next((t for t in (bool, int, float, str) if issubclass(field.type_, t)), None)
+
+
+class SchemaMigration:
+    """Brings documents written with an older schema up to `schema`.
+
+    Every document is stamped with the version of the schema it was written with. Documents
+    with another version are migrated field by field: valid values are kept (and coerced,
+    e.g. "30" -> 30 for an integer field), invalid or missing ones are replaced by the default
+    of the field. Fields that aren't in `schema` anymore are kept untouched, so changing the
+    schema back doesn't lose data.
+    """
+
+    def __init__(self, schema: Type[BaseModel]) -> None:
+        self.schema = schema
+        self.version = schema_version(schema)
+        # Stored type and whether it can be `None`, of every field. Empty if some field can't
+        # be checked by its type, or the schema validates more than each field.
+        self._types: dict[str, tuple[type, bool]] = {}
+        types = {name: value_type(field) for name, field in schema.__fields__.items()}
+        if None not in types.values() and not (
+            schema.__pre_root_validators__ or schema.__post_root_validators__
+        ):
+            self._types = {
+                name: (t, schema.__fields__[name].allow_none) for name, t in types.items()  # type: ignore[misc]
+            }
+
+    def is_current(self, document: Mapping) -> bool:
+        return document.get(SCHEMA_KEY) == self.version
+
+    def fits(self, document: Mapping) -> bool:
+        """Whether `document` can be read without migrating it: it's current, or it was written
+        before documents were stamped and every field of the schema already has a value of its
+        type. Those values were validated when written, checking their types is much cheaper
+        than validating them again. Constraints aren't checked, `migrate` validates them."""
+        if SCHEMA_KEY in document or not self._types:
+            return self.is_current(document)
+        for name, (stored_type, allow_none) in self._types.items():
+            value = document.get(name)
+            if value is None:
+                if not allow_none or name not in document:
+                    return False
+            elif type(value) is not stored_type:
+                return False
+        return True
+
+    def migrate(self, document: Mapping) -> DictItem:
+        """Returns the fields of `document` migrated to the schema, without the reserved keys.
+
+        :raises MigrationError: If a required field without a default value is invalid.
+        """
+        data = {k: v for k, v in document.items() if not k.startswith(RESERVED_PREFIX)}
+        # Each attempt replaces at least one field, so it ends after one attempt per field
+        for _ in range(len(self.schema.__fields__) + 1):
+            try:
+                item = self.schema(**data)
+            except ValidationError as e:
+                for field_name in {str(error["loc"][0]) for error in e.errors()}:
+                    model_field = self.schema.__fields__.get(field_name)
+                    if model_field is None or model_field.required:
+                        raise MigrationError(field_name)
+                    data[field_name] = model_field.get_default()
+                continue
+            return {**data, **item.dict()}
+        raise MigrationError(next(iter(self.schema.__fields__)))
+
+
+@dataclass
+class MigrationProgress:
+    """Reported after each batch of a bulk migration."""
+
+    workspace: str
+    # Documents migrated so far, in every workspace
+    migrated: int
+    # Ids of the documents of `workspace` that couldn't be migrated
+    failed: list[int] = field(default_factory=list)
+
+
+class MigrationCheckpoint:
+    """Remembers how far a bulk migration got, in a sidecar file next to the database, so an
+    interrupted migration resumes after the last batch written. Databases without a file keep
+    it in memory."""
+
+    SUFFIX = ".migration"
+
+    def __init__(self, database_path: Optional[Path]) -> None:
+        self.path = sidecar_path(database_path, self.SUFFIX) if database_path else None
+        self._memory: Optional[DictItem] = None
+
+    def load(self, version: str) -> Optional[tuple[str, int]]:
+        """Returns the workspace and id of the last document migrated to `version`, if any."""
+        stored = self._memory
+        if self.path is not None:
+            try:
+                stored = json.loads(self.path.read_bytes())
+            except (OSError, ValueError):
+                return None
+        if not stored or stored.get("version") != version:
+            return None
+        return stored["workspace"], stored["last_id"]
+
+    def save(self, version: str, workspace: str, last_id: int) -> None:
+        stored = {"version": version, "workspace": workspace, "last_id": last_id}
+        if self.path is None:
+            self._memory = stored
+        else:
+            write_atomic(self.path, json.dumps(stored).encode())
+
+    def clear(self) -> None:
+        self._memory = None
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
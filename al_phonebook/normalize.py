@@ -0,0 +1,70 @@
+import re
+import unicodedata
+from typing import Any
+
+# Keys starting with `RESERVED_PREFIX` are written by the database next to the contact
+# data (e.g. normalized copies of fields used for searching) and are never part of an `Item`.
+RESERVED_PREFIX = "_"
+DIGITS_KEY = "_digits"
+FOLDED_KEY = "_folded"
+# Marks a deleted document (a tombstone) until the table is compacted
+DELETED_KEY = "_deleted"
+# Version of the schema a document was written with, see `SchemaMigration`
+SCHEMA_KEY = "_schema"
+
+_NON_DIGITS = re.compile(r"[^0-9]")
+
+
+def search_key(value: Any) -> str:
+    """Normalizes `value` for case insensitive comparisons: Unicode normalized (NFKC),
+    casefolded and without surrounding whitespace."""
+    if value is None:
+        return ""
+    return unicodedata.normalize("NFKC", str(value)).casefold().strip()
+
+
+def phone_digits(value: Any) -> str:
+    """Normalizes a phone number to its digits only, e.g. "+1 555-0100" -> "15550100"."""
+    if value is None:
+        return ""
+    return _NON_DIGITS.sub("", str(value))
+
+
+_SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"),
+    **dict.fromkeys("cgjkqsxz", "2"),
+    **dict.fromkeys("dt", "3"),
+    "l": "4",
+    **dict.fromkeys("mn", "5"),
+    "r": "6",
+}
+
+
+def soundex(value: Any) -> str:
+    """American Soundex code of the first word of `value`, e.g. both "Clarice" and
+    "Clarisse" are "C462". Accents are ignored, "Élodie" is "Elodie". Returns an empty
+    string if there are no letters."""
+    words = str(value or "").split()
+    # Decomposed, accented letters are the letter followed by combining marks, which are
+    # dropped with the other characters that aren't letters
+    word = unicodedata.normalize("NFKD", words[0] if words else "")
+    letters = [c for c in word.casefold() if "a" <= c <= "z"]
+    if not letters:
+        return ""
+    code = letters[0].upper()
+    previous = _SOUNDEX_CODES.get(letters[0], "")
+    for letter in letters[1:]:
+        digit = _SOUNDEX_CODES.get(letter, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        # "h" and "w" don't separate letters with the same code, vowels do
+        if letter not in "hw":
+            previous = digit
+    return code.ljust(4, "0")
+
+
+def phonetic_codes(value: Any) -> frozenset[str]:
+    """Soundex codes of every word of `value`."""
+    return frozenset(code for code in map(soundex, str(value or "").split()) if code)
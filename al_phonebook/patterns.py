@@ -0,0 +1,55 @@
+import re
+from functools import lru_cache
+from typing import Any, Sequence
+
+try:
+    from re import _parser as sre_parse  # type: ignore # Python 3.11+
+except ImportError:
+    import sre_parse
+
+# Parsed regex opcodes that are always part of a match. Anything else (alternatives,
+# optional repeats, classes, anchors...) interrupts a run of required literal characters.
+_LITERAL = sre_parse.LITERAL
+_SUBPATTERN = sre_parse.SUBPATTERN
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+
+def _required_literals(parsed: Any, literals: list[str]) -> None:
+    run: list[str] = []
+
+    def flush() -> None:
+        if run:
+            literals.append("".join(run))
+            run.clear()
+
+    for op, value in parsed:
+        if op == _LITERAL:
+            run.append(chr(value))
+            continue
+        flush()
+        if op == _SUBPATTERN:
+            # (group, add flags, del flags, pattern). Literals of a case insensitive group,
+            # e.g. `(?i:abc)`, may be found in another case
+            if not value[1] & re.IGNORECASE:
+                _required_literals(value[-1], literals)
+        elif op in _REPEATS and value[0] >= 1:
+            _required_literals(value[2], literals)
+    flush()
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern: str) -> tuple[re.Pattern, Sequence[str]]:
+    """Compiles `pattern` and extracts the literal substrings every match must contain,
+    longest first, e.g. `^[a-z]+@al\\.com$` -> ("@al.com",). Cached, so each pattern is only
+    compiled and analysed once.
+
+    No literals are extracted from case insensitive patterns or groups.
+
+    :raises re.error: If `pattern` isn't a valid regular expression.
+    """
+    compiled = re.compile(pattern)
+    if compiled.flags & re.IGNORECASE:
+        return compiled, ()
+    literals: list[str] = []
+    _required_literals(sre_parse.parse(pattern), literals)
+    return compiled, tuple(sorted(dict.fromkeys(literals), key=len, reverse=True))
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Optional, Sequence
+
+from .types import DictItem
+
+
+def sidecar_path(database_path: Path, suffix: str) -> Path:
+    """Path of a file stored next to the database, e.g. `.alpb.json` -> `.alpb.json.indexes`."""
+    return database_path.with_name(database_path.name + suffix)
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """Writes `data` to a temporary file first and then replaces `path`, so readers never
+    see a partially written file."""
+    temporary = path.with_name(path.name + ".tmp")
+    with temporary.open("wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def file_stamp(path: Path) -> Optional[DictItem]:
+    """Identifies the current content of the file in `path` by its inode, size and
+    modification time, or `None` if it doesn't exist. Databases are written to a new file
+    replacing the old one, so every write gives a new stamp without reading the file."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return {"inode": stat.st_ino, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def index_file_name(table: str, kind: str, field: str) -> str:
+    """Name of the file storing an index. Table names are chosen by users, hashing them keeps
+    any character out of file names."""
+    key = json.dumps([table, kind, field]).encode()
+    return hashlib.sha256(key).hexdigest()[:24] + ".json"
+
+
+class IndexStore:
+    """Persists the indexes of a database in a sidecar directory next to it, so they don't
+    have to be rebuilt from every document each time the database is opened. Every index is
+    a file of its own, so using one of them, e.g. to complete names, only reads that one.
+
+    The stored indexes are tied to the `file_stamp` of the database file in a manifest. If
+    the database was changed without updating them (or the indexes configured changed), they
+    are considered stale and ignored.
+    """
+
+    SUFFIX = ".indexes"
+    MANIFEST = "manifest.json"
+
+    def __init__(self, database_path: Path) -> None:
+        self.database_path = database_path
+        self.path = sidecar_path(database_path, self.SUFFIX)
+
+    def load(self, spec: Sequence[Sequence[str]]) -> set[str]:
+        """Returns the names of the tables whose indexes are stored. Returns an empty set if
+        the manifest is missing, unreadable or stale."""
+        try:
+            stored = json.loads((self.path / self.MANIFEST).read_bytes())
+        except (OSError, ValueError):
+            return set()
+        if stored.get("spec") != spec or stored.get("stamp") != file_stamp(self.database_path):
+            return set()
+        return set(stored.get("tables", ()))
+
+    def load_index(self, table: str, kind: str, field: str) -> Optional[DictItem]:
+        """Returns the stored data of a single index of `table`, `None` if it's unreadable."""
+        try:
+            data: DictItem = json.loads((self.path / index_file_name(table, kind, field)).read_bytes())
+        except (OSError, ValueError):
+            return None
+        return data
+
+    def save(
+        self, spec: Sequence[Sequence[str]], tables: dict[str, list[DictItem]], kept: Iterable[str]
+    ) -> Optional[DictItem]:
+        """Stores the indexes of `tables`, as returned by `IndexSet.dump`, together with the
+        current stamp of the database, which is returned. The stored indexes of the tables in
+        `kept` are still valid and kept as they are, the others are removed. Must be called
+        after the database was written."""
+        if self.path.is_file():
+            # Written by an older version, as a single file
+            self.path.unlink()
+        self.path.mkdir(exist_ok=True)
+        names = {*kept, *tables}
+        for name, indexes in tables.items():
+            for index in indexes:
+                write_atomic(
+                    self.path / index_file_name(name, index["kind"], index["field"]),
+                    json.dumps(index["data"]).encode(),
+                )
+        stamp = file_stamp(self.database_path)
+        manifest = {"spec": spec, "stamp": stamp, "tables": sorted(names)}
+        write_atomic(self.path / self.MANIFEST, json.dumps(manifest).encode())
+        used = {index_file_name(name, kind, field) for name in names for kind, field in spec}
+        for file in self.path.glob("*.json"):
+            if file.name != self.MANIFEST and file.name not in used:
+                file.unlink(missing_ok=True)
+        return stamp
@@ -0,0 +1,123 @@
+import heapq
+import pickle
+import tempfile
+from itertools import islice
+from typing import IO, Any, Callable, Iterable, Iterator, Mapping, Optional, Sequence, TypeVar, Union
+
+from .normalize import search_key
+
+# How many entries are sorted in memory at once. Larger results are sorted in runs of this
+# size spilled to temporary files and merged.
+RUN_SIZE = 10_000
+
+T = TypeVar("T", bound=Mapping)
+# (field, descending) pairs
+Order = Sequence[tuple[str, bool]]
+
+
+class SortError(Exception):
+    pass
+
+
+class Descending:
+    """Wraps a value so it sorts in the opposite order."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+    def __lt__(self, other: "Descending") -> bool:
+        return bool(other.value < self.value)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Descending) and self.value == other.value
+
+
+def parse_order(order_by: Union[str, Sequence[str]], fields: Optional[Iterable[str]] = None) -> Order:
+    """Parses `order_by`, field names separated by commas or a sequence of them, e.g.
+    `name,-age`. A `-` before a field sorts it in descending order.
+
+    :raises SortError: If a field is empty or isn't one of `fields`, when given."""
+    names = order_by.split(",") if isinstance(order_by, str) else order_by
+    known = set(fields) if fields is not None else None
+    order = []
+    for name in names:
+        name = name.strip()
+        descending = name.startswith("-")
+        field = name.lstrip("-")
+        if not field:
+            raise SortError(f"Invalid sort order {order_by}.")
+        if known is not None and field not in known:
+            raise SortError(f"Can't sort by {field}, it isn't a field. Fields are: {', '.join(sorted(known))}.")
+        order.append((field, descending))
+    return order
+
+
+def sort_key(order: Order) -> Callable[[Mapping], tuple]:
+    """Key sorting entries by `order`. Strings are compared ignoring case, like they are
+    searched, and entries missing a value always come last."""
+
+    def key(entry: Mapping) -> tuple:
+        parts = []
+        for field, descending in order:
+            value = entry.get(field)
+            if isinstance(value, str):
+                value = search_key(value)
+            missing = value is None or value == ""
+            # Values are only compared when both are present
+            value = 0 if missing else value
+            parts.append((missing, Descending(value) if descending else value))
+        return tuple(parts)
+
+    return key
+
+
+def sort_in_memory(entries: Iterable[T], order: Order, limit: Optional[int] = None) -> list[T]:
+    """Sorts `entries` by `order` and keeps the first `limit`. For entries already held in
+    memory, e.g. a list returned by a database, where spilling runs wouldn't save any."""
+    key = sort_key(order)
+    if limit is not None:
+        return heapq.nsmallest(limit, entries, key=key)
+    return sorted(entries, key=key)
+
+
+def sort_entries(
+    entries: Iterable[T], order: Order, limit: Optional[int] = None, run_size: int = RUN_SIZE
+) -> Iterator[T]:
+    """Sorts `entries` by `order` keeping at most `run_size` entries in memory at once.
+
+    With a `limit`, only the first `limit` entries are kept in a heap. Otherwise, sorted runs
+    of `run_size` entries are spilled to temporary files and merged as they are read back."""
+    if limit is not None:
+        return iter(sort_in_memory(entries, order, limit))
+    key = sort_key(order)
+    iterator = iter(entries)
+    run = sorted(islice(iterator, run_size), key=key)
+    if len(run) < run_size:
+        return iter(run)
+    files = [_spill(run)]
+    del run
+    while True:
+        run = sorted(islice(iterator, run_size), key=key)
+        if not run:
+            break
+        files.append(_spill(run))
+    return heapq.merge(*(_read_run(f) for f in files), key=key)
+
+
+def _spill(run: Sequence[T]) -> IO[bytes]:
+    f = tempfile.TemporaryFile(prefix="al_phonebook-sort-")
+    for entry in run:
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def _read_run(f: IO[bytes]) -> Iterator[Any]:
+    with f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
@@ -0,0 +1,290 @@
+import functools
+import gzip
+import json
+import os
+import struct
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from tinydb.storages import Storage
+
+from .types import DictItem, PathLike
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+GZIP_SUFFIX = ".gz"
+# Tag and content of the values of `BinarySerializer`
+_INT = struct.Struct("<cq")
+_FLOAT = struct.Struct("<cd")
+_SIZE = struct.Struct("<cI")
+_INT64_MIN, _INT64_MAX = -(2**63), 2**63 - 1
+# Format the database files are written in unless configured otherwise
+DEFAULT_FORMAT = "json"
+
+
+class StorageFormatError(Exception):
+    pass
+
+
+class Serializer(ABC):
+    """Encodes the raw data of every table of the database to bytes and back."""
+
+    name: str
+
+    @abstractmethod
+    def dumps(self, data: DictItem) -> bytes:
+        pass
+
+    @abstractmethod
+    def loads(self, raw: bytes) -> DictItem:
+        """:raises ValueError: If `raw` isn't valid, e.g. a partially written file."""
+
+
+class JSONSerializer(Serializer):
+    name = "json"
+
+    def dumps(self, data: DictItem) -> bytes:
+        return json.dumps(data).encode("utf-8")
+
+    def loads(self, raw: bytes) -> DictItem:
+        data: DictItem = json.loads(raw)
+        return data
+
+
+class OrjsonSerializer(Serializer):
+    """Same files as `JSONSerializer`, encoded and decoded several times faster by `orjson`,
+    if it's installed (`pip install al_phonebook[fast]`)."""
+
+    name = "orjson"
+
+    def __init__(self) -> None:
+        if orjson is None:
+            raise StorageFormatError("The orjson format needs orjson: pip install orjson")
+
+    def dumps(self, data: DictItem) -> bytes:
+        # Document ids are strings already, `OPT_NON_STR_KEYS` is only a safety net
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, raw: bytes) -> DictItem:
+        data: DictItem = orjson.loads(raw)
+        return data
+
+
+class BinarySerializer(Serializer):
+    """Binary encoding of the builtin types documents are made of. The format is fixed and
+    versioned, so files stay readable whatever the Python version, and decoding only ever
+    builds these types. Files start with `MAGIC` so they can be told apart from json ones,
+    followed by the `VERSION` of the format.
+
+    Every value is a one byte tag followed by its content, little endian:
+
+    * `N`, `T`, `F`: None, True, False.
+    * `i`: a signed 64 bits integer, `I`: a larger one as a `s` decimal string.
+    * `d`: a 64 bits float.
+    * `s`: the unsigned 32 bits length of the utf-8 string, then the string.
+    * `l`: the unsigned 32 bits number of items of the list, then the items.
+    * `m`: the unsigned 32 bits number of keys of the dict, then each key and value.
+
+    Tuples are written as lists, like json does.
+    """
+
+    name = "binary"
+    MAGIC = b"ALPB"
+    VERSION = 2
+
+    def dumps(self, data: DictItem) -> bytes:
+        parts = [self.MAGIC, bytes([self.VERSION])]
+        self._encode(data, parts)
+        return b"".join(parts)
+
+    def loads(self, raw: bytes) -> DictItem:
+        if not raw.startswith(self.MAGIC):
+            raise ValueError("Not a binary database file.")
+        version = raw[len(self.MAGIC) : len(self.MAGIC) + 1]
+        if version != bytes([self.VERSION]):
+            raise ValueError(f"Unsupported binary database version {version!r}.")
+        try:
+            data, end = self._decode(raw, len(self.MAGIC) + 1)
+        except (struct.error, IndexError, UnicodeDecodeError, RecursionError) as e:
+            raise ValueError(f"Corrupted binary database file: {e!r}") from e
+        if end != len(raw) or not isinstance(data, dict):
+            raise ValueError("Corrupted binary database file.")
+        return data
+
+    def _encode(self, value: Any, parts: list[bytes]) -> None:
+        if value is None:
+            parts.append(b"N")
+        elif value is True:
+            parts.append(b"T")
+        elif value is False:
+            parts.append(b"F")
+        elif isinstance(value, int):
+            if _INT64_MIN <= value <= _INT64_MAX:
+                parts.append(_INT.pack(b"i", value))
+            else:
+                parts.append(b"I")
+                self._encode(str(value), parts)
+        elif isinstance(value, float):
+            parts.append(_FLOAT.pack(b"d", value))
+        elif isinstance(value, str):
+            encoded = value.encode("utf-8")
+            parts.append(_SIZE.pack(b"s", len(encoded)))
+            parts.append(encoded)
+        elif isinstance(value, (list, tuple)):
+            parts.append(_SIZE.pack(b"l", len(value)))
+            for item in value:
+                self._encode(item, parts)
+        elif isinstance(value, dict):
+            parts.append(_SIZE.pack(b"m", len(value)))
+            for key, item in value.items():
+                self._encode(key, parts)
+                self._encode(item, parts)
+        else:
+            raise TypeError(f"Can't store {type(value).__name__} values in a binary database.")
+
+    def _decode(self, raw: bytes, position: int) -> tuple[Any, int]:
+        """Returns the value starting at `position` of `raw` and the position after it."""
+        tag = raw[position : position + 1]
+        if tag == b"N":
+            return None, position + 1
+        if tag == b"T":
+            return True, position + 1
+        if tag == b"F":
+            return False, position + 1
+        if tag == b"i":
+            return _INT.unpack_from(raw, position)[1], position + _INT.size
+        if tag == b"I":
+            digits, end = self._decode(raw, position + 1)
+            return int(digits), end
+        if tag == b"d":
+            return _FLOAT.unpack_from(raw, position)[1], position + _FLOAT.size
+        if tag not in (b"s", b"l", b"m"):
+            raise ValueError(f"Corrupted binary database file: unknown tag {tag!r}.")
+        size = _SIZE.unpack_from(raw, position)[1]
+        position += _SIZE.size
+        if tag == b"s":
+            end = position + size
+            if end > len(raw):
+                raise ValueError("Corrupted binary database file: truncated string.")
+            return raw[position:end].decode("utf-8"), end
+        if tag == b"l":
+            items = []
+            for _ in range(size):
+                item, position = self._decode(raw, position)
+                items.append(item)
+            return items, position
+        mapping = {}
+        for _ in range(size):
+            key, position = self._decode(raw, position)
+            mapping[key], position = self._decode(raw, position)
+        return mapping, position
+
+
+SERIALIZERS: dict[str, type[Serializer]] = {
+    serializer.name: serializer
+    for serializer in (JSONSerializer, OrjsonSerializer, BinarySerializer)
+}
+
+
+def get_serializer(name: str) -> Serializer:
+    """:raises StorageFormatError: If there's no format `name` or it can't be used here."""
+    try:
+        serializer = SERIALIZERS[name]
+    except KeyError:
+        raise StorageFormatError(
+            f"Unknown storage format {name}. Supported formats are: {', '.join(SERIALIZERS)}."
+        )
+    return serializer()
+
+
+def detect_serializer(raw: bytes) -> Serializer:
+    """The serializer able to decode `raw`. Any format can be read whatever the configured one
+    is, so changing it doesn't make existing databases unreadable."""
+    if raw.startswith(BinarySerializer.MAGIC):
+        return BinarySerializer()
+    return OrjsonSerializer() if orjson is not None else JSONSerializer()
+
+
+class SerializedStorage(Storage):
+    """Stores the database in `path` encoded by `serializer`, gzip compressed if `compressed`.
+    Contacts are mostly the same keys repeated, so they compress well, which matters when
+    reading the file is slow (e.g. network drives). Files are read in whatever format they
+    were written, told by their leading bytes, writes use `serializer`.
+
+    Compressed files are decompressed as they are read, without reading the compressed file
+    into memory first. Writes replace the file at once, so readers never see a partially
+    written file."""
+
+    def __init__(
+        self, path: PathLike, serializer: Serializer, compressed: bool = False, **kwargs: Any
+    ) -> None:
+        super().__init__()
+        self.path = Path(path)
+        self.serializer = serializer
+        self.compressed = compressed
+        # Creates a missing file, unlike `touch` an existing one keeps its modification time
+        self.path.open("ab").close()
+
+    def read(self) -> Optional[DictItem]:
+        if not self.path.stat().st_size:
+            # Empty file, TinyDB initializes the database
+            return None
+        with gzip.open(self.path) if self.compressed else self.path.open("rb") as f:
+            raw = f.read()
+        return detect_serializer(raw).loads(raw)
+
+    def write(self, data: DictItem) -> None:
+        raw = self.serializer.dumps(data)
+        if self.compressed:
+            raw = gzip.compress(raw)
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        temporary.write_bytes(raw)
+        os.replace(temporary, self.path)
+
+    def close(self) -> None:
+        pass
+
+
+def stored_size(path: PathLike) -> int:
+    """Size of the data in `path` once decompressed. gzip files end with it, modulo 4GB."""
+    path = Path(path)
+    if not is_compressed(path):
+        return path.stat().st_size
+    with path.open("rb") as f:
+        if f.seek(0, os.SEEK_END) < 4:
+            return 0
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), "little")
+
+
+def is_compressed(path: PathLike) -> bool:
+    """Whether the database in `path` is stored compressed, decided by its suffix: `.json.gz`."""
+    return str(path).endswith(".json" + GZIP_SUFFIX)
+
+
+def storage_class(path: PathLike, storage_format: str = DEFAULT_FORMAT) -> Callable[..., Storage]:
+    """The TinyDB storage for a database in `path` written in `storage_format`. The file is
+    read in whatever format it's in, e.g. after `convert_storage`, whatever `storage_format` is.
+
+    :raises StorageFormatError: If `storage_format` isn't one of `SERIALIZERS` or can't be used."""
+    return functools.partial(
+        SerializedStorage,
+        serializer=get_serializer(storage_format),
+        compressed=is_compressed(path),
+    )
+
+
+def convert_storage(path: PathLike, storage_format: str) -> int:
+    """Rewrites the database in `path` in `storage_format`, whatever format it's in now.
+    Returns the size of the file written.
+
+    :raises StorageFormatError: If `storage_format` isn't one of `SERIALIZERS` or can't be used."""
+    path = Path(path)
+    serializer = get_serializer(storage_format)
+    storage = SerializedStorage(path, serializer, compressed=is_compressed(path))
+    storage.write(storage.read() or {})
+    return path.stat().st_size
@@ -0,0 +1,94 @@
+import random
+from typing import Type
+
+from hypothesis import HealthCheck, Phase, given, settings
+from hypothesis import strategies as st
+from pydantic import BaseModel, EmailStr, ValidationError
+from pydantic.fields import ModelField
+from pydantic.types import ConstrainedInt, ConstrainedStr
+
+from al_phonebook.types import DictItem
+
+
+def field_strategy(name: str, field: ModelField) -> st.SearchStrategy:
+    """Hypothesis strategy for the values of a pydantic `field`, following its constraints."""
+    type_ = field.type_
+    if issubclass(type_, EmailStr):
+        strategy = st.emails()
+    elif "phone" in name:
+        strategy = st.from_regex(r"\+?[0-9]{8,14}", fullmatch=True)
+    elif issubclass(type_, ConstrainedStr) or issubclass(type_, str):
+        strategy = st.text(
+            min_size=getattr(type_, "min_length", None) or 5,
+            max_size=getattr(type_, "max_length", None) or 100,
+        )
+    elif issubclass(type_, ConstrainedInt):
+        low = type_.ge if type_.ge is not None else (type_.gt + 1 if type_.gt is not None else 1)
+        high = type_.le if type_.le is not None else (type_.lt - 1 if type_.lt is not None else 120)
+        strategy = st.integers(min_value=low, max_value=high)
+    elif issubclass(type_, bool):
+        strategy = st.booleans()
+    elif issubclass(type_, int):
+        strategy = st.integers(min_value=0, max_value=10**6)
+    elif issubclass(type_, float):
+        strategy = st.floats(min_value=0, max_value=10**6, allow_nan=False)
+    else:
+        strategy = st.from_type(type_)
+    return strategy if field.required else st.none() | strategy
+
+
+def contact_strategy(schema: Type[BaseModel]) -> st.SearchStrategy:
+    """Hypothesis strategy for contacts of `schema`, e.g. `Item` or a custom model."""
+    return st.fixed_dictionaries(
+        {name: field_strategy(name, field) for name, field in schema.__fields__.items()}
+    )
+
+
+def sample_pool(schema: Type[BaseModel], size: int) -> list[DictItem]:
+    """Draws `size` valid contacts of `schema` with hypothesis. Drawing is slow (milliseconds
+    per contact), so large datasets are built by `generate` from a small pool."""
+    pool: list[DictItem] = []
+
+    @settings(
+        max_examples=size,
+        database=None,
+        deadline=None,
+        phases=[Phase.generate],
+        suppress_health_check=list(HealthCheck),
+    )
+    @given(contact_strategy(schema))
+    def draw(contact: DictItem) -> None:
+        try:
+            pool.append(schema(**contact).dict())
+        except ValidationError:
+            pass
+
+    draw()
+    return pool
+
+
+def generate(
+    schema: Type[BaseModel],
+    size: int,
+    workspaces: int = 3,
+    pool_size: int = 500,
+    seed: int = 0,
+) -> dict[str, list[DictItem]]:
+    """Generates `size` contacts of `schema` spread over `workspaces` workspaces.
+
+    Each field of a contact is taken from a random contact of a pool drawn with hypothesis,
+    so the dataset has far more distinct contacts than the pool. Names get a unique suffix.
+    The same `seed` gives the same layout.
+    """
+    pool = sample_pool(schema, pool_size)
+    fields = list(schema.__fields__)
+    rng = random.Random(seed)
+    dataset: dict[str, list[DictItem]] = {f"workspace_{i}": [] for i in range(workspaces)}
+    names = list(dataset)
+    for i in range(size):
+        contact = {field: rng.choice(pool)[field] for field in fields}
+        if isinstance(contact.get("name"), str):
+            suffix = f" {i}"
+            contact["name"] = contact["name"][: 100 - len(suffix)].strip() + suffix
+        dataset[names[i % workspaces]].append(contact)
+    return dataset
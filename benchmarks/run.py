@@ -0,0 +1,193 @@
+"""Times the main `Model` operations on synthetic datasets, against every `AbcDatabase` backend.
+
+    python -m benchmarks.run --sizes 10000 --sizes 100000 -o results.json
+    python -m benchmarks.run --sizes 10000 -o new.json --compare results.json
+"""
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional, Type
+
+import click
+import yaml
+from pydantic import BaseModel
+
+from al_phonebook.config import load_schema_py
+from al_phonebook.lib import AbcDatabase, Item, Model, TinyDBDatabase
+from al_phonebook.types import DictItem
+
+from .datasets import generate
+
+# Creates a backend storing its data in the given folder. Add new backends here.
+BACKENDS: dict[str, Callable[[Path], AbcDatabase]] = {
+    "tinydb": lambda folder: TinyDBDatabase(path=folder / "db.json"),
+    "tinydb-gzip": lambda folder: TinyDBDatabase(path=folder / "db.json.gz"),
+    "tinydb-binary": lambda folder: TinyDBDatabase(path=folder / "db.json", storage_format="binary"),
+    "tinydb-memory": lambda folder: TinyDBDatabase(path=None, in_memory=True),
+}
+
+# Slower than this ratio compared to the previous results is reported as a regression
+REGRESSION_RATIO = 1.2
+
+
+def timed(function: Callable[[], Any], repeat: int = 1) -> float:
+    """Best wall time of `repeat` runs of `function`, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def cli_startup(folder: Path, database: AbcDatabase) -> Optional[float]:
+    """Time to start the CLI with the benchmarked database configured, in a new process."""
+    database_path = getattr(database, "path", None)
+    if database_path is None:
+        return None
+    home = folder / "home"
+    settings = home / ".al_phonebook" / "settings.yaml"
+    settings.parent.mkdir(parents=True, exist_ok=True)
+    settings.write_text(yaml.dump({"database": {"path": str(database_path)}, "model": {}}))
+    environment = {**os.environ, "HOME": str(home)}
+    command = [sys.executable, "-m", "al_phonebook.main", "list-formatters"]
+    return timed(lambda: subprocess.run(command, env=environment, check=True, capture_output=True))
+
+
+def benchmark(
+    backend: str,
+    schema: Type[BaseModel],
+    dataset: dict[str, list[DictItem]],
+    operations: int,
+    repeat: int,
+    seed: int,
+) -> list[DictItem]:
+    rng = random.Random(seed)
+    results: list[DictItem] = []
+    size = sum(map(len, dataset.values()))
+
+    def record(operation: str, seconds: Optional[float], count: int = 1) -> None:
+        if seconds is None:
+            return
+        results.append(
+            {
+                "backend": backend,
+                "size": size,
+                "operation": operation,
+                "seconds": seconds,
+                "per_operation": seconds / count,
+                "count": count,
+            }
+        )
+        click.echo(f"{backend:>14} {size:>9} {operation:<16} {seconds:10.4f}s")
+
+    with tempfile.TemporaryDirectory() as folder:
+        model = Model(BACKENDS[backend](Path(folder)), custom_item_schema=schema)
+        ids: dict[str, list[int]] = {}
+
+        def add_items() -> None:
+            for workspace, contacts in dataset.items():
+                ids[workspace] = [*model.add_items(contacts, workspace=workspace)]
+
+        record("add_items", timed(add_items), size)
+
+        workspace = next(iter(dataset))
+        contacts = dataset[workspace]
+        samples = [rng.randrange(len(contacts)) for _ in range(operations)]
+        names = [contacts[i]["name"] for i in samples]
+
+        def filter_exact() -> None:
+            for name in names[:10]:
+                model.filter({"name": name}, workspace=workspace, exact=True)
+
+        def filter_fuzzy() -> None:
+            # The unique suffix of the name, found anywhere in it
+            for name in names[:10]:
+                model.filter({"name": name.rsplit(" ", 1)[-1]}, workspace=workspace)
+
+        def get() -> None:
+            for i in samples:
+                model.get(ids[workspace][i], workspace=workspace)
+
+        def update() -> None:
+            for i in samples:
+                model.update(ids[workspace][i], {"name": f"Updated {i}"}, workspace=workspace)
+
+        record("filter_exact", timed(filter_exact, repeat), 10)
+        record("filter_fuzzy", timed(filter_fuzzy, repeat), 10)
+        record("get", timed(get, repeat), operations)
+        record("update", timed(update), operations)
+        record("all", timed(lambda: [len(c) for c in model.all().values()], repeat))
+        record("cli_startup", cli_startup(Path(folder), model.database))
+    return results
+
+
+def compare(results: list[DictItem], previous: list[DictItem]) -> int:
+    """Prints how `results` compare to `previous` ones. Returns the number of regressions."""
+    before = {(r["backend"], r["size"], r["operation"]): r["per_operation"] for r in previous}
+    regressions = 0
+    for r in results:
+        old = before.get((r["backend"], r["size"], r["operation"]))
+        if not old:
+            continue
+        ratio = r["per_operation"] / old
+        flag = ""
+        if ratio > REGRESSION_RATIO:
+            flag = "  <-- regression"
+            regressions += 1
+        click.echo(f"{r['backend']:>14} {r['size']:>9} {r['operation']:<16} x{ratio:6.2f}{flag}")
+    return regressions
+
+
+@click.command()
+@click.option("--sizes", multiple=True, type=int, default=[10_000], help="Number of contacts. Can be repeated, e.g. --sizes 10000 --sizes 1000000.")
+@click.option("--workspaces", default=3, type=click.IntRange(1), help="Workspaces the contacts are spread over.")
+@click.option("-b", "--backend", "backends", multiple=True, type=click.Choice([*BACKENDS]), help="Backends benchmarked. All by default.")
+@click.option("--schema", type=click.Path(exists=True, dir_okay=False), help="A .py file with a custom `Item` model.")
+@click.option("--operations", default=100, type=click.IntRange(1), help="How many `get` and `update` calls are timed.")
+@click.option("--repeat", default=3, type=click.IntRange(1), help="Read operations are timed this many times, the best is kept.")
+@click.option("--pool", default=500, type=click.IntRange(1), help="How many contacts are drawn with hypothesis to build the datasets.")
+@click.option("--seed", default=0, type=int)
+@click.option("-o", "--output", type=click.Path(dir_okay=False, writable=True), help="Writes the results to this json file.")
+@click.option("--compare", "previous", type=click.Path(exists=True, dir_okay=False), help="Results of a previous run to compare with.")
+def main(
+    sizes: tuple[int, ...],
+    workspaces: int,
+    backends: tuple[str, ...],
+    schema: Optional[str],
+    operations: int,
+    repeat: int,
+    pool: int,
+    seed: int,
+    output: Optional[str],
+    previous: Optional[str],
+) -> None:
+    item_schema = load_schema_py(schema) if schema else Item
+    results: list[DictItem] = []
+    for size in sizes:
+        dataset = generate(item_schema, size, workspaces=workspaces, pool_size=pool, seed=seed)
+        for backend in backends or BACKENDS:
+            results += benchmark(backend, item_schema, dataset, operations, repeat, seed)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "schema": schema or "Item",
+        "results": results,
+    }
+    if output:
+        Path(output).write_text(json.dumps(report, indent=4))
+    if previous:
+        regressions = compare(results, json.loads(Path(previous).read_text())["results"])
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
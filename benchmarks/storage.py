@@ -0,0 +1,73 @@
+"""Compares the size on disk and the time to open (read) a database in every storage format,
+plain and gzip compressed.
+
+    python -m benchmarks.storage --sizes 10000 --sizes 100000 -o storage.json
+"""
+import json
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import click
+
+from al_phonebook.lib import Item, Model, TinyDBDatabase
+from al_phonebook.storages import SERIALIZERS, orjson
+from al_phonebook.types import DictItem
+
+from .datasets import generate
+from .run import timed
+
+SUFFIXES = (".json", ".json.gz")
+# orjson is optional
+FORMATS = [name for name in SERIALIZERS if name != "orjson" or orjson is not None]
+
+
+def benchmark(size: int, workspaces: int, pool: int, repeat: int) -> list[DictItem]:
+    dataset = generate(Item, size, workspaces=workspaces, pool_size=pool)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for storage_format in FORMATS:
+            for suffix in SUFFIXES:
+                results.append(
+                    run(Path(folder) / f"{storage_format}{suffix}", storage_format, dataset, repeat)
+                )
+    return results
+
+
+def run(path: Path, storage_format: str, dataset: dict[str, list[DictItem]], repeat: int) -> DictItem:
+    size = sum(len(contacts) for contacts in dataset.values())
+    model = Model(TinyDBDatabase(path=path, storage_format=storage_format))
+    write = timed(lambda: [model.add_items(c, workspace=w) for w, c in dataset.items()])
+    # Opening reads and decodes the whole file on the first access
+    open_ = timed(
+        lambda: TinyDBDatabase(path=path, storage_format=storage_format).db.tables(), repeat
+    )
+    result = {
+        "format": storage_format,
+        "compressed": path.suffix == ".gz",
+        "size": size,
+        "bytes": path.stat().st_size,
+        "open_seconds": open_,
+        "write_seconds": write,
+    }
+    click.echo(
+        f"{path.name:>16} {size:>9} {result['bytes']:>12} bytes "
+        f"open {open_:8.4f}s write {write:8.4f}s"
+    )
+    return result
+
+
+@click.command()
+@click.option("--sizes", multiple=True, type=int, default=[10_000], help="Number of contacts. Can be repeated.")
+@click.option("--workspaces", default=3, type=click.IntRange(1))
+@click.option("--pool", default=500, type=click.IntRange(1), help="How many contacts are drawn with hypothesis to build the datasets.")
+@click.option("--repeat", default=3, type=click.IntRange(1), help="Opening is timed this many times, the best is kept.")
+@click.option("-o", "--output", type=click.Path(dir_okay=False, writable=True), help="Writes the results to this json file.")
+def main(sizes: tuple[int, ...], workspaces: int, pool: int, repeat: int, output: Optional[str]) -> None:
+    results = [r for size in sizes for r in benchmark(size, workspaces, pool, repeat)]
+    if output:
+        Path(output).write_text(json.dumps({"results": results}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@ from typing import Sequence
 
 class TinyDBTest(TinyDBDatabase):
     def __init__(self) -> None:
-        self.db = super().get_database(path=None, in_memory=True)
+        super().__init__(path=None, in_memory=True, indexed_fields=("age",))
 
 def test_tiny_db():
     return TinyDBTest()
@@ -1,8 +1,17 @@
+import json
+import tempfile
+from pathlib import Path
+
 import pytest
+from click.shell_completion import ShellComplete
 from click.testing import CliRunner
-from al_phonebook.cli import search
-from al_phonebook.lib import Model
+from al_phonebook.cli import (backup, cli, convert_storage, dedupe, migrate, restore,
+                              search, stats)
+from al_phonebook.federated import FederatedDatabase, Source
+from al_phonebook.lib import Item, Model, TinyDBDatabase
+from pydantic import create_model
 import click
+from .common import models
 
 
 def test_search(models_with_data) -> None:
@@ -11,3 +20,161 @@ def test_search(models_with_data) -> None:
         result = runner.invoke(search, ["name", "Clarisse"], obj=model)
         assert result.exit_code == 0 
         assert "Clarisse" in result.output
+
+
+def test_search_phonetic(models_with_data) -> None:
+    runner = CliRunner()
+    for model in models_with_data:
+        result = runner.invoke(search, ["name", "Clarice", "--mode", "phonetic"], obj=model)
+        assert result.exit_code == 0
+        assert "Clarisse" in result.output
+
+
+def test_search_regex(models_with_data) -> None:
+    runner = CliRunner()
+    for model in models_with_data:
+        result = runner.invoke(search, ["email", "^doug@", "--mode", "regex"], obj=model)
+        assert result.exit_code == 0
+        assert "Doug" in result.output and "Adam" not in result.output
+        result = runner.invoke(search, ["email", "(", "--mode", "regex"], obj=model)
+        assert "Invalid regular expression" in result.output
+
+
+def test_search_sort_and_limit(models_with_data) -> None:
+    runner = CliRunner()
+    for model in models_with_data:
+        result = runner.invoke(search, ["email", "al.com", "--sort", "-age", "--limit", "2"], obj=model)
+        assert result.exit_code == 0
+        assert result.output.index("Clarisse") < result.output.index("Bruce")
+        assert "Adam" not in result.output
+        result = runner.invoke(search, ["email", "al.com", "--sort", "height"], obj=model)
+        assert "Can't sort by height" in result.output
+
+
+def test_search_explain(models_with_data) -> None:
+    runner = CliRunner()
+    for model in models_with_data:
+        result = runner.invoke(search, ["name", "Cla", "--explain"], obj=model)
+        assert result.exit_code == 0
+        assert "Plan: full scan" in result.output
+        assert "scanned: 4, returned: 1" in result.output
+
+
+def test_search_shell_completion(models_with_data) -> None:
+    for model in models_with_data:
+        completion = ShellComplete(search, {"obj": model}, "search", "_COMPLETE")
+        fields = [c.value for c in completion.get_completions([], "na")]
+        values = [c.value for c in completion.get_completions(["name"], "Cl")]
+        assert fields == ["name"]
+        assert values == ["Clarisse"]
+
+
+def test_dedupe() -> None:
+    runner = CliRunner()
+    output = Path(tempfile.mkdtemp()) / "suggestions.json"
+    for model in models():
+        model.add_items([{"name": "Clarice", "email": "c@al.com"}, {"name": "Clarisse", "email": "c@al.com"}])
+        result = runner.invoke(dedupe, ["-o", str(output)], obj=model)
+        assert result.exit_code == 0
+        assert "Merge suggestions" in result.output
+        suggestions = json.loads(output.read_text())
+        assert [(s["id"], s["duplicate_id"]) for s in suggestions] == [(1, 2)]
+
+
+def test_stats(models_with_data_multiple_workspaces) -> None:
+    runner = CliRunner()
+    for model in models_with_data_multiple_workspaces:
+        result = runner.invoke(stats, ["-g", "age:10", "-m", "count", "-m", "avg:age"], obj=model)
+        assert result.exit_code == 0
+        assert "avg:age" in result.output
+        assert "31.5" in result.output
+
+
+def test_migrate(data) -> None:
+    runner = CliRunner()
+    for model in models():
+        model.add_items(d.dict() for d in data)
+        model.update_item_schema(
+            create_model("Item", company=(str, "ACME"), __base__=Item)
+        )
+        result = runner.invoke(migrate, ["--batch-size", "3"], obj=model)
+        assert result.exit_code == 0
+        assert "4 contacts migrated" in result.output
+        assert model.database._table().get(doc_id=4)["company"] == "ACME"
+
+
+def test_backup_and_restore(data) -> None:
+    runner = CliRunner()
+    folder = Path(tempfile.mkdtemp())
+    model = Model(TinyDBDatabase(path=folder / "db.json"))
+    model.add_items(d.dict() for d in data)
+    result = runner.invoke(backup, [str(folder / "backup")], obj=model)
+    assert "Saved all contacts" in result.output
+    model.update(1, {"age": 31})
+    result = runner.invoke(backup, [str(folder / "backup")], obj=model)
+    assert "Saved 1 changes" in result.output
+    result = runner.invoke(backup, [str(folder / "backup")], obj=model)
+    assert "Nothing changed" in result.output
+
+    model.update(1, {"age": 50})
+    result = runner.invoke(restore, [str(folder / "backup"), "--yes"], obj=model)
+    assert result.exit_code == 0
+    assert "up to change 5" in result.output
+    assert model.get(1).age == 31
+
+
+def test_convert_storage(data) -> None:
+    runner = CliRunner()
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    model = Model(TinyDBDatabase(path=path))
+    model.add_items(d.dict() for d in data)
+    result = runner.invoke(convert_storage, ["binary"], obj=model)
+    assert result.exit_code == 0
+    assert "binary format" in result.output
+    model.update(1, {"age": 31})
+    assert Model(TinyDBDatabase(path=path, storage_format="binary")).get(1).age == 31
+    # The format is detected when the configuration wasn't changed
+    assert Model(TinyDBDatabase(path=path)).get(1).age == 31
+    result = runner.invoke(convert_storage, ["xml"], obj=model)
+    assert result.exit_code != 0
+    federated = Model(FederatedDatabase([Source("a", model.database)]))
+    result = runner.invoke(convert_storage, ["binary"], obj=federated)
+    assert result.exit_code == 0
+    assert "can't be converted" in result.output
+
+
+def test_profile_and_metrics() -> None:
+    runner = CliRunner()
+    home = Path(tempfile.mkdtemp())
+    metrics = home / "metrics.json"
+    result = runner.invoke(
+        cli, ["--profile", "--metrics", str(metrics), "stats"], env={"HOME": str(home)}
+    )
+    assert result.exit_code == 0
+    assert "Time by operation" in result.output
+    assert "model.aggregate" in result.output
+    assert "model.aggregate" in json.loads(metrics.read_text())["operations"]
+
+
+def test_max_memory(data) -> None:
+    runner = CliRunner()
+    home = Path(tempfile.mkdtemp())
+    (home / ".al_phonebook").mkdir()
+    model = Model(TinyDBDatabase(path=home / ".al_phonebook" / ".alpb.json"))
+    model.add_items(d.dict() for d in data)
+    result = runner.invoke(
+        cli, ["--max-memory", "1K", "list", "--sort", "-age"], env={"HOME": str(home)}
+    )
+    assert result.exit_code == 0
+    assert result.output.index("Clarisse") < result.output.index("Adam")
+    assert "Peak memory" in result.output and "budget 1.0K" in result.output
+    result = runner.invoke(
+        cli, ["--max-memory", "1K", "search", "name", "a", "--limit", "1"], env={"HOME": str(home)}
+    )
+    assert "Adam" in result.output and "Clarisse" not in result.output
+    result = runner.invoke(
+        cli, ["--max-memory", "1K", "search", "name", "a", "--explain"], env={"HOME": str(home)}
+    )
+    assert "--explain can't be used" in result.output and "Adam" not in result.output
+    result = runner.invoke(cli, ["--max-memory", "lots", "list"], env={"HOME": str(home)})
+    assert result.exit_code != 0
@@ -1,12 +1,28 @@
 from configparser import ConfigParser
+import asyncio
+import json
 from json import load
 import os
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 from .common import models
 
 import pytest
-from al_phonebook.lib import DatabasePathError, Item, TinyDBDatabase
+from al_phonebook.aggregate import AggregationError
+from al_phonebook.async_model import AsyncModel
+from al_phonebook.backup import BackupError, backup, restore
+from al_phonebook.budget import parse_size
+from al_phonebook.changes import ChangeFeed
+from al_phonebook.collection import ItemCollection
+from al_phonebook.constants import FilterMode
+from al_phonebook.indexes import (BloomFilter, DigitTrie, FilterError, PrefixIndex,
+                                  Range, Regex, SortedIndex)
+from al_phonebook.lib import (DatabasePathError, Item, Model, TinyDBDatabase,
+                              case_insensitive_filter)
 from al_phonebook.config import (
     Configuration,
     ConfigurationError,
@@ -16,8 +32,18 @@ from al_phonebook.config import (
     create_item_model,
     default_plugin_folder
 )
+from al_phonebook.federated import FederatedDatabase, FederationError, Source
 from al_phonebook.formatter_registry import FormatterRegistry
+from al_phonebook.explain import SlowQueryLog
+from al_phonebook.metrics import METRICS
+from al_phonebook.migration import MigrationCheckpoint, MigrationError, schema_version
+from al_phonebook.normalize import soundex
+from al_phonebook.patterns import compile_pattern
+from al_phonebook.sidecar import IndexStore
+from al_phonebook.sorting import SortError, parse_order, sort_entries
+from al_phonebook.storages import BinarySerializer, StorageFormatError, orjson
 from hypothesis import strategies as st, given
+from pydantic import ValidationError, conint, create_model
 
 
 def test_start_tinydb_from_custom_path() -> None:
@@ -84,6 +110,24 @@ def test_list_all_items(models_with_data, data) -> None:
         assert model.all().get("personal") == [i.dict() for i in data]
 
 
+def test_all_items_compact_collection(models_with_data, data) -> None:
+    for model in models_with_data:
+        personal = model.all().get("personal")
+        assert isinstance(personal, ItemCollection)
+        assert len(personal) == len(data)
+        assert personal[-1] == data[-1]
+        assert personal[1:3] == [i.dict() for i in data[1:3]]
+        assert personal.memory_usage() > 0
+
+
+def test_filter_returns_collection_with_ids(models_with_data, data) -> None:
+    for model in models_with_data:
+        r = model.filter({"name": "a"})
+        assert isinstance(r, ItemCollection)
+        assert [i.id for i in r] == [1, 3]
+        assert r.row(0)["name"] == data[0].name
+
+
 def test_add_custom_fields() -> None:
     custom_fields = {
         "age": {"type": "integer"},
@@ -205,6 +249,365 @@ def test_filter_non_string_fields(data, models_with_data) -> None:
         assert r[0].name == data[3].name
 
 
+def test_range_filter(models_with_data, data) -> None:
+    for model in models_with_data:
+        assert [i.name for i in model.filter({"age": {"gt": 30, "lt": 60}})] == [
+            data[1].name,
+            data[3].name,
+        ]
+        assert [i.name for i in model.filter({"age": {"between": (30, 40)}})] == [
+            data[0].name,
+            data[1].name,
+            data[3].name,
+        ]
+        r = model.filter({"age": {"ge": 40}, "name": "Clar"})
+        assert [i.name for i in r] == [data[2].name]
+        # The tightest bound of each end is kept
+        assert model.filter({"age": {"gt": 20, "ge": 30, "lt": 34, "le": 33}}) == model.filter(
+            {"age": {"between": (30, 33)}}
+        )
+    assert Range.from_condition("age", {"gt": 30, "ge": 40}) == Range(40, None, True)
+    assert Range.from_condition("age", {"ge": 30, "gt": 30, "le": 50, "between": (0, 50)}) == Range(30, 50, False, True)
+    assert Range.from_condition("age", {"lt": 30, "le": 30}) == Range(None, 30)
+
+
+def test_range_filter_not_indexed(data) -> None:
+    m = Model(TinyDBDatabase(path=None, in_memory=True))
+    m.add_items(d.dict() for d in data)
+    assert [i.name for i in m.filter({"age": {"le": 33}})] == [data[0].name, data[3].name]
+
+
+def test_range_filter_invalid_operator(models_with_data) -> None:
+    for model in models_with_data:
+        with pytest.raises(FilterError):
+            model.filter({"age": {"around": 30}})
+        with pytest.raises(FilterError):
+            model.filter({"age": {"gt": "thirty"}})
+
+
+def test_sorted_index_maintained_on_writes() -> None:
+    for m in models():
+        first = m.add_item({"name": "Young", "age": 20})
+        m.filter({"age": {"gt": 0}})  # builds the index
+        m.add_item({"name": "Old", "age": 90})
+        m.update(first, {"age": 95})
+        assert [i.name for i in m.filter({"age": {"gt": 80}})] == ["Young", "Old"]
+        assert m.filter({"age": {"lt": 50}}) == []
+
+
+def test_index_build() -> None:
+    documents = [(i, {"age": age}) for i, age in enumerate([40, None, 30, 40, "x", 20], 1)]
+    built, added = SortedIndex("age"), SortedIndex("age")
+    built.build(documents)
+    for doc_id, document in documents:
+        added.add(doc_id, document)
+    assert built.dump() == added.dump() == {"keys": [20, 30, 40, 40], "doc_ids": [6, 3, 1, 4]}
+    built.build([(7, {"age": 30})])
+    assert built.doc_ids == [6, 3, 7, 1, 4]
+
+    names = [(i, {"name": name}) for i, name in enumerate(["bruce", "Adam", None, "adam", ""], 1)]
+    prefix, added_prefix = PrefixIndex("name"), PrefixIndex("name")
+    prefix.build(names)
+    for doc_id, document in names:
+        added_prefix.add(doc_id, document)
+    assert prefix.dump() == added_prefix.dump() == {"values": ["Adam", "adam", "bruce"], "doc_ids": [2, 4, 1]}
+
+
+def test_phone_number_normalized_match() -> None:
+    for m in models():
+        id = m.add_item({"name": "Phoned", "phone_number": "+1 555-0100"})
+        assert [i.id for i in m.filter({"phone_number": "15550100"}, exact=True)] == [id]
+        assert [i.id for i in m.filter({"phone_number": "555 01"})] == [id]
+        assert m.get(id).phone_number == "+1 555-0100"
+        assert "_digits" not in m.database.get(id)
+
+
+def test_phone_number_prefix_filter() -> None:
+    for m in models():
+        london = m.add_item({"name": "London", "phone_number": "+44 20 7946 000"})
+        m.add_item({"name": "Manchester", "phone_number": "+44 161 4960000"})
+        assert [i.id for i in m.filter({"phone_number": {"prefix": "+44 20"}})] == [london]
+        m.update(london, {"phone_number": "+44 161 4960001"})
+        assert m.filter({"phone_number": {"prefix": "4420"}}) == []
+        assert len(m.filter({"phone_number": {"prefix": "44161"}})) == 2
+
+
+def test_digit_trie() -> None:
+    trie = DigitTrie("phone_number")
+    trie.add(1, {"phone_number": "+44 20 1234"})
+    trie.add(2, {"phone_number": "4420 5678"})
+    trie.add(3, {"phone_number": "+1 555"})
+    assert sorted(trie.prefix("4420")) == [1, 2]
+    trie.remove(1, {"phone_number": "+44 20 1234"})
+    assert trie.prefix("4420") == [2]
+    assert trie.prefix("9") == []
+
+
+def test_complete(models_with_data, data) -> None:
+    for model in models_with_data:
+        assert model.complete("name", "cla") == [data[2].name]
+        assert model.complete("name", "", limit=2) == [data[0].name, data[1].name]
+        assert model.complete("email", "doug") == [data[3].email]
+
+
+def test_complete_after_writes() -> None:
+    for m in models():
+        m.add_items([{"name": "Vitor"}, {"name": "vicente"}, {"name": "Vitor"}])
+        assert m.complete("name", "vi") == ["vicente", "Vitor"]
+        id = m.add_item({"name": "Victoria"})
+        m.update(id, {"name": "Vivian"})
+        assert m.complete("name", "VI") == ["vicente", "Vitor", "Vivian"]
+        assert len(m.filter({"name": {"prefix": "vit"}})) == 2
+
+
+def test_indexes_persisted_next_to_database(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    m = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    m.add_items(d.dict() for d in data)
+    assert len(m.filter({"age": {"gt": 35}})) == 2
+
+    store = IndexStore(path)
+    assert store.path.exists()
+    spec = m.database._new_index_set().spec()
+    assert "personal" in store.load(spec)
+
+    reopened = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    reopened.add_item({"name": "Eve", "age": 70})
+    assert [i.name for i in reopened.filter({"age": {"gt": 50}})] == ["Clarisse", "Eve"]
+    assert reopened.complete("name", "e") == ["Eve"]
+    assert "personal" in store.load(spec)
+
+
+def test_complete_reads_only_its_index(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    m = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    m.add_items(d.dict() for d in data)
+    m.filter({"age": {"gt": 35}})
+
+    reopened = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    store = reopened.database._index_store
+    read = []
+    load_index = store.load_index
+    store.load_index = lambda *index: read.append(index) or load_index(*index)
+    reads = METRICS.latency["storage.read"].count
+    assert reopened.complete("name", "cl") == ["Clarisse"]
+    assert read == [("personal", "prefix", "name")]
+    assert METRICS.latency["storage.read"].count == reads
+    # Writes update every index, the others are read first
+    reopened.add_item({"name": "Clara", "age": 70})
+    assert len(read) == len(reopened.database._new_index_set().spec())
+    assert [i.name for i in Model(TinyDBDatabase(path=path, indexed_fields=("age",))).filter({"age": {"gt": 50}})] == ["Clarisse", "Clara"]
+
+
+def test_indexes_written_by_another_process(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    first = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    first.add_items(d.dict() for d in data)
+    assert len(first.filter({"age": {"gt": 35}})) == 2
+
+    second = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    second.update(1, {"age": 70})
+    # The indexes of `first` are stale, they mustn't be saved over the ones of `second`
+    first.update(2, {"age": 80})
+    for m in (first, Model(TinyDBDatabase(path=path, indexed_fields=("age",)))):
+        assert [i.name for i in m.filter({"age": {"gt": 65}})] == ["Adam", "Bruce"]
+
+
+def test_stale_indexes_are_rebuilt(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    m = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    m.add_items(d.dict() for d in data)
+    m.filter({"age": {"gt": 35}})
+    spec = m.database._new_index_set().spec()
+
+    # Written without going through `TinyDBDatabase`, so the stored indexes don't know about it
+    m.database.db.insert({"name": "Outsider", "age": 99})
+    assert IndexStore(path).load(spec) == set()
+
+    reopened = Model(TinyDBDatabase(path=path, indexed_fields=("age",)))
+    assert [i.name for i in reopened.filter({"age": {"gt": 90}})] == ["Outsider"]
+    assert "personal" in IndexStore(path).load(spec)
+
+
+def test_exists(models_with_data, data) -> None:
+    for model in models_with_data:
+        assert model.exists({"name": data[1].name})
+        assert model.exists({"name": data[1].name, "email": data[1].email})
+        assert not model.exists({"name": "bruce"})
+        assert not model.exists({"name": data[1].name, "email": data[0].email})
+        assert not model.exists({"email": data[3].email}, workspace="secondary")
+
+
+def test_exists_after_update() -> None:
+    for m in models():
+        id = m.add_item({"name": "Before"})
+        assert m.exists({"name": "Before"})
+        m.update(id, {"name": "After"})
+        assert m.exists({"name": "After"})
+        assert not m.exists({"name": "Before"})
+
+
+def test_bloom_filter_error_rate() -> None:
+    bloom = BloomFilter("name", error_rate=0.01, capacity=100)
+    for i in range(1000):
+        bloom.add(i, {"name": f"member-{i}"})
+    assert all(f"member-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"stranger-{i}" in bloom for i in range(10000))
+    assert false_positives < 100
+
+    restored = BloomFilter("name")
+    restored.load(bloom.dump())
+    assert "member-10" in restored
+
+
+def test_find_duplicates() -> None:
+    for m in models():
+        clarice = m.add_item({"name": "Clarice", "email": "clarisse@al.com"})
+        m.add_item({"name": "Bruce", "phone_number": "+1 555-0100"})
+        m.add_item({"name": "Someone Else", "email": "else@al.com"})
+        clarisse = m.add_item({"name": "Clarisse", "email": "CLARISSE@al.com"}, workspace="Work")
+        bruce = m.add_item({"name": "bruce", "phone_number": "15550100"}, workspace="Work")
+
+        suggestions = m.find_duplicates()
+        pairs = {
+            frozenset([(s.workspace, s.id), (s.duplicate_workspace, s.duplicate_id)])
+            for s in suggestions
+        }
+        assert pairs == {
+            frozenset([("personal", clarice), ("Work", clarisse)]),
+            frozenset([("personal", 2), ("Work", bruce)]),
+        }
+        assert all(0.6 <= s.score <= 1 for s in suggestions)
+        reasons = sorted(s.reasons for s in suggestions)
+        assert reasons == [["email", "name"], ["phone_number", "name"]]
+
+
+def test_find_duplicates_parallel() -> None:
+    for m in models():
+        m.add_items({"name": f"Person {i}", "email": f"person{i % 500}@al.com"} for i in range(1500))
+        sequential = m.find_duplicates(workers=1)
+        parallel = m.find_duplicates(workers=2)
+        assert len(sequential) >= 1000
+        assert sorted(s.dict().items() for s in sequential) == sorted(s.dict().items() for s in parallel)
+
+
+def test_soundex() -> None:
+    assert soundex("Clarice") == soundex("Clarisse") == "C462"
+    assert soundex("Robert") == soundex("Rupert") == "R163"
+    assert soundex("Ashcraft") == "A261"
+    assert soundex("Lee") == "L000"
+    assert soundex("Élodie") == soundex("Elodie") == "E430"
+    assert soundex("Müller") == soundex("Muller")
+    assert soundex("") == ""
+
+
+def test_phonetic_filter(models_with_data, data) -> None:
+    for model in models_with_data:
+        r = model.filter({"name": "Clarice"}, mode=FilterMode.PHONETIC)
+        assert [i.name for i in r] == [data[2].name]
+        assert model.filter({"name": "Clarice"}) == []
+
+
+def test_phonetic_filter_after_writes() -> None:
+    for m in models():
+        id = m.add_item({"name": "Catherine Smith"})
+        m.add_item({"name": "Kathryn Smyth"})
+        assert len(m.filter({"name": {"phonetic": "Smithe"}})) == 2
+        assert len(m.filter({"name": {"phonetic": "Catharine Smith"}})) == 1
+        m.update(id, {"name": "Robert"})
+        assert [i.name for i in m.filter({"name": "Rupert"}, mode="phonetic")] == ["Robert"]
+        assert [i.name for i in m.filter({"name": {"phonetic": "smith"}})] == ["Kathryn Smyth"]
+
+
+def test_phonetic_filter_not_indexed(data) -> None:
+    m = Model(TinyDBDatabase(path=None, in_memory=True, phonetic_fields=()))
+    m.add_items(d.dict() for d in data)
+    assert [i.name for i in m.filter({"name": "Clarise"}, mode=FilterMode.PHONETIC)] == ["Clarisse"]
+
+
+def test_compile_pattern() -> None:
+    assert compile_pattern(r"^[a-z]+@al\.com$")[1] == ("@al.com",)
+    assert compile_pattern("foo(bar|baz)qux")[1] == ("foo", "qux", "ba")
+    assert compile_pattern("(?i)abc")[1] == ()
+    assert compile_pattern("x(?i:bc)d")[1] == ("x", "d")
+    assert "ABC" in Regex("(?i:abc)")
+    assert "xBC" in Regex("x(?i:bc)")
+    assert "XBC" not in Regex("x(?i:bc)")
+
+
+def test_regex_filter(models_with_data, data) -> None:
+    for model in models_with_data:
+        r = model.filter({"email": {"regex": r"^(a|b)[a-z]+@al\.com$"}})
+        assert [i.name for i in r] == [data[0].name, data[1].name]
+        r = model.filter({"name": "^C.*e$"}, mode=FilterMode.REGEX)
+        assert [i.name for i in r] == [data[2].name]
+        assert model.filter({"age": {"regex": "3"}}) == []
+        with pytest.raises(FilterError):
+            model.filter({"name": {"regex": "(unclosed"}})
+
+
+def test_case_insensitive_search_keys() -> None:
+    for m in models():
+        id = m.add_item({"name": "  Straße Fiona ", "email": "Fiona@AL.com"})
+        stored = m.database._table().get(doc_id=id)
+        assert stored["_folded"]["name"] == "strasse fiona"
+        assert "_folded" not in m.get(id).dict()
+        assert "_folded" not in m.filter({"name": "fiona"}).row(0)
+
+        assert [i.id for i in m.filter({"name": "STRASSE"})] == [id]
+        assert [i.id for i in m.filter({"name": "ﬁona"})] == [id]
+        assert [i.id for i in m.filter({"email": "fiona@al"})] == [id]
+        m.update(id, {"email": "other@al.com"})
+        assert m.filter({"email": "fiona"}) == []
+
+
+def test_case_insensitive_legacy_documents() -> None:
+    for m in models():
+        # Written without the shadow keys, like documents from older versions
+        m.database._table().insert({"name": "Legacy Person"})
+        assert [i.name for i in m.filter({"name": "LEGACY"})] == ["Legacy Person"]
+        assert case_insensitive_filter("name", "legacy person ")({"name": "Legacy Person"})
+
+
+def test_count(models_with_data, data) -> None:
+    for model in models_with_data:
+        assert model.count() == model.count({}) == len(model.all()["personal"])
+        assert model.count({"age": {"gt": 35}}) == 2
+        assert model.count({"email": "al.com", "age": {"lt": 35}}) == 2
+        assert model.count({"name": "Bruce"}, exact=True) == 1
+        assert model.count(workspace="nothing here") == 0
+
+
+def test_aggregate(models_with_data_multiple_workspaces, data) -> None:
+    for model in models_with_data_multiple_workspaces:
+        assert model.aggregate() == [
+            {"workspace": "personal", "count": 3},
+            {"workspace": "secondary", "count": 2},
+        ]
+        assert model.aggregate(group_by=["email:domain"], metrics=["count", "max:age"]) == [
+            {"email:domain": "al.com", "count": 5, "max:age": 60},
+        ]
+        assert model.aggregate(group_by=["age:20"], metrics=["count", "avg:age"]) == [
+            {"age:20": 20, "count": 2, "avg:age": 31.5},
+            {"age:20": 40, "count": 1, "avg:age": 40},
+            {"age:20": 60, "count": 2, "avg:age": 60},
+        ]
+        r = model.aggregate(
+            group_by=["workspace"], metrics=["sum:age"], filters={"age": {"ge": 40}}, workspaces=["secondary"]
+        )
+        assert r == [{"workspace": "secondary", "sum:age": 60}]
+
+
+def test_aggregate_invalid() -> None:
+    for m in models():
+        with pytest.raises(AggregationError):
+            m.aggregate(group_by=["age:ten"])
+        with pytest.raises(AggregationError):
+            m.aggregate(metrics=["median:age"])
+        with pytest.raises(AggregationError):
+            m.aggregate(metrics=["avg"])
+
+
 @pytest.mark.skip("Feature not necessary for now, nice to have in the future.")
 def test_add_with_overwrite(data, models_with_data) -> None:
     assert False
@@ -218,6 +621,502 @@ def test_update(data) -> None:
         assert m.get(id).email == data[0].email
 
 
+def test_update_where(data) -> None:
+    for m in models():
+        m.add_items(d.dict() for d in data)
+        ids = m.update_where({"age": {"lt": 40}}, {"address": "Main St", "name": "Renamed"})
+        assert ids == [1, 4]
+        assert [i.id for i in m.filter({"address": "main"})] == ids
+        assert [i.id for i in m.filter({"name": "renamed"})] == ids
+        assert m.complete("name", "ren") == ["Renamed"]
+        assert m.update_where({"name": "nobody"}, {"address": "x"}) == []
+        with pytest.raises(ValidationError):
+            m.update_where({}, {"email": "invalid"})
+
+
+def test_delete_where_and_compact(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    for m in [*models(), Model(TinyDBDatabase(path=path, indexed_fields=("age",)))]:
+        m.add_items(d.dict() for d in data)
+        assert m.delete_where({"age": {"gt": 35}}) == [2, 3]
+        assert [i.name for i in m.all()["personal"]] == ["Adam", "Doug"]
+        assert m.count() == 2 and m.count({"age": {"gt": 0}}) == 2
+        assert m.filter({"name": "bruce"}) == []
+        assert not m.exists({"name": "Bruce"})
+        assert m.complete("name", "") == ["Adam", "Doug"]
+        assert m.database.get(2) is None
+        assert m.update(2, {"age": 50}) is None
+        assert len(m.database._table()) == 4
+
+        assert m.compact() == 2
+        assert m.compact() == 0
+        assert len(m.database._table()) == 2
+        assert [i.name for i in m.filter({"age": {"lt": 40}})] == ["Adam", "Doug"]
+        assert not m.exists({"name": "Bruce"})
+
+
+def young_schema():
+    return create_model("Item", age=(Optional[conint(lt=50)], None), __base__=Item)
+
+
+def test_migrate_on_read(data) -> None:
+    for m in models():
+        m.add_items(d.dict() for d in data)
+        m.update_item_schema(young_schema())
+        assert [i.age for i in m.all()["personal"]] == [30, 40, None, 33]
+        assert m.filter({"name": "Clarisse"})[0].age is None
+        # Reads don't write the migrated documents back
+        assert m.database._table().get(doc_id=3)["age"] == 60
+
+        m.update(3, {"email": "c@al.com"})
+        stored = m.database._table().get(doc_id=3)
+        assert stored["age"] is None
+        assert stored["_schema"] == schema_version(m.ItemSchema)
+
+
+def test_read_unstamped_documents(data) -> None:
+    for m in models():
+        # Written before documents were stamped with the version of their schema
+        m.database._table().insert_multiple([*(d.dict() for d in data), {"name": "Doug", "age": "35"}])
+        migrated = []
+        migrate = m.database.migration.migrate
+        m.database.migration.migrate = lambda document: migrated.append(document) or migrate(document)
+        assert [i.age for i in m.all()["personal"]] == [30, 40, 60, 33, 35]
+        # Only the document not having every field with a value of its type is validated
+        assert [d["name"] for d in migrated] == ["Doug"]
+
+
+def test_migrate_resumes(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    m = Model(TinyDBDatabase(path=path))
+    m.add_items(d.dict() for d in data)
+    m.update_item_schema(young_schema())
+    checkpoint = MigrationCheckpoint(path)
+
+    progress = m.migrate(batch_size=2)
+    assert next(progress).migrated == 2
+    assert checkpoint.load(schema_version(m.ItemSchema)) == ("personal", 2)
+    del progress
+
+    reopened = Model(TinyDBDatabase(path=path), custom_item_schema=young_schema())
+    assert [p.migrated for p in reopened.migrate(batch_size=2)] == [2]
+    assert not checkpoint.path.exists()
+    assert reopened.database._table().get(doc_id=3)["age"] is None
+    assert [p.migrated for p in reopened.migrate()] == []
+
+
+def test_migrate_required_field_without_default(data) -> None:
+    for m in models():
+        m.add_items(d.dict() for d in data[:2])
+        m.update_item_schema(create_model("Item", company=(str, ...), __base__=Item))
+        assert [p.failed for p in m.migrate()] == [[1, 2]]
+        with pytest.raises(MigrationError):
+            m.database.migration.migrate(m.database._table().get(doc_id=1))
+
+
+def test_changes_recorded_concurrently() -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+
+    def record(feed: ChangeFeed) -> None:
+        for id in range(50):
+            feed.record("add", "personal", [(id, {})])
+
+    # Each feed opens the file on its own, like several processes would
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        [*executor.map(record, [ChangeFeed(path) for _ in range(4)])]
+    assert [c.seq for c in ChangeFeed(path).since()] == list(range(1, 201))
+
+
+def test_changes() -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    for m in [*models(), Model(TinyDBDatabase(path=path))]:
+        received = []
+        unsubscribe = m.subscribe(received.append)
+        m.add_items([{"name": "Adam"}, {"name": "Bruce"}])
+        m.update(1, {"age": 30})
+        m.update_where({"name": "bruce"}, {"age": 40})
+        m.delete_where({"name": "adam"})
+        unsubscribe()
+        m.add_item({"name": "Clarisse"}, workspace="secondary")
+
+        changes = [*m.changes()]
+        assert [c.seq for c in changes] == [1, 2, 3, 4, 5, 6]
+        assert [(c.op, c.id) for c in changes] == [
+            ("add", 1), ("add", 2), ("update", 1), ("update", 2), ("delete", 1), ("add", 1)
+        ]
+        assert changes[2].document == {**Item(name="Adam").dict(), "age": 30}
+        assert changes[4].document is None
+        assert changes[5].workspace == "secondary"
+        assert received == changes[:5]
+        assert [c.seq for c in m.changes(since=4)] == [5, 6]
+        assert [*m.changes(since=6)] == []
+
+    reopened = Model(TinyDBDatabase(path=path))
+    assert reopened.database.feed.last_seq == 6
+    reopened.add_item({"name": "Doug"})
+    assert [(c.seq, c.document["name"]) for c in reopened.changes(since=6)] == [(7, "Doug")]
+
+
+def test_change_feed_since() -> None:
+    feed = ChangeFeed(Path(tempfile.mkdtemp()) / "db.json")
+    for i in range(0, 300, 3):
+        feed.record("add", "personal", [(i, {"name": "x" * i}), (i + 1, None), (i + 2, {})])
+    for since in (0, 1, 2, 150, 298, 299, 300):
+        assert [c.seq for c in feed.since(since)] == [*range(since + 1, 301)]
+
+
+def test_backup_and_restore(data) -> None:
+    folder = Path(tempfile.mkdtemp())
+    m = Model(TinyDBDatabase(path=folder / "db.json"))
+    m.add_items(d.dict() for d in data[:2])
+    assert backup(m.database, folder / "backup").snapshot == "snapshot-0000000002.json.gz"
+    assert backup(m.database, folder / "backup").seq == 2
+
+    m.add_item(data[2].dict(), workspace="secondary")
+    m.update(1, {"age": 31})
+    m.delete_where({"name": "bruce"})
+    result = backup(m.database, folder / "backup")
+    assert (result.segment, result.changes) == ("delta-0000000003-0000000005.jsonl.gz", 3)
+    expected = {w: [i.dict() for i in items] for w, items in m.all().items()}
+
+    restored = Model(TinyDBDatabase(path=folder / "restored.json", indexed_fields=("age",)))
+    restored.add_item({"name": "Overwritten"})
+    assert restore(restored.database, folder / "backup") == 5
+    assert {w: [i.dict() for i in items] for w, items in restored.all().items()} == expected
+    assert [i.name for i in restored.filter({"age": {"gt": 30}})] == ["Adam"]
+    assert restored.filter({"name": "overwritten"}) == []
+
+    assert backup(m.database, folder / "backup", full=True).snapshot
+    assert sorted(p.name for p in (folder / "backup").iterdir()) == [
+        "manifest.json", "snapshot-0000000005.json.gz"
+    ]
+
+
+def test_backup_after_restore(data) -> None:
+    folder = Path(tempfile.mkdtemp())
+    m = Model(TinyDBDatabase(path=folder / "db.json"))
+    m.add_items(d.dict() for d in data[:2])
+    backup(m.database, folder / "backup")
+    m.add_item({"name": "Rolled back"})
+    assert restore(m.database, folder / "backup") == 2
+    assert [c.op for c in m.changes(since=3)] == ["reset"]
+
+    m.add_item({"name": "Eve"})
+    # The changes since the backup include the rolled back one, a new snapshot is needed
+    assert backup(m.database, folder / "backup").snapshot
+    restored = Model(TinyDBDatabase(path=folder / "restored.json"))
+    restore(restored.database, folder / "backup")
+    assert [i.name for i in restored.all()["personal"]] == [d.name for d in data[:2]] + ["Eve"]
+
+
+def test_restore_corrupted_backup(data) -> None:
+    folder = Path(tempfile.mkdtemp())
+    m = Model(TinyDBDatabase(path=folder / "db.json"))
+    m.add_items(d.dict() for d in data)
+    backup(m.database, folder)
+    m.update(1, {"age": 31})
+    segment = folder / backup(m.database, folder).segment
+    segment.write_bytes(segment.read_bytes()[:-1])
+    with pytest.raises(BackupError, match="corrupted"):
+        restore(m.database, folder)
+    assert m.get(1).age == 31
+
+
+def test_compressed_database(data) -> None:
+    folder = Path(tempfile.mkdtemp())
+    for name in ("db.json", "db.json.gz"):
+        m = Model(TinyDBDatabase(path=folder / name, indexed_fields=("age",)))
+        m.add_items(d.dict() for d in data * 20)
+        m.update(1, {"age": 31})
+
+    compressed = folder / "db.json.gz"
+    assert compressed.read_bytes()[:2] == b"\x1f\x8b"
+    assert compressed.stat().st_size < (folder / "db.json").stat().st_size
+    reopened = Model(TinyDBDatabase(path=compressed, indexed_fields=("age",)))
+    assert len(reopened.all()["personal"]) == len(data) * 20
+    assert reopened.get(1).age == 31
+    assert Configuration(database_path=compressed).database_path == compressed
+    with pytest.raises(ConfigurationError):
+        Configuration(database_path=folder / "db.gz")
+
+
+def test_storage_formats(data) -> None:
+    folder = Path(tempfile.mkdtemp())
+    m = Model(TinyDBDatabase(path=folder / "db.json", storage_format="binary"))
+    m.add_items(d.dict() for d in data)
+    assert (folder / "db.json").read_bytes().startswith(BinarySerializer.MAGIC)
+    reopened = Model(TinyDBDatabase(path=folder / "db.json", storage_format="binary"))
+    assert [i.name for i in reopened.filter({"name": "a"})] == [i.name for i in m.filter({"name": "a"})]
+
+    m.database.convert_storage("json")
+    assert json.loads((folder / "db.json").read_bytes())["personal"]["1"]["name"] == "Adam"
+    m.update(1, {"age": 31})
+    assert Model(TinyDBDatabase(path=folder / "db.json")).get(1).age == 31
+
+    compressed = Model(TinyDBDatabase(path=folder / "db.json.gz", storage_format="binary"))
+    compressed.add_items(d.dict() for d in data)
+    assert compressed.database.convert_storage("json") == (folder / "db.json.gz").stat().st_size
+    assert len(Model(TinyDBDatabase(path=folder / "db.json.gz")).all()["personal"]) == len(data)
+
+    with pytest.raises(StorageFormatError):
+        TinyDBDatabase(path=folder / "db.json", storage_format="xml")
+    binary = BinarySerializer()
+    document = {"a": {"1": {"s": "é", "n": None, "b": [True, False], "i": -2**70, "f": 1.5}}}
+    assert binary.loads(binary.dumps(document)) == document
+    # Fixed bytes, whatever the Python version
+    assert binary.dumps({"a": [1, "b"]}) == (
+        b"ALPB\x02m\x01\x00\x00\x00s\x01\x00\x00\x00al\x02\x00\x00\x00"
+        b"i\x01\x00\x00\x00\x00\x00\x00\x00s\x01\x00\x00\x00b"
+    )
+    for corrupted in (binary.dumps(document)[:-2], b"ALPB\x01", b"ALPB\x02x"):
+        with pytest.raises(ValueError):
+            binary.loads(corrupted)
+    with pytest.raises(ConfigurationError):
+        Configuration(storage_format="xml")
+
+
+@pytest.mark.skipif(orjson is None, reason="orjson isn't installed")
+def test_orjson_storage_format(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    m = Model(TinyDBDatabase(path=path, storage_format="orjson"))
+    m.add_items(d.dict() for d in data)
+    assert len(Model(TinyDBDatabase(path=path)).all()["personal"]) == len(data)
+
+
+class SlowDatabase(TinyDBDatabase):
+    def filter(self, *args, **kwargs):
+        time.sleep(0.5)
+        return super().filter(*args, **kwargs)
+
+
+def test_federated_database(data) -> None:
+    folder = Path(tempfile.mkdtemp())
+    team_a = Model(TinyDBDatabase(path=folder / "a.json"))
+    team_a.add_items(d.dict() for d in data[:2])
+    team_b = Model(TinyDBDatabase(path=folder / "b.json"))
+    team_b.add_items([{"name": "ADAM", "email": "adam@al.com", "address": "Street"}, data[2].dict()])
+    slow = Model(SlowDatabase(path=folder / "c.json"))
+    slow.add_item(data[3].dict())
+
+    m = Model(
+        FederatedDatabase(
+            [
+                Source("a", team_a.database),
+                Source("b", team_b.database),
+                Source("slow", slow.database, timeout=0.05),
+            ]
+        )
+    )
+    with pytest.warns(UserWarning, match="slow didn't answer"):
+        found = m.filter({"email": "al.com"})
+    assert [(i.name, i.sources, i.address) for i in found] == [
+        ("Adam", ["a", "b"], "Street"), ("Bruce", ["a"], None), ("Clarisse", ["b"], None)
+    ]
+    # The slow source doesn't keep the process running at exit
+    answering = [t for t in threading.enumerate() if t.name == "al_phonebook-federated-slow"]
+    assert answering and all(t.daemon for t in answering)
+    # It isn't queried again until it's done, which would hold another thread
+    start = time.monotonic()
+    with pytest.warns(UserWarning, match="slow is still answering"):
+        assert len(m.filter({"email": "al.com"})) == 3
+    assert time.monotonic() - start < 0.4
+    # The slow source is still busy with the filter until then
+    time.sleep(0.5)
+    assert [i.name for i in m.all()["personal"]] == ["Adam", "Bruce", "Clarisse", "Doug"]
+    assert m.get(2).name == "Bruce"
+    assert m.database.get(2, source="b")["name"] == "Clarisse"
+
+    assert m.add_item({"name": "Eve"}) == 3
+    assert team_a.get(3).name == "Eve"
+    # Ids are only unique within a source
+    m.update(2, {"age": 50}, source="a")
+    assert team_a.get(2).age == 50
+    with pytest.raises(FederationError):
+        m.update(2, {"age": 50}, source="b")
+    assert team_b.get(2).age == data[2].age
+    # Contacts of the same source aren't merged, even with the same identity
+    team_a.add_item({"name": "John Smith"})
+    team_a.add_item({"name": "John Smith", "age": 40})
+    team_b.add_item({"name": "john smith", "address": "Street"})
+    found = [(i.id, i.sources, i.address) for i in m.filter({"name": "John"})]
+    assert found == [(4, ["a", "b"], "Street"), (5, ["a"], None)]
+    assert [i.name for i in m.all()["personal"]].count("John Smith") == 2
+    with pytest.raises(FederationError):
+        FederatedDatabase([Source("a", team_a.database), Source("a", team_b.database)])
+    with pytest.raises(ConfigurationError):
+        Configuration(sources={"local": {"path": folder / "b.json"}})
+
+
+def test_sort(data) -> None:
+    for indexed in ((), ("age",)):
+        m = Model(TinyDBDatabase(path=None, in_memory=True, indexed_fields=indexed))
+        m.add_items([*(d.dict() for d in data), {"name": "eve"}])
+        assert [i.name for i in m.filter({}, order_by="-age")] == ["Clarisse", "Bruce", "Doug", "Adam", "eve"]
+        assert [i.name for i in m.filter({"email": "al.com"}, order_by="age", limit=2)] == ["Adam", "Doug"]
+        assert [i.name for i in m.all(order_by=["-name"])["personal"]] == ["eve", "Doug", "Clarisse", "Bruce", "Adam"]
+        assert [i.name for i in m.all(limit=1)["personal"]] == ["Adam"]
+    with pytest.raises(SortError):
+        m.filter({}, order_by="name,,age")
+    with pytest.raises(SortError):
+        m.all(order_by="height")
+
+
+def test_sort_by_index_keeps_ties() -> None:
+    plain, indexed = models(), Model(TinyDBDatabase(path=None, in_memory=True, indexed_fields=("age",)))
+    for m in (*plain, indexed):
+        m.add_items({"name": f"n{i}", "age": (30, 20)[i % 2]} for i in range(8))
+        m.update(1, {"age": 20})
+    # Sorting doesn't build the indexes
+    assert indexed.database._indexes == {}
+    expected = [i.name for i in plain[0].filter({}, order_by="-age")]
+    indexed.filter({"age": {"gt": 0}})  # builds the index
+    for order_by in ("-age", "age"):
+        assert [i.name for i in indexed.filter({}, order_by=order_by)] == [
+            i.name for i in plain[0].filter({}, order_by=order_by)
+        ]
+    assert expected[:4] == ["n2", "n4", "n6", "n0"]
+    assert [i.name for i in indexed.filter({"name": "n7"}, order_by="-age")] == ["n7"]
+    assert [i.name for i in indexed.filter({}, order_by="-age", limit=2)] == ["n2", "n4"]
+
+
+def test_sort_entries_spills_runs() -> None:
+    entries = [{"name": f"n{i % 7}", "age": i} for i in range(100)]
+    order = parse_order("name,-age")
+    expected = sorted(sorted(entries, key=lambda e: -e["age"]), key=lambda e: e["name"])
+    assert list(sort_entries(entries, order, run_size=8)) == expected
+    assert list(sort_entries(entries, order, limit=3, run_size=8)) == expected[:3]
+
+
+def test_async_model(data) -> None:
+    async def run(model: Model) -> None:
+        async with AsyncModel(model) as phonebook:
+            await phonebook.add_items(d.dict() for d in data)
+            METRICS.reset()
+            filters = [{"name": "a"}, {"name": "Cla"}, {"email": "al.com"}, {"name": "a"}]
+            results = await asyncio.gather(*(phonebook.filter(f) for f in filters))
+            # A single load of the workspace is shared by every search
+            assert METRICS.latency["storage.read"].count == 1
+            assert [[i.name for i in r] for r in results] == [
+                [i.name for i in model.filter(f)] for f in filters
+            ]
+            # Searches don't use a load made before a write started while they wait for it
+            search = asyncio.ensure_future(phonebook.filter({"name": "Fay"}))
+            for _ in range(3):
+                await asyncio.sleep(0)  # the load is submitted
+            await phonebook.add_item({"name": "Fay"})
+            assert [i.name for i in await search] == ["Fay"]
+            assert (await phonebook.get(3)).name == "Clarisse"
+
+            assert await phonebook.add_item({"name": "Eve"}, workspace="secondary") == 1
+            found = await phonebook.filter({"name": "e"}, workspace="secondary")
+            assert [i.name for i in found] == ["Eve"]
+            await phonebook.update(1, {"age": 31})
+            entries = [(w, i.name, i.age) async for w, i in phonebook.all()]
+            assert entries[0] == ("personal", "Adam", 31)
+            assert entries[-1] == ("secondary", "Eve", None)
+            assert len(entries) == len(data) + 2
+
+    for model in models():
+        asyncio.run(run(model))
+
+    async def update_source(model: Model) -> None:
+        async with AsyncModel(model) as phonebook:
+            await phonebook.update(1, {"age": 32}, source="a")
+            assert (await phonebook.get(1)).age == 32
+            with pytest.raises(FederationError):
+                await phonebook.update(1, {"age": 33}, source="b")
+
+    local = Model(TinyDBDatabase(path=None, in_memory=True))
+    local.add_item({"name": "Adam"})
+    asyncio.run(update_source(Model(FederatedDatabase([Source("a", local.database)]))))
+
+
+def test_memory_budget(data) -> None:
+    path = Path(tempfile.mkdtemp()) / "db.json"
+    m = Model(TinyDBDatabase(path=path), max_memory=parse_size("1K"))
+    m.add_items(d.dict() for d in data)
+    m.add_item({"name": "Eve"}, workspace="secondary")
+    assert m.streams()
+    assert not Model(m.database, max_memory=parse_size("1M")).streams()
+    assert not Model(TinyDBDatabase(path=None, in_memory=True), max_memory=1).streams()
+
+    # A budget this small sorts in runs of a single entry
+    entries = [(w, i.name) for w, i in m.iter_all(order_by="-age")]
+    assert entries == [
+        ("personal", "Clarisse"), ("personal", "Bruce"), ("personal", "Doug"),
+        ("personal", "Adam"), ("secondary", "Eve"),
+    ]
+    found = m.iter_filter({"age": {"gt": 30}}, order_by="name", limit=2)
+    assert [(i.id, i.name) for i in found] == [(2, "Bruce"), (3, "Clarisse")]
+    with pytest.raises(FilterError):
+        m.iter_filter({"age": {"gt": "x"}})
+    with pytest.raises(SortError):
+        m.iter_all(order_by="height")
+    assert parse_size("1.5G") == 3 << 29
+    with pytest.raises(ValueError):
+        parse_size("128X")
+
+
+def test_metrics(data) -> None:
+    METRICS.reset()
+    m = Model(TinyDBDatabase(path=Path(tempfile.mkdtemp()) / "db.json"))
+    m.add_items(d.dict() for d in data)
+    reads = METRICS.latency["storage.read"].count
+    assert len(m.filter({"name": "a"})) == 2
+    # Counting the rows scanned mustn't read the database again
+    assert METRICS.latency["storage.read"].count == reads + 1
+
+    assert METRICS.latency["model.filter"].count == 1
+    assert METRICS.latency["database.filter"].count == 1
+    assert METRICS.latency["storage.write"].count >= 1
+    assert METRICS.counters["rows_scanned"] == 4
+    assert METRICS.counters["rows_returned"] == 2
+    assert METRICS.counters["bytes_written"] > 0 and METRICS.counters["bytes_read"] > 0
+
+    exported = METRICS.to_prometheus()
+    assert 'al_phonebook_operation_seconds_count{operation="model.filter"} 1' in exported
+    assert 'al_phonebook_operation_seconds_bucket{operation="model.filter",le="+Inf"} 1' in exported
+    assert "al_phonebook_rows_scanned_total 4" in exported
+    assert json.loads(METRICS.to_json())["counters"]["rows_returned"] == 2
+
+
+def test_explain(models_with_data) -> None:
+    for model in models_with_data:
+        plan = model.explain({"age": {"gt": 35}, "name": "a"})
+        assert plan.access_path == "index"
+        assert [(s.field, s.access, s.rows) for s in plan.steps] == [
+            ("age", "sorted index", 2),
+            ("name", "full scan", None),
+        ]
+        assert (plan.estimated_rows, plan.rows_scanned, plan.rows_returned) == (2, 2, 1)
+        assert set(plan.timings) == {"plan", "search"}
+
+        plan = model.explain({"email": "al.com"})
+        assert plan.access_path == "full scan"
+        assert (plan.estimated_rows, plan.rows_scanned, plan.rows_returned) == (4, 4, 4)
+
+        plans: list = []
+        reads = METRICS.latency["storage.read"].count
+        assert len(model.filter({"email": "al.com"}, plans=plans)) == 4
+        # The plan comes from the search itself, reading the database once
+        assert [p.rows_returned for p in plans] == [4]
+        assert METRICS.latency["storage.read"].count == reads + 1
+
+
+def test_slow_query_log(data) -> None:
+    log = Path(tempfile.mkdtemp()) / "slow.log"
+    m = Model(TinyDBDatabase(path=None, in_memory=True, slow_query_log=SlowQueryLog(log, 0)))
+    m.add_items(d.dict() for d in data)
+    assert [i.name for i in m.filter({"name": "doug"})] == ["Doug"]
+    entry = json.loads(log.read_text().split(" ", 2)[2])
+    assert entry["filters"] == {"name": "doug"}
+    assert entry["plan"]["rows_returned"] == 1
+
+    m.database.slow_query_log = SlowQueryLog(log, threshold_ms=60_000)
+    m.filter({"name": "adam"})
+    assert len(log.read_text().splitlines()) == 1
+
+
 def test_exact_filter(models_with_data, data) -> None:
     for model in models_with_data:
         r = model.filter({"name": "Bruce"}, exact=True)